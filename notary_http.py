@@ -20,22 +20,21 @@ import argparse
 import logging
 import os
 import re
-import struct
-import threading
-from xml.dom.minidom import getDOMImplementation
+import time
 
 import cherrypy
 
 from notary_util import notary_common
 from notary_util import notary_logs
-from notary_util.notary_db import ndb
+from notary_util import notary_reply
+from notary_util.notary_db import ndb, SchemaError
+from notary_util.notary_response_store import ResponseStore, ResponseStoreError
 from util import crypto, cache
+from util.scan_pool import ScanPool
+from util.singleflight import SingleFlight, SingleFlightTimeout
 from util.keymanager import keymanager
 from util.ssl_scan_sock import attempt_observation_for_service, SSLScanTimeoutException, SSLAlertException
 
-# track locks at the module level so we only use them once across all cherrypy threads
-PROBE_LIMIT = 10 # simultaneous scans for new services
-
 class NotaryHTTPServer(object):
 	"""
 	Network Notary server for the Perspectives project
@@ -48,7 +47,7 @@ class NotaryHTTPServer(object):
 	# MAJOR version when you make large architectural changes,
 	# MINOR version when you add functionality in a backwards-compatible manner
 	# PATCH version when you make backwards-compatible bug fixes.
-	VERSION = "3.5"
+	VERSION = "3.6"
 
 	DEFAULT_WEB_PORT = 8080
 	ENV_PORT_KEY_NAME = 'PORT'
@@ -56,6 +55,13 @@ class NotaryHTTPServer(object):
 	STATIC_INDEX = "index.html"
 	LOG_FILE = 'webserver.log'
 	CHERRYPY_FILE = 'cherrypy.log'
+	COALESCE_TIMEOUT = 10 # seconds
+	SCAN_THREADS = 10 # simultaneous scans for new services
+	SCAN_QUEUE_SIZE = 100 # services waiting to be scanned
+	ON_DEMAND_SCAN_TIMEOUT = 10 # seconds
+
+	# options for scanning new services, which a notary serving a response store never does
+	SCAN_OPTIONS = ['scan_threads', 'scan_queue_size', 'wait_for_scan']
 
 	CACHE_EXPIRY = 12 # hours. see doc/advanced_notary_configuration.txt
 
@@ -96,6 +102,18 @@ class NotaryHTTPServer(object):
 			help="Use RAM to cache observation data on the local machine only.\
 			If you don't use any other type of caching, use this! " + cache.Pycache.get_help())
 
+		parser.add_argument('--negative-cache', default=False, const=cache.NegativeCache.CACHE_SIZE,
+			nargs='?', type=cls.positive_integer, metavar="MAX_ENTRIES",
+			help="Remember services that have no observations (and services we could not scan) in RAM for a short time,\
+			and return 404 Not Found for them right away without querying the database.\
+			This is separate from any other caching. If MAX_ENTRIES is not given, remember up to %(const)s services.")
+		parser.add_argument('--negative-cache-expiry', '--negative-cache-duration',\
+			default=str(cache.NegativeCache.CACHE_EXPIRY) + 's', type=cls.cache_duration,
+			metavar="NEGATIVE_CACHE_EXPIRY[Ss|Mm|Hh]",
+			help="Expire negative cache entries after this many seconds / minutes / hours. " +\
+			"Hours is the default time unit if none is provided. " +\
+			"Clients retry requests for unknown services, so keep this short. Default: %(default)s.")
+
 		parser.add_argument('--sni', action='store_true', default=False,
 			help="Use Server Name Indication when scanning sites. See section 3.1 of http://www.ietf.org/rfc/rfc4366.txt.\
 			 Default: \'%(default)s\'")
@@ -111,6 +129,13 @@ class NotaryHTTPServer(object):
 			"so you may want your (scan frequency + scan duration + cache expiry) to be <= 48 hours. Default: " +\
 			str(cls.CACHE_EXPIRY) + " hours.")
 
+		parser.add_argument('--history-days',\
+			default=0, type=cls.non_negative_integer, metavar="DAYS",
+			help="Only include observations that ended within this many days in replies.\
+			Clients only look at recent observations, so this makes replies smaller and faster to build.\
+			Services with no observations in this time are treated like new services.\
+			0 means include every observation. Default: %(default)s.")
+
 		# socket_queue_size and thread_pool use the cherrypy defaults,
 		# but we hardcode them here rather than refer to the cherrypy variables directly
 		# just in case the cherrypy architecture changes.
@@ -122,25 +147,82 @@ class NotaryHTTPServer(object):
 			default=10, type=cls.positive_integer,
 			help="The number of worker threads to start up in the pool. Must be a positive integer. Default: %(default)s.")
 
+		parser.add_argument('--scan-threads',\
+			default=cls.SCAN_THREADS, type=cls.positive_integer,
+			help="When a service we have no data for is requested it is scanned in the background.\
+			This is the number of services that can be scanned at the same time. Must be a positive integer. Default: %(default)s.")
+		parser.add_argument('--scan-queue-size', '--scan-queue',\
+			default=cls.SCAN_QUEUE_SIZE, type=cls.positive_integer,
+			help="The maximum number of services that can wait for a free scan thread.\
+			Requests for new services beyond this are not scanned. Must be a positive integer. Default: %(default)s.")
+
+		parser.add_argument('--wait-for-scan',\
+			default=0, type=cls.non_negative_integer, metavar="SECONDS",
+			help="When a service we have no data for is requested, wait up to this many seconds for it to be scanned\
+			and return the results, rather than returning 404 Not Found right away and having the client ask again.\
+			Each waiting request uses a web server thread, so you may want to increase --thread-pool-size.\
+			0 means don't wait. Default: %(default)s.")
+
+		parser.add_argument('--response-store', metavar='FILE',
+			help="Answer every request from a file of signed replies written by notary_util/build_response_store.py\
+			instead of using the database or the private key. Services that aren't in the file get 404 Not Found\
+			and are not scanned, so this can't be used with --scan-threads, --scan-queue-size or --wait-for-scan. The file is reloaded automatically when it is rebuilt.\
+			See doc/advanced_notary_configuration.txt.")
+
+		parser.add_argument('--coalesce-timeout',\
+			default=cls.COALESCE_TIMEOUT, type=cls.positive_integer,
+			help="When several requests for the same service arrive at once, only one of them queries the database;\
+			the others wait for and share its result. This is how many seconds they will wait\
+			before giving up and returning 503 Service Unavailable. Must be a positive integer. Default: %(default)s.")
+
 		return parser
 
 	def __init__(self):
-		args = self.get_parser().parse_args()
+		parser = self.get_parser()
+		args = parser.parse_args()
+		if (args.response_store):
+			for option in self.SCAN_OPTIONS:
+				if (getattr(args, option) != parser.get_default(option)):
+					parser.error("--{0} cannot be used with --response-store, which never scans new services.".format(
+						option.replace('_', '-')))
 		notary_logs.setup_logs(args.logfile, self.LOG_FILE)
 
-		# pass ndb the args so it can use any relevant ones from its own parser
-		try:
-			self.ndb = ndb(args)
-		except Exception as e:
+		self.response_store = None
+		if (args.response_store):
+			# every reply is already signed, so we need neither the database nor the private key
+			try:
+				self.response_store = ResponseStore(args.response_store)
+			except (IOError, ResponseStoreError) as e:
+				logging.error("Could not open response store: '%s'" % (str(e)))
+				exit(1)
 			self.ndb = None
-			logging.error("Database error: '%s'" % (str(e)))
+			self.notary_public_key = self.response_store.get_public_key()
+			self.notary_priv_key = None
+			self.signer = None
+			(num_services, built_time) = self.response_store.get_stats()
+			print("Serving {0} services from '{1}', built {2}.".format(
+				num_services, args.response_store, time.ctime(built_time)))
+		else:
+			# pass ndb the args so it can use any relevant ones from its own parser
+			try:
+				self.ndb = ndb(args)
+			except SchemaError as e:
+				# serving without the database would hide the problem, so don't start at all
+				logging.error(str(e))
+				exit(1)
+			except Exception as e:
+				self.ndb = None
+				logging.error("Database error: '%s'" % (str(e)))
 
-		# same for keymanager
-		km = keymanager(args)
-		(self.notary_public_key, self.notary_priv_key) = km.get_keys()
-		if (self.notary_public_key == None or self.notary_priv_key == None):
-			logging.error("Could not get public and private keys.")
-			exit(1)
+			# same for keymanager
+			km = keymanager(args)
+			(self.notary_public_key, self.notary_priv_key) = km.get_keys()
+			if (self.notary_public_key == None or self.notary_priv_key == None):
+				logging.error("Could not get public and private keys.")
+				exit(1)
+
+			# parse the private key once here rather than for every response we sign
+			self.signer = crypto.Signer(self.notary_priv_key)
 
 		self.web_port = self.DEFAULT_WEB_PORT
 		if (args.envport):
@@ -162,10 +244,33 @@ class NotaryHTTPServer(object):
 		elif (args.pycache):
 			self.cache = cache.Pycache(args.pycache)
 
+		self.negative_cache = None
+		if (args.negative_cache):
+			self.negative_cache = cache.NegativeCache(args.negative_cache, args.negative_cache_expiry)
+
+		# only let one thread at a time calculate the response for a given service
+		self.in_flight = SingleFlight()
+
 		self.use_sni = args.sni
 		self.create_static_index()
 		self.args = args
 
+		# scan services we have no data for in the background.
+		# scan results are saved to the database, so without one there is nothing to scan for.
+		self.scan_pool = None
+		if (self.ndb != None):
+			self.scan_pool = ScanPool(self.scan_service, args.scan_threads, args.scan_queue_size)
+
+		# every web server and scan thread may want a database connection at the same time.
+		# if the pool can't open that many, requests queue for a connection and may time out.
+		connections_needed = args.thread_pool_size + args.scan_threads
+		if ((self.scan_pool != None) and (args.db_pool_size + args.db_max_overflow < connections_needed) and
+			(self.ndb.db.dialect.name != 'sqlite')):
+			logging.warning(("The database pool allows {0} connections (--db-pool-size + --db-max-overflow) " +
+				"but there are {1} web server and scan threads (--thread-pool-size + --scan-threads). " +
+				"Requests may wait for a database connection.").format(
+				args.db_pool_size + args.db_max_overflow, connections_needed))
+
 		print("Using public key\n" + self.notary_public_key)
 
 
@@ -183,6 +288,14 @@ class NotaryHTTPServer(object):
 			raise argparse.ArgumentTypeError("'{0}' is not a positive integer.".format(value))
 		return ivalue
 
+	@classmethod
+	def non_negative_integer(self, value):
+		"""Convert value to an integer >= 0, or raise an exception if we cannot."""
+		ivalue = int(value)
+		if ivalue < 0:
+			raise argparse.ArgumentTypeError("'{0}' is not a non-negative integer.".format(value))
+		return ivalue
+
 	@classmethod
 	def cache_duration(self, value):
 		"""Validate cache duration time, or raise an exception if we cannot."""
@@ -279,12 +392,25 @@ class NotaryHTTPServer(object):
 
 		service = str(host + ":" + port + "," + service_type)
 
+		if (self.response_store != None):
+			entry = self.response_store.get(service)
+			if (entry == None):
+				raise cherrypy.HTTPError(404) # 404 Not Found
+			return notary_reply.render_cache_entry(entry)
+
+		if (self.negative_cache != None and self.negative_cache.contains(service)):
+			# we recently found no observations for this service.
+			# a scan has already been started if we could; don't query the database again.
+			self.ndb.report_metric('NegativeCacheHit', "Service: {0} HitCount: {1}".format(
+				service, self.negative_cache.get_hit_count()))
+			raise cherrypy.HTTPError(404) # 404 Not Found
+
 		if (self.cache):
 			try:
 				cached_service = self.cache.get(service)
 				if (cached_service != None):
 					self.ndb.report_metric('CacheHit', service)
-					return cached_service
+					return notary_reply.render_cache_entry(cached_service)
 				else:
 					self.ndb.report_metric('CacheMiss', service)
 			except Exception as e:
@@ -292,124 +418,153 @@ class NotaryHTTPServer(object):
 
 		#TODO: don't reference session directly
 		if (not self.args.cache_only and self.ndb and (self.ndb._Session != None)):
-			return self.calculate_service_xml(service, service_type)
+			return self.coalesce_service_xml(service, service_type)
 		else:
 			logging.error("Database is not available to retrieve data, and data not in the cache.\n")
 			raise cherrypy.HTTPError(503) # 503 Service Unavailable
 
-	def calculate_service_xml(self, service, service_type):
+	def coalesce_service_xml(self, service, service_type):
 		"""
-		Query the database and build a response containing any known keys for the given service.
+		Calculate the xml response for a service,
+		or wait for and share the result if another thread is already calculating it.
 		"""
-
-		self.ndb.report_metric('GetObservationsForService', service)
-		obs = None
-		timestamps_by_key = {}
-		keys = []
-		num_rows = 0
-
+		# when a popular service's cache entry expires many requests for it can arrive at once;
+		# this prevents every one of them from querying the database and signing the same response.
 		try:
-			# TODO: can we grab this all in one query instead of looping?
-			with self.ndb.get_session() as session:
-				obs = self.ndb.get_observations(session, service)
-				if (obs != None):
-					for (_, key, start, end) in obs:
-						num_rows += 1
-						if key not in keys:
-							timestamps_by_key[key] = []
-							keys.append(key)
-						timestamps_by_key[key].append((start, end))
+			# the thread calculating the response may also be waiting for a scan
+			return self.in_flight.do(service,
+				lambda: self.calculate_service_xml(service, service_type),
+				self.args.coalesce_timeout + self.args.wait_for_scan)
+		except SingleFlightTimeout as e:
+			logging.warning(str(e))
+			raise cherrypy.HTTPError(503) # 503 Service Unavailable
+		finally:
+			# report running totals, like ResponseSigned does
+			(coalesced, timeouts) = self.in_flight.get_stats()
+			if (coalesced > 0):
+				self.ndb.report_metric('RequestCoalesced', "CoalescedCount: {0} TimeoutCount: {1}".format(
+					coalesced, timeouts))
+
+	def get_key_timespans(self, service):
+		"""Get the observations for a service, grouped by key."""
+		min_end = None
+		if (self.args.history_days > 0):
+			min_end = int(time.time()) - (self.args.history_days * 3600 * 24)
+		try:
+			return self.ndb.get_observations_by_key(service, min_end)
 		except Exception:
-			# error already logged inside get_observations.
+			# error already logged inside get_observations_by_key.
 			# we can also see InterfaceError or AttributeError when looping through observation records
 			# if the database is under heavy load.
 			raise cherrypy.HTTPError(503) # 503 Service Unavailable
 
-		if num_rows == 0:
-			# rate-limit on-demand probes
-			global scan_semaphore
-			global scan_sites
-			global scan_sites_lock
-
-			if (scan_semaphore.acquire(False)):
-				do_scan = False
-				with scan_sites_lock:
-					if (service not in scan_sites):
-						# only scan a given site with one thread at a time
-						scan_sites[service] = True
-						do_scan = True
-
-				if (do_scan):
-					t = OnDemandScanThread(service, 10, self.use_sni, self, self.ndb)
-					t.start()
-					# report the metrics *after* launching so the scanning thread can get started
-					self.ndb.report_metric('ScanForNewService', service)
-				else:
-					scan_semaphore.release()
-			else:
-				self.ndb.report_metric('ProbeLimitExceeded', "CurrentProbleLimit: " + str(PROBE_LIMIT) + " Service: " + service)
-			# return 404, assume client will re-query
-			raise cherrypy.HTTPError(404) # 404 Not Found
-	
-		dom_impl = getDOMImplementation()
-		new_doc = dom_impl.createDocument(None, "notary_reply", None)
-		top_element = new_doc.documentElement
-		top_element.setAttribute("version", "1")
-		top_element.setAttribute("sig_type", "rsa-md5")
-
-		packed_data = ""
-
-		# create an XML response that we'll send back to the client
-		for k in keys:
-			key_elem = new_doc.createElement("key")
-			key_elem.setAttribute("type", notary_common.SERVICE_TYPES[service_type])
-			key_elem.setAttribute("fp", k)
-			top_element.appendChild(key_elem)
-			num_timespans = len(timestamps_by_key[k])
-			head = struct.pack("BBBBB", (num_timespans >> 8) & 255, num_timespans & 255, 0, 16, 3)
-
-			fp_bytes = ""
-			for hex_byte in k.split(":"):
-				fp_bytes += struct.pack("B", int(hex_byte, 16))
-
-			ts_bytes = ""
-			for ts in sorted(timestamps_by_key[k], key=lambda t_pair: t_pair[0]):
-				ts_start = ts[0]
-				ts_end = ts[1]
-				ts_elem = new_doc.createElement("timestamp")
-				ts_elem.setAttribute("end", str(ts_end))
-				ts_elem.setAttribute("start", str(ts_start))
-				key_elem.appendChild(ts_elem)
-				ts_bytes += struct.pack("BBBB", ts_start >> 24 & 255,
-					ts_start >> 16 & 255,
-					ts_start >> 8 & 255,
-					ts_start & 255)
-				ts_bytes += struct.pack("BBBB", ts_end >> 24 & 255,
-					ts_end >> 16 & 255,
-					ts_end >> 8 & 255,
-					ts_end & 255)
-			packed_data = (head + fp_bytes + ts_bytes) + packed_data
-
-		packed_data = service.encode() + struct.pack("B", 0) + packed_data
-		sig = crypto.sign_content(packed_data, self.notary_priv_key)
-		top_element.setAttribute("sig", sig)
-		xml = top_element.toprettyxml()
+	def scan_new_service(self, service):
+		"""
+		Queue a scan for a service we have no observations for.
+
+		If --wait-for-scan is used, wait for the scan and return True if it finished in time.
+		Otherwise return False right away.
+		"""
+		wait = (self.args.wait_for_scan > 0)
+
+		if (self.negative_cache != None and not wait):
+			# remember that the service has no data until a scan finds some.
+			# do this before queueing the scan so a scan that finishes right away can't be missed.
+			# (if we're waiting for the scan, let other requests for the service wait for it too;
+			# a failed scan adds the service to the negative cache.)
+			self.negative_cache.add(service)
+
+		priority = ScanPool.PRIORITY_NORMAL
+		if (wait):
+			# someone is waiting on the result, so scan before services nobody is waiting for
+			priority = ScanPool.PRIORITY_HIGH
+
+		result = self.scan_pool.submit(service, priority)
+		if (result == ScanPool.QUEUED):
+			self.ndb.report_metric('ScanForNewService', service)
+		elif (result == ScanPool.QUEUE_FULL):
+			if (self.negative_cache != None):
+				# we haven't tried to scan the service, so let clients ask again
+				self.negative_cache.discard(service)
+			self.ndb.report_metric('ProbeLimitExceeded', "ScanQueueSize: {0} Service: {1}".format(
+				self.args.scan_queue_size, service))
+			return False
+		# else a scan for this service is already waiting or running
+
+		if (wait):
+			if (self.scan_pool.wait(service, self.args.wait_for_scan)):
+				return True
+			self.ndb.report_metric('ScanWaitTimeout', "WaitForScan: {0} Service: {1}".format(
+				self.args.wait_for_scan, service))
+		return False
+
+	def calculate_service_xml(self, service, service_type):
+		"""
+		Query the database and build a response containing any known keys for the given service.
+		"""
+
+		self.ndb.report_metric('GetObservationsForService', service)
+
+		key_timespans = self.get_key_timespans(service)
+
+		if (len(key_timespans) == 0):
+			if (self.scan_new_service(service)):
+				# the scan finished while we waited; see whether it found anything
+				key_timespans = self.get_key_timespans(service)
+
+			if (len(key_timespans) == 0):
+				# return 404, assume client will re-query
+				raise cherrypy.HTTPError(404) # 404 Not Found
+
+		# create an XML response that we'll send back to the client.
+		# cache the compact signed data rather than the XML when we can; it's much smaller.
+		cache_entry = notary_reply.build_cache_entry(service, service_type, key_timespans, self.signer)
+		if (cache_entry != None):
+			xml = notary_reply.render_cache_entry(cache_entry)
+		else:
+			xml = notary_reply.build_reply(service, service_type, key_timespans, self.signer)
+			cache_entry = xml
+
+		(sign_count, avg_sign_time, max_sign_time) = self.signer.get_stats()
+		self.ndb.report_metric('ResponseSigned', "AverageSignTime: {0:.6f} MaxSignTime: {1:.6f} SignCount: {2}".format(
+			avg_sign_time, max_sign_time, sign_count))
+		self.ndb.report_metric('DatabasePoolStats', ("OpenConnections: {open} AverageWaitTime: {avg_wait:.6f} " +
+			"MaxWaitTime: {max_wait:.6f} Checkouts: {checkouts} Timeouts: {timeouts}").format(**self.ndb.get_pool_stats()))
 
 		if (self.cache != None):
-			self.cache.set(service, xml, expiry=self.args.cache_expiry)
+			self.cache.set(service, cache_entry, expiry=self.args.cache_expiry)
 
 		return xml
 
-	def scan_finished(self, service):
-		"""Clean up any state used for on-deman scans."""
-		global scan_semaphore
-		global scan_sites
-		global scan_sites_lock
+	def scan_service(self, service):
+		"""Scan a service we have no observations for. Called by scan pool workers."""
+		found_key = False
+		try:
+			fp = attempt_observation_for_service(service, self.ON_DEMAND_SCAN_TIMEOUT, self.use_sni)
+			if (fp != None):
+				self.ndb.report_observation(service, fp)
+				found_key = True
+			# else error already logged
+			# TODO: add internal blacklisting to remove sites that don't exist or stop working.
+		except (ValueError, SSLScanTimeoutException, SSLAlertException) as e:
+			self.ndb.report_metric('OnDemandServiceScanFailure', service + " " + str(e))
+			logging.error("Error scanning '{0}' - {1}".format(service, e))
+		except Exception as e:
+			self.ndb.report_metric('OnDemandServiceScanFailure', service + " " + str(e))
+			logging.exception(e)
+		finally:
+			if (self.negative_cache != None):
+				if (found_key):
+					self.negative_cache.discard(service)
+				else:
+					# start the expiry time from when the scan failed
+					self.negative_cache.add(service)
 
-		with scan_sites_lock:
-			if service in scan_sites:
-				del scan_sites[service]
-		scan_semaphore.release()
+			stats = self.scan_pool.get_stats()
+			self.ndb.report_metric('OnDemandScanStats', ("QueueDepth: {queue_depth} InProgress: {in_progress} " +
+				"AverageWaitTime: {avg_wait_time:.3f} MaxWaitTime: {max_wait_time:.3f} " +
+				"AverageScanTime: {avg_scan_time:.3f} MaxScanTime: {max_scan_time:.3f} " +
+				"Finished: {finished} Rejected: {rejected} Duplicates: {duplicates}").format(**stats))
 
 	@cherrypy.expose
 	def index(self, host=None, port=None, service_type=None, **invalid_params):
@@ -438,37 +593,6 @@ class NotaryHTTPServer(object):
 		return self.get_xml(host, port, service_type)
 
 
-class OnDemandScanThread(threading.Thread):
-
-	def __init__(self, sid, timeout_sec, use_sni, server_obj, db):
-		self.sid = sid
-		self.timeout_sec = timeout_sec
-		self.use_sni = use_sni
-		self.server_obj = server_obj
-		self.db = db
-		threading.Thread.__init__(self)
-
-	def __del__(self):
-		"""Clean up after scanning."""
-		del self.db
-
-	def run(self):
-
-		try:
-			fp = attempt_observation_for_service(self.sid, self.timeout_sec, self.use_sni)
-			if (fp != None):
-				self.db.report_observation(self.sid, fp)
-			# else error already logged
-			# TODO: add internal blacklisting to remove sites that don't exist or stop working.
-		except (ValueError, SSLScanTimeoutException, SSLAlertException) as e:
-			self.db.report_metric('OnDemandServiceScanFailure', self.sid + " " + str(e))
-			logging.error("Error scanning '{0}' - {1}".format(self.sid, e))
-		except Exception as e:
-			self.db.report_metric('OnDemandServiceScanFailure', self.sid + " " + str(e))
-			logging.exception(e)
-		finally:
-			self.server_obj.scan_finished(self.sid)
-
 def main():
 	"""Run the main program: start the NotaryHTTPServer."""
 	# create an instance here so command-line args will be automatically passed and parsed
@@ -533,7 +657,4 @@ def main():
 	cherrypy.engine.block()
 
 if __name__ == "__main__":
-	scan_semaphore = threading.BoundedSemaphore(PROBE_LIMIT)
-	scan_sites = {}
-	scan_sites_lock = threading.Lock()
 	main()
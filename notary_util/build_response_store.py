@@ -0,0 +1,110 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sign a reply for every service in the notary database and write them all to one response store file.
+
+Notaries started with 'notary_http.py --response-store FILE' answer requests from the file
+without a database or the private key, so read-only copies of a notary can run almost anywhere.
+Replies are signed with the observations in the database when the file is built,
+so build it again after every scan. The finished file replaces the old one,
+and running notaries switch to it automatically.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+from db2file import group_by_service
+from notary_db import ndb, SchemaError
+import notary_common
+import notary_reply
+from notary_response_store import ResponseStoreWriter
+
+# TODO: HACK
+# add ..\util to the import path so we can import keymanager
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from util import crypto
+from util.keymanager import keymanager
+
+
+PROGRESS_INTERVAL = 10 # seconds
+
+def get_parser():
+	"""Return an argument parser for this module."""
+	parser = argparse.ArgumentParser(parents=[keymanager.get_parser(), ndb.get_parser()],
+	description=__doc__)
+
+	parser.add_argument('output_file', metavar='FILE',
+				help="File to write the response store to.")
+	parser.add_argument('--history-days', type=int, default=0, metavar='DAYS',
+				help="Only include observations that ended within this many days in replies, "
+				"like 'notary_http.py --history-days'. 0 means include every observation. Default: %(default)s")
+	return parser
+
+def main(db, signer, public_key, output_file, history_days=0):
+	"""Run the main program. Return the number of services written."""
+	since = None
+	if (history_days > 0):
+		since = int(time.time()) - (history_days * 3600 * 24)
+
+	start_time = time.time()
+	last_progress = start_time
+	writer = ResponseStoreWriter(output_file, public_key)
+	skipped = 0
+
+	for (service, keys) in group_by_service(db.stream_observations(since=since)):
+		service_type = service.split(',')[-1]
+		if (service_type not in notary_common.SERVICE_TYPES):
+			skipped += 1
+			continue
+
+		# store the same thing notary_http.py would cache
+		entry = notary_reply.build_cache_entry(service, service_type, keys, signer)
+		if (entry == None):
+			entry = notary_reply.build_reply(service, service_type, keys, signer)
+		writer.add(service, entry)
+
+		if (time.time() - last_progress >= PROGRESS_INTERVAL):
+			last_progress = time.time()
+			print("Signed replies for {0} services ({1:.0f} per second)...".format(
+				writer.num_services, writer.num_services / (last_progress - start_time)))
+
+	print("Sorting the index...")
+	writer.close()
+	print("Wrote replies for {0} services to '{1}' in {2:.1f} seconds.".format(
+		writer.num_services, output_file, time.time() - start_time))
+	if (skipped > 0):
+		print("Skipped {0} services with an unknown service type.".format(skipped))
+	return writer.num_services
+
+if __name__ == "__main__":
+	args = get_parser().parse_args()
+	# pass ndb and keymanager the args so they can use any relevant ones from their own parsers
+	try:
+		db = ndb(args)
+	except SchemaError as e:
+		print(e, file=sys.stderr)
+		exit(1)
+	(public_key, private_key) = keymanager(args).get_keys()
+	if (public_key == None or private_key == None):
+		print("Could not get public and private keys.", file=sys.stderr)
+		exit(1)
+	main(db, crypto.Signer(private_key), public_key, args.output_file, args.history_days)
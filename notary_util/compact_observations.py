@@ -0,0 +1,102 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Merge observations of the same service and key whose timespans overlap or touch,
+so the database and every reply for those services get smaller.
+
+Years of scanning, and importing data with file2db, can leave several observations
+for one key that together cover a single unbroken timespan.
+Services are compacted a batch at a time, each batch in its own short transaction,
+so this can run while the notary is serving requests.
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+
+from notary_db import ndb, SchemaError
+from notary_reply import TIMESPAN, TIMESTAMP
+
+
+DEFAULT_BATCH_SIZE = 1000 # services
+DEFAULT_PAUSE = 0.1 # seconds
+PROGRESS_INTERVAL = 10 # seconds
+
+def get_parser():
+	"""Return an argument parser for this module."""
+	parser = argparse.ArgumentParser(parents=[ndb.get_parser()],
+	description=__doc__)
+
+	parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, metavar='SERVICES',
+				help="Compact this many services in each transaction. Default: %(default)s")
+	parser.add_argument('--pause', type=float, default=DEFAULT_PAUSE, metavar='SECONDS',
+				help="Wait this long between batches, to leave time for other database users. Default: %(default)s")
+	parser.add_argument('--max-gap', type=int, default=ndb.COMPACTION_MAX_GAP, metavar='SECONDS',
+				help="Merge timespans that are at most this many seconds apart. Default: %(default)s")
+	return parser
+
+def main(db, batch_size=DEFAULT_BATCH_SIZE, pause=DEFAULT_PAUSE, max_gap=ndb.COMPACTION_MAX_GAP):
+	"""Run the main program."""
+	if (batch_size < 1):
+		print("The batch size must be at least 1.", file=sys.stderr)
+		return
+
+	(low, high) = db.get_service_id_range()
+	if (low == None):
+		print("There are no services to compact.")
+		return
+
+	start_time = time.time()
+	last_progress = start_time
+	count_before = db.count_observations()
+	rows_removed = 0
+	xml_bytes = 0
+	skipped = 0
+
+	for batch_start in range(low, high + 1, batch_size):
+		removed = db.compact_observations(batch_start, batch_start + batch_size - 1, max_gap)
+		if (removed == None):
+			skipped += 1
+		else:
+			rows_removed += len(removed)
+			xml_bytes += sum([len(TIMESTAMP % (end, start)) for (start, end) in removed])
+
+		if (time.time() - last_progress >= PROGRESS_INTERVAL):
+			last_progress = time.time()
+			print("Compacted services up to ID {0} of {1}; {2} observations removed so far.".format(
+				min(batch_start + batch_size - 1, high), high, rows_removed))
+		if (pause > 0):
+			time.sleep(pause)
+
+	print("Removed {0} of {1} observations in {2:.1f} seconds.".format(rows_removed, count_before, time.time() - start_time))
+	print("Replies are {0} bytes smaller in total ({1} bytes of XML and {2} bytes of signed data).".format(
+		xml_bytes + (rows_removed * TIMESPAN.size), xml_bytes, rows_removed * TIMESPAN.size))
+	if (skipped > 0):
+		print("{0} batches were skipped because their observations changed while they were being compacted. Run again to compact them.".format(
+			skipped))
+
+if __name__ == "__main__":
+	args = get_parser().parse_args()
+	# pass ndb the args so it can use any relevant ones from its own parser
+	try:
+		db = ndb(args)
+	except SchemaError as e:
+		print(e, file=sys.stderr)
+		exit(1)
+	main(db, args.batch_size, args.pause, args.max_gap)
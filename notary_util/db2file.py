@@ -16,99 +16,202 @@
 
 """
 Export Observation data from a network notary database.
+
+Records are written as they are read from the database,
+so even very large databases can be exported without running out of memory.
+
+Use --binary to write a compact binary snapshot instead of text;
+see notary_snapshot.py for the format. file2db.py --binary reads it back.
+
+Use --since to export only the observations added or extended since an earlier export.
+file2db.py merges them into a copy of the database, so a second notary can be kept up to date
+without exporting and importing everything again.
 """
 
 from __future__ import print_function
 
+import sys
 import time
 import argparse
 
-from notary_db import ndb
+from notary_db import ndb, SchemaError
 import notary_common
+import notary_snapshot
 
 
 DEFAULT_OUTFILE = "-"
-
-
-def print_long_output(obs):
+OUTPUT_BUFFER_SIZE = 1024 * 1024 # bytes
+PROGRESS_INTERVAL = 10000 # services
+# observations can be written with a time from shortly before they are committed
+# (e.g. when a scan started), so suggest a --since that overlaps this export a little.
+# importing the same observations again is harmless.
+SINCE_OVERLAP = 60 * 60 # seconds
+
+
+def group_by_service(obs):
+	"""
+	Group (service, key, start, end) records that are sorted by service and key.
+	Yield (service, keys) for each service, where keys is a list of (key, timespans) tuples.
+	"""
+	service = None
+	keys = []
+	for (sid, key, start, end) in obs:
+		if (sid != service):
+			if (service != None):
+				yield (service, keys)
+			service = sid
+			keys = []
+		if (len(keys) == 0 or keys[-1][0] != key):
+			keys.append((key, []))
+		keys[-1][1].append((start, end))
+
+	if (service != None):
+		yield (service, keys)
+
+def print_long_output(output_file, sid, keys):
 	"""Print output in an expanded format, grouping keys for each service."""
+	s_type = sid.split(",")[-1]
 
-	old_sid = None
-	num_sids = 0
-
-	key_to_obs  = {}
-	for (service, key, start, end) in obs:
-		sid = service
-		if old_sid != sid:
-			num_sids += 1
-			if num_sids % 1000 == 0:
-				print("processed %s service-ids" % num_sids)
-			if old_sid is not None:
-				print_sid_info(old_sid, key_to_obs)
-			key_to_obs = {}
-			old_sid = sid
-
-		if key not in key_to_obs:
-			key_to_obs[key] = []
-		key_to_obs[key].append((start, end))
-
-		print_sid_info(sid, key_to_obs)
-
-def print_sid_info(sid, key_to_obs):
-	"""Print all of the keys for a single service."""
-	s_type = sid.split(",")[1]
-	
 	if (s_type not in notary_common.SERVICE_TYPES):
-		return	
-	
-	with open(output_file, 'a') as f:
-		print("", file=f)
-		print("Start Host: '%s'" % sid, file=f)
-		key_type_text = notary_common.SERVICE_TYPES[s_type]
-		for key in key_to_obs:
-			if key is None:
-				continue
-			print("%s key: %s" % (key_type_text, key), file=f)
-			for ts in key_to_obs[key]:
-				print("start:\t%s - %s" % (ts[0],time.ctime(ts[0])), file=f)
-				print("end:\t%s - %s" % (ts[1],time.ctime(ts[1])), file=f)
-			print("", file=f)
-		print("End Host", file=f)
-
-def print_tuples(obs):
-	"""Print output in a simple tuple format, one record per line. This makes it easy to import the data somewhere else."""
-
-	# note: lines starting with '#' should be ignored by the importer.
-
-	output = [] # use list appending for better performance than string concatenation
-	output.append("# Export of network notary Observations from %s" %args.dbname)
-	output.append("# %s\n" % time.ctime())
-
-	for (service, key, start, end) in obs:
-		output_file.write("({0}, {1}, {2}, {3})".format(service, key, start, end))
-
-
-parser = argparse.ArgumentParser(parents=[ndb.get_parser()], description=__doc__)
-parser.add_argument('output_file', type=argparse.FileType('w'), nargs='?', default=DEFAULT_OUTFILE,
-			help="File to write data to. Use '-' to write to stdout. Writing to stdout is the default.")
-formats = parser.add_mutually_exclusive_group()
-formats.add_argument('--tuples', '--tup', action='store_true',
-			help=print_tuples.__doc__ + " This is the default.")
-formats.add_argument('--long', action='store_true',
-			help=print_long_output.__doc__)
-
-
-args = parser.parse_args()
-
-# pass ndb the args so it can use any relevant ones from its own parser
-ndb = ndb(args)
-
-output_file = args.output_file
-with ndb.get_session() as session:
-	obs = ndb.get_all_observations(session)
-
-	if (args.long):
-		print_long_output(obs)
+		return
+
+	output_file.write("\nStart Host: '%s'\n" % sid)
+	key_type_text = notary_common.SERVICE_TYPES[s_type]
+	for (key, timespans) in keys:
+		if key is None:
+			continue
+		output_file.write("%s key: %s\n" % (key_type_text, key))
+		for (start, end) in timespans:
+			output_file.write("start:\t%s - %s\n" % (start, time.ctime(start)))
+			output_file.write("end:\t%s - %s\n" % (end, time.ctime(end)))
+		output_file.write("\n")
+	output_file.write("End Host\n")
+
+TUPLES_HELP = "Print output in a simple tuple format, one record per line. This makes it easy to import the data somewhere else."
+
+class TupleWriter(object):
+	"""
+	Write exported '(service, key, start, end)' lines to a file
+	and print progress every PROGRESS_INTERVAL services.
+
+	write() can be given any part of the output - several lines, or only part of one -
+	so services are only counted once their lines are complete.
+	"""
+
+	def __init__(self, output_file):
+		self.output_file = output_file
+		self.num_services = 0
+		self.service = None
+		self.partial = '' # the start of a line whose end we haven't been given yet
+
+	def write(self, data):
+		lines = (self.partial + data).split('\n')
+		# the last piece is '' if data ended with a newline
+		self.partial = lines.pop()
+		for line in lines:
+			self.write_line(line + '\n')
+
+	def write_line(self, line):
+		# service names never contain ', ', so everything before the first one is the service
+		end = line.find(', ')
+		if (end > 0):
+			sid = line[1:end]
+			if (sid != self.service):
+				if (self.service != None):
+					self.finish_service()
+				self.service = sid
+		self.output_file.write(line)
+
+	def finish_service(self):
+		self.num_services += 1
+		if (self.num_services % PROGRESS_INTERVAL == 0):
+			print_progress(self.output_file, self.num_services, self.service)
+
+	def close(self):
+		if (self.partial != ''):
+			self.write_line(self.partial)
+			self.partial = ''
+		if (self.service != None):
+			self.finish_service()
+			self.service = None
+
+def print_progress(output_file, num_services, sid):
+	"""Tell the user how far the export has got."""
+	# make sure everything we report as done has really been written
+	output_file.flush()
+	print("Exported {0} services, up to '{1}'.".format(num_services, sid), file=sys.stderr)
+
+def get_parser():
+	"""Return an argument parser for this module."""
+	parser = argparse.ArgumentParser(parents=[ndb.get_parser()], description=__doc__,
+	epilog="Progress is printed to stderr every {0} services (with --binary, after each block of about {1} observations), "
+		"along with the name of the last service written. "
+		"To resume an export that was interrupted, run it again with '--after-service' "
+		"and that name, writing to a new file.".format(PROGRESS_INTERVAL, notary_snapshot.DEFAULT_BLOCK_SIZE))
+
+	parser.add_argument('output_file', type=argparse.FileType('w', OUTPUT_BUFFER_SIZE), nargs='?', default=DEFAULT_OUTFILE,
+				help="File to write data to. Use '-' to write to stdout. Writing to stdout is the default.")
+	formats = parser.add_mutually_exclusive_group()
+	formats.add_argument('--tuples', '--tup', action='store_true',
+				help=TUPLES_HELP + " This is the default.")
+	formats.add_argument('--long', action='store_true',
+				help=print_long_output.__doc__)
+	formats.add_argument('--binary', action='store_true',
+				help="Write a compact binary snapshot, which is several times smaller than the tuple format "
+				"and faster to import. Use file2db.py --binary to import it.")
+	parser.add_argument('--after-service', metavar='SERVICE',
+				help="Only export services whose names sort after this one.")
+	parser.add_argument('--last-service', metavar='SERVICE',
+				help="Stop after exporting this service.")
+	parser.add_argument('--since', type=int, metavar='TIMESTAMP',
+				help="Only export observations added or extended at or after this unix time. "
+				"Each export prints the value to use for the next one.")
+	return parser
+
+def main(db, output_file=sys.stdout, long_output=False, after_service=None, last_service=None, binary=False,
+	since=None):
+	"""Run the main program. Return the number of services exported."""
+	start_time = int(time.time())
+	if (binary):
+		writer = notary_snapshot.SnapshotWriter(output_file)
+		for (sid, keys) in group_by_service(db.stream_observations(after_service, last_service, since)):
+			num_blocks = len(writer.index)
+			writer.write_service(sid, keys)
+			# services are only written a block at a time, so report progress when a block is done
+			if (len(writer.index) > num_blocks):
+				print_progress(output_file, writer.num_services, sid)
+		writer.close()
+		num_services = writer.num_services
+	elif (long_output):
+		num_services = 0
+		for (sid, keys) in group_by_service(db.stream_observations(after_service, last_service, since)):
+			print_long_output(output_file, sid, keys)
+			num_services += 1
+			if (num_services % PROGRESS_INTERVAL == 0):
+				print_progress(output_file, num_services, sid)
 	else:
-		print_tuples(obs)
-
+		# note: lines starting with '#' should be ignored by the importer.
+		output_file.write("# Export of network notary Observations from %s\n" % db.db.url.database)
+		output_file.write("# %s\n" % time.ctime())
+		if (since != None):
+			output_file.write("# Only observations added or extended since %s\n" % time.ctime(since))
+		output_file.write("\n")
+		writer = TupleWriter(output_file)
+		db.copy_observations_to(writer, after_service, last_service, since)
+		writer.close()
+		num_services = writer.num_services
+
+	output_file.flush()
+	print("Exported {0} services.".format(num_services), file=sys.stderr)
+	print("To export only what changes after this, use --since {0}".format(start_time - SINCE_OVERLAP), file=sys.stderr)
+	return num_services
+
+if __name__ == "__main__":
+	args = get_parser().parse_args()
+	# pass ndb the args so it can use any relevant ones from its own parser
+	try:
+		db = ndb(args)
+	except SchemaError as e:
+		print(e, file=sys.stderr)
+		exit(1)
+	main(db, args.output_file, args.long, args.after_service, args.last_service, args.binary, args.since)
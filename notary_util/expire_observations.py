@@ -0,0 +1,132 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Archive and delete observations that ended more than a number of days ago.
+
+Clients ignore old observations, but every reply still includes them and
+the database and its indexes keep growing.
+Observations are written to a compressed archive file before they are deleted,
+a small batch at a time with a pause between batches, so this can run while the notary is serving requests.
+
+The archive holds one (service, key, start, end) tuple per line:
+restore it with 'gunzip -c ARCHIVE | python notary_util/file2db.py'.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import os
+import sys
+import time
+
+from notary_db import ndb, SchemaError
+
+
+DEFAULT_DAYS = 365
+DEFAULT_BATCH_SIZE = 500 # observations
+DEFAULT_PAUSE = 0.1 # seconds
+PROGRESS_INTERVAL = 10 # seconds
+
+def get_parser():
+	"""Return an argument parser for this module."""
+	parser = argparse.ArgumentParser(parents=[ndb.get_parser()],
+	description=__doc__,
+	formatter_class=argparse.RawDescriptionHelpFormatter)
+
+	parser.add_argument('archive_file', nargs='?', default=None,
+				help="gzip file to add the deleted observations to. Required unless --no-archive is used.")
+	parser.add_argument('--no-archive', action='store_true', default=False,
+				help="Delete old observations without archiving them.")
+	parser.add_argument('--days', type=int, default=DEFAULT_DAYS,
+				help="Keep observations that ended within this many days. Default: %(default)s")
+	parser.add_argument('--metrics', action='store_true', default=False,
+				help="Also delete metrics older than --days. Metrics are not archived.")
+	parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, metavar='RECORDS',
+				help="Delete this many records in each transaction. Default: %(default)s")
+	parser.add_argument('--pause', type=float, default=DEFAULT_PAUSE, metavar='SECONDS',
+				help="Wait this long between batches, to leave time for other database users. Default: %(default)s")
+	return parser
+
+def expire_in_batches(name, expire_batch, pause):
+	"""Call expire_batch() until it deletes nothing. Return the total number of records deleted."""
+	total = 0
+	last_progress = time.time()
+	while True:
+		count = expire_batch()
+		if (count == 0):
+			return total
+		total += count
+
+		if (time.time() - last_progress >= PROGRESS_INTERVAL):
+			last_progress = time.time()
+			print("Deleted {0} {1} so far.".format(total, name))
+		if (pause > 0):
+			time.sleep(pause)
+
+def main(db, archive_file=None, days=DEFAULT_DAYS, metrics=False, batch_size=DEFAULT_BATCH_SIZE, pause=DEFAULT_PAUSE):
+	"""Run the main program. If archive_file is None observations are deleted without archiving them."""
+	# deleting observations the scanner might still extend would leave services with broken history
+	if (days * 3600 * 24 <= db.OBSERVATION_UPDATE_LIMIT):
+		print("--days must be more than {0} hours.".format(db.OBSERVATION_UPDATE_LIMIT / 3600), file=sys.stderr)
+		return
+	if (batch_size < 1):
+		print("The batch size must be at least 1.", file=sys.stderr)
+		return
+
+	start_time = time.time()
+	cutoff = int(start_time - (days * 3600 * 24))
+	archive = None
+	if (archive_file != None):
+		# gzip files can be appended to, so the same archive can be used for every run
+		archive = gzip.open(archive_file, 'ab')
+		archive.write("# Network notary Observations that ended before {0} - archived {1}\n".format(
+			time.ctime(cutoff), time.ctime(start_time)))
+
+	def archive_rows(rows):
+		for (service, key, start, end) in rows:
+			archive.write("({0}, {1}, {2}, {3})\n".format(service, key, start, end))
+		# make sure the records are safely on disk before they are deleted
+		archive.flush()
+		os.fsync(archive.fileno())
+
+	try:
+		expire_batch = lambda: db.expire_observations(cutoff, batch_size, archive_rows if (archive != None) else None)
+		count = expire_in_batches('observations', expire_batch, pause)
+		print("Deleted {0} observations that ended before {1}.".format(count, time.ctime(cutoff)))
+	finally:
+		if (archive != None):
+			archive.close()
+
+	if (metrics):
+		count = expire_in_batches('metrics', lambda: db.expire_metrics(cutoff, batch_size), pause)
+		print("Deleted {0} metrics recorded before {1}.".format(count, time.ctime(cutoff)))
+
+	print("Finished in {0:.1f} seconds.".format(time.time() - start_time))
+
+if __name__ == "__main__":
+	parser = get_parser()
+	args = parser.parse_args()
+	if (args.archive_file == None and not args.no_archive):
+		parser.error("Please give an archive file, or use --no-archive.")
+	# pass ndb the args so it can use any relevant ones from its own parser
+	try:
+		db = ndb(args)
+	except SchemaError as e:
+		print(e, file=sys.stderr)
+		exit(1)
+	main(db, args.archive_file, args.days, args.metrics, args.batch_size, args.pause)
@@ -25,106 +25,173 @@ Tuples look like:
 e.g.
   (domain.com:443,2, aa:bb:cc:dd:ee:ff, 123, 456)
 
-If you have a large number of records to insert (i.e. millions)
+With --binary the file is instead read as a binary snapshot written by db2file.py --binary.
+
+Records are merged with the observations already in the database:
+observations that are already there are skipped, and ones that now end later are extended.
+So the same file can safely be imported more than once, and the output of db2file.py --since
+can be imported to bring a copy of another notary's database up to date.
+
+The file is read and written to the database in batches,
+so even files with millions of records can be imported quickly.
+If you have a large number of records to insert
 you may want to run this *without* echoing database statements,
 both to improve speed and to avoid memory issues.
 """
 
 from __future__ import print_function
 
-import sys
-import os
 import re
+import sys
 import time
 import argparse
 
-from notary_db import ndb
+from notary_db import ndb, SchemaError
+import notary_snapshot
 
 DEFAULT_INFILE = "-"
+DEFAULT_BATCH_SIZE = 10000 # records
+INVALID_FILE = "invalid_lines.txt"
 
-def import_records(infile):
-	"""Read a file of tuples and extract service and observation data."""
+# tuples will be formatted like this:
+# (domain.com:443,2, aa:bb:cc:dd:ee:ff, 123, 456)
+#TODO: get correct regex for URLs
+VALID_TUPLE = re.compile("^ *\(([\w\-:,.]+), *([0-9a-fA-F:]+), *(\d+), *(\d+)\) *$")
 
-	print("Reading records from '{0}'.".format(infile.name))
-
-	lines = infile.readlines()
-	infile.close()
+# some lines may contain service-only tuples, like
+# (domain.com:443,2, None, None, None)
+SITE_TUPLE = re.compile("^ *\(([\w\-:,.]+), *\w+, *\w+, *\w+\) *$")
 
-	services = {}
-	observations = []
-	invalid_lines = []
-	invalid_file = "invalid_lines.txt"
-	num_lines = 0
-	num_invalid_lines = 0
+# snapshots don't have lines to check,
+# so check their services and keys against the same patterns the tuples use
+VALID_SERVICE = re.compile("^[\w\-:,.]+$")
+VALID_KEY = re.compile("^[0-9a-fA-F:]+$")
 
-	# tuples will be formatted like this:
-	# (domain.com:443,2, aa:bb:cc:dd:ee:ff, 123, 456)
-	#TODO: get correct regex for URLs
-	valid_tuple = re.compile("^ *\(([\w\-:,.]+), *([0-9a-fA-F:]+), *(\d+), *(\d+)\) *$")
 
-	# some lines may contain service-only tuples, like
-	# (domain.com:443,2, None, None, None)
-	site_tuple = re.compile("^ *\(([\w\-:,.]+), *\w+, *\w+, *\w+\) *$")
-
-	for line in lines:
+def read_tuples(infile, invalid):
+	"""
+	Yield (service, key, start, end) for each valid record in a file of tuples,
+	or (service, None, None, None) for a service without observations.
+	Write each invalid line to the file 'invalid' and yield None for it.
+	"""
+	for line in infile:
 
 		# remember: ALL INPUT IS EVIL!
 		# test each line before passing to the database.
-		if (valid_tuple.match(line)):
-			match = valid_tuple.match(line)
-			service = str(match.group(1))
-			key = str(match.group(2))
-			start = int(match.group(3))
-			end = int(match.group(4))
-
-			services[service] = True
-			observations.append((service, key, start, end))
+		match = VALID_TUPLE.match(line)
+		if (match and int(match.group(3)) <= int(match.group(4))):
+			yield (str(match.group(1)), str(match.group(2)), int(match.group(3)), int(match.group(4)))
 
-		elif (site_tuple.match(line)):
-			service = str(site_tuple.match(line).group(1))
-			services[service] = True
+		elif (SITE_TUPLE.match(line)):
+			yield (str(SITE_TUPLE.match(line).group(1)), None, None, None)
 
 		# ignore comments and blank lines
 		elif ((not line.startswith('#')) and (line not in ['\n', '\r\n'])):
-			invalid_lines.append(line)
-
-		num_lines += 1
-		if (num_lines) % 100000 == 0:
-			print("Finished reading {0} lines...".format(num_lines))
-
-	print("Found {0} invalid lines. Exporting to {1}.".format(
-		len(invalid_lines), invalid_file))
-	with open(invalid_file,'w') as outfile:
-		for line in invalid_lines:
-			print(line, file=outfile)
-
-	service_count = len(services)
-	if (service_count > 0):
-		print("Found {0} services. Adding to database.".format(service_count))
-		ndb.insert_bulk_services(services.keys())
-	else:
-		print("No services found.")
-
-	if not args.services_only:
-		print("Found %s observations. Adding to database." % len(observations))
-		#TODO: need to get the service_ids after services are inserted
-		for (service, key, start, end) in observations:
-			# NOTE! this is a special case use of _insert_observation() -
-			# we only call this because database records are assumed to be valid already,
-			# but won't necessarily be inserted in chronological order.
-			# you should use report_observation() during normal use.
-			ndb._insert_observation(service, key, start, end)
-
-
-parser = argparse.ArgumentParser(parents=[ndb.get_parser()], description=__doc__,
-	formatter_class=argparse.RawDescriptionHelpFormatter)
-parser.add_argument('input_file', type=argparse.FileType('r'), nargs='?', default=DEFAULT_INFILE,
-			help="File to read from. Use '-' to read from stdin (which is the default).")
-parser.add_argument('--services-only', '-s', action='store_true', default=False,
-			help="Only import services, not observations.")
-
-args = parser.parse_args()
-# pass ndb the args so it can use any relevant ones from its own parser
-ndb = ndb(args)
-import_records(args.input_file)
+			invalid.write(line)
+			yield None
+
+def read_snapshot(infile, invalid):
+	"""The same as read_tuples(), for a binary snapshot written by db2file.py --binary."""
+	reader = notary_snapshot.SnapshotReader(infile)
+	index = reader.get_index()
+	if (index != None):
+		print("Snapshot has {0} services and {1} observations.".format(
+			sum([entry[1] for entry in index]), sum([entry[2] for entry in index])))
+
+	for (service, keys) in reader.read_services():
+		valid_service = VALID_SERVICE.match(service)
+		if (len(keys) == 0):
+			if (valid_service):
+				yield (service, None, None, None)
+			else:
+				invalid.write("(%s, None, None, None)\n" % service)
+				yield None
+
+		for (key, timespans) in keys:
+			valid = valid_service and VALID_KEY.match(key)
+			for (start, end) in timespans:
+				if (valid):
+					yield (service, key, start, end)
+				else:
+					# write invalid records as tuples, so they can be fixed and imported like any others
+					invalid.write("(%s, %s, %s, %s)\n" % (service, key, start, end))
+					yield None
+
+def import_records(db, infile, services_only=False, batch_size=DEFAULT_BATCH_SIZE, invalid_file=INVALID_FILE,
+	binary=False):
+	"""
+	Read a file of tuples, or a binary snapshot if binary is True,
+	and add the service and observation data to the database.
+	Return the number of observations read.
+	"""
+
+	print("Reading records from '{0}'.".format(infile.name))
+
+	services = set()
+	observations = []
+	num_records = 0
+	num_invalid_records = 0
+	num_observations = 0
+	start_time = time.time()
+
+	def write_batch():
+		if (services_only):
+			db.insert_bulk_observations([], services)
+		else:
+			db.insert_bulk_observations(observations, services)
+		services.clear()
+		del observations[:]
+
+		elapsed = max(time.time() - start_time, 0.001)
+		print("Read {0} records and {1} observations ({2:.0f} observations per second)...".format(
+			num_records, num_observations, num_observations / elapsed))
+
+	read_records = read_snapshot if binary else read_tuples
+	with open(invalid_file, 'w') as outfile:
+		for record in read_records(infile, outfile):
+			num_records += 1
+			if (record == None):
+				num_invalid_records += 1
+			elif (record[1] == None):
+				services.add(record[0])
+			elif (services_only):
+				services.add(record[0])
+				num_observations += 1
+			else:
+				observations.append(record)
+				num_observations += 1
+
+			if (len(observations) + len(services) >= batch_size):
+				write_batch()
+
+		if (len(observations) + len(services) > 0):
+			write_batch()
+	infile.close()
 
+	print("Finished in {0:.1f} seconds.".format(time.time() - start_time))
+	print("Found {0} invalid records. Exported them to {1}.".format(num_invalid_records, invalid_file))
+	return num_observations
+
+def get_parser():
+	"""Return an argument parser for this module."""
+	parser = argparse.ArgumentParser(parents=[ndb.get_parser()], description=__doc__,
+		formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('input_file', type=argparse.FileType('r'), nargs='?', default=DEFAULT_INFILE,
+				help="File to read from. Use '-' to read from stdin (which is the default).")
+	parser.add_argument('--services-only', '-s', action='store_true', default=False,
+				help="Only import services, not observations.")
+	parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, metavar='RECORDS',
+				help="Add this many records to the database in each transaction. Default: %(default)s")
+	parser.add_argument('--binary', action='store_true', default=False,
+				help="Read a binary snapshot written by db2file.py --binary instead of tuples.")
+	return parser
+
+if __name__ == "__main__":
+	args = get_parser().parse_args()
+	# pass ndb the args so it can use any relevant ones from its own parser
+	try:
+		db = ndb(args)
+	except SchemaError as e:
+		print(e, file=sys.stderr)
+		exit(1)
+	import_records(db, args.input_file, args.services_only, args.batch_size, binary=args.binary)
@@ -26,7 +26,7 @@ import sys
 import time
 import argparse
 
-from notary_db import ndb
+from notary_db import ndb, SchemaError
 
 
 DAYS_META_NAME = 'Days'
@@ -84,5 +84,9 @@ def main(db, output_file=DEFAULT_OUTFILE, list_all=True, list_newer=False, list_
 if __name__ == "__main__":
 	args = get_parser().parse_args()
 	# pass ndb the args so it can use any relevant ones from its own parser
-	db = ndb(args)
+	try:
+		db = ndb(args)
+	except SchemaError as e:
+		print(e, file=sys.stderr)
+		exit(1)
 	main(db, args.output_file, args.all, args.newer, args.older)
@@ -24,6 +24,7 @@ and keeps things modular for easier refactoring.
 from __future__ import print_function
 
 import argparse
+import collections
 from contextlib import contextmanager
 import logging
 import os
@@ -31,16 +32,19 @@ import re
 import threading
 import time
 import ConfigParser
+from cStringIO import StringIO
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.engine import create_engine
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.event import listen
 from sqlalchemy.orm import sessionmaker, scoped_session, relationship, backref, validates
-from sqlalchemy.pool import Pool
-from sqlalchemy.exc import IntegrityError, ProgrammingError, OperationalError, ResourceClosedError
+from sqlalchemy.pool import Pool, QueuePool
+from sqlalchemy.exc import IntegrityError, ProgrammingError, OperationalError, ResourceClosedError,\
+	DisconnectionError, TimeoutError, DBAPIError
 from sqlalchemy.schema import CheckConstraint, UniqueConstraint
-from sqlalchemy.sql import select, and_, func
-from sqlalchemy import Column, Integer, String, Index, ForeignKey
+from sqlalchemy.sql import select, and_, or_, bindparam, func, literal, cast
+from sqlalchemy import Column, Integer, String, Index, ForeignKey, inspect
 
 
 # class to base ORM classes on
@@ -57,6 +61,13 @@ class Services(ORMBase):
 	service_id = Column(Integer, nullable=False, primary_key=True)
 	name = Column(String, nullable=False, unique=True)
 
+	# copies of the service's most recent observation, kept up to date whenever observations are written,
+	# so we don't have to search the service's whole history to find them.
+	# NULL until the service has an observation.
+	last_seen = Column(Integer)	#unix timestamp - the 'end' of the most recent observation.
+	current_key = Column(String)	#the key of the most recent observation.
+	current_observation_id = Column(Integer)	#no foreign key, so the two tables don't depend on each other.
+
 class Observations(ORMBase):
 	"""
 	The time ranges observed for each key used by a service.
@@ -110,6 +121,7 @@ class Observations(ORMBase):
 
 # create indexes to speed up queries
 Index('ix_services_name', Services.name)
+Index('ix_services_last_seen', Services.last_seen)
 Index('ix_observations_end', Observations.end)
 Index('ix_observations_service_id_key_end', Observations.service_id, Observations.key, Observations.end)
 
@@ -139,9 +151,12 @@ class Metrics(ORMBase):
 # analysis can be done later on a copy of the data so it doesn't slow down the actual notary machine.
 
 
-def ratelimited(max_per_second=1):
+def ratelimited(max_per_second=1, key=None):
 	"""
 	Decorate a function, only allowing it to be called every so often.
+
+	If 'key' is given it is called with the same arguments as the function,
+	and calls are limited separately for each value it returns.
 	"""
 	# we could make this available to other modules if it would be useful.
 
@@ -149,19 +164,27 @@ def ratelimited(max_per_second=1):
 	warn_every = 10 # seconds
 
 	def decorate(func):
-		last_called = [0.0]
+		last_called = {}
 		last_warned = [0.0]
 		num_skips = [0]
+		lock = threading.Lock()
 
 		def rate_limited_function(*args, **kargs):
-			curtime = time.clock()
-			elapsed = curtime - last_called[0]
-			left_to_wait = min_interval - elapsed
+			limit = None
+			if (key != None):
+				limit = key(*args, **kargs)
+			# use the wall clock - time.clock() is processor time on unix
+			curtime = time.time()
+			with lock:
+				call = (curtime - last_called.get(limit, 0.0) >= min_interval)
+				if (call):
+					last_called[limit] = curtime
+				else:
+					num_skips[0] += 1
 
-			if left_to_wait <= 0:
+			if (call):
 				# return the actual function so it can be called
 				ret = func(*args, **kargs)
-				last_called[0] = curtime
 
 				# we want to note in the logs that some calls were skipped,
 				# while not printing the log too often -
@@ -173,12 +196,128 @@ def ratelimited(max_per_second=1):
 			else:
 				# ignore the function call and continue
 				ret = lambda: True
-				num_skips[0] += 1
 			return ret
 		return rate_limited_function
 	return decorate
 
 
+class ServiceIdCache(object):
+	"""
+	Remember the service_id for recently used service names,
+	so queries can use t_observations directly instead of joining t_services by name.
+
+	Service names never change once they are created, so entries never expire;
+	when the cache is full the least recently used entry is discarded.
+	"""
+
+	def __init__(self, max_entries):
+		"""Create a cache of up to max_entries service names. If max_entries is 0 nothing is cached."""
+		if (max_entries < 0):
+			raise ValueError("ServiceIdCache size cannot be negative.")
+		self.max_entries = max_entries
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		with self.lock:
+			return len(self.entries)
+
+	def get(self, service):
+		"""Return the service_id for a service name, or None if it isn't cached."""
+		with self.lock:
+			service_id = self.entries.pop(service, None)
+			if (service_id == None):
+				self.misses += 1
+				return None
+			# move to the end so it is discarded last
+			self.entries[service] = service_id
+			self.hits += 1
+			return service_id
+
+	def add(self, service, service_id):
+		"""Remember the service_id for a service name."""
+		if (self.max_entries == 0):
+			return
+		with self.lock:
+			self.entries.pop(service, None)
+			self.entries[service] = service_id
+			while (len(self.entries) > self.max_entries):
+				self.entries.popitem(last=False)
+
+	def get_stats(self):
+		"""Return a dictionary with the number of entries, hits, and misses."""
+		with self.lock:
+			return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class TimedQueuePool(QueuePool):
+	"""
+	A connection pool that records how long callers wait to get a connection,
+	and how often they give up because the pool stayed empty for too long.
+	"""
+
+	def __init__(self, *args, **kw):
+		QueuePool.__init__(self, *args, **kw)
+		self.stats_lock = threading.Lock()
+		self.checkouts = 0
+		self.total_wait = 0.0
+		self.max_wait = 0.0
+		self.timeouts = 0
+
+	def connect(self):
+		return self._timed(QueuePool.connect)
+
+	def unique_connection(self):
+		# engines check connections out with this rather than connect()
+		return self._timed(QueuePool.unique_connection)
+
+	def _timed(self, checkout):
+		"""Check out a connection with checkout(self), recording how long it took."""
+		start = time.time()
+		try:
+			return checkout(self)
+		except TimeoutError:
+			with self.stats_lock:
+				self.timeouts += 1
+			raise
+		finally:
+			wait = time.time() - start
+			with self.stats_lock:
+				self.checkouts += 1
+				self.total_wait += wait
+				self.max_wait = max(self.max_wait, wait)
+
+	def get_stats(self):
+		"""Return a dictionary with the number of checkouts and timeouts and the average and maximum wait in seconds."""
+		with self.stats_lock:
+			avg_wait = 0.0
+			if (self.checkouts > 0):
+				avg_wait = self.total_wait / self.checkouts
+			return {'checkouts': self.checkouts, 'timeouts': self.timeouts,
+				'avg_wait': avg_wait, 'max_wait': self.max_wait}
+
+
+def _chunks(items, size):
+	"""Split a list into lists of at most 'size' items."""
+	items = list(items)
+	return [items[i:i + size] for i in range(0, len(items), size)]
+
+def _copy_value(column, value):
+	"""Format a value for postgresql's COPY text format."""
+	if (value == None):
+		return '\\N'
+	if (isinstance(value, unicode)):
+		value = value.encode('utf-8')
+	return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class SchemaError(Exception):
+	"""The database was created by an older version of the notary and must be upgraded before it can be used."""
+	pass
+
+
 class ndb(object):
 	"""
 	Notary database interface - create and interact with database tables.
@@ -207,6 +346,24 @@ class ndb(object):
 	DB_URL_FIELD = 'DATABASE_URL'
 	DB_PASSWORD_FIELD = 'NOTARY_DB_PASSWORD'
 	DEFAULT_ECHO = 0
+	DEFAULT_SERVICE_ID_CACHE_SIZE = 100000 # entries
+
+	# connection pool settings. these only apply to databases that run as a server (e.g. postgresql);
+	# sqlite databases are opened directly and don't use a pool.
+	# the same defaults as SQLAlchemy, except recycle, where 0 means never.
+	DEFAULT_POOL_SIZE = 5 # connections kept open
+	DEFAULT_MAX_OVERFLOW = 10 # extra connections opened when all of the pool is in use
+	DEFAULT_POOL_TIMEOUT = 30 # seconds to wait for a free connection
+	DEFAULT_POOL_RECYCLE = 0 # seconds before a connection is replaced
+	DEFAULT_STATEMENT_TIMEOUT = 0 # milliseconds. postgresql only
+
+	# collations that compare strings byte by byte, the same way python compares them.
+	# used where rows must come back in the order python sorts them, whatever collation the database uses.
+	BYTE_ORDER_COLLATIONS = {'sqlite': 'BINARY', 'postgresql': '"C"'}
+
+	# sqlite performance settings - see --sqlite-wal
+	DEFAULT_SQLITE_CACHE_SIZE = 64 # MB per connection
+	DEFAULT_SQLITE_MMAP_SIZE = 256 # MB
 
 	# store config in this directory,
 	# so all modules that use the database can use it
@@ -216,7 +373,9 @@ class ndb(object):
 
 	EVENT_TYPE_NAMES = ['GetObservationsForService', 'ScanForNewService', 'ProbeLimitExceeded',
 		'ServiceScanStart', 'ServiceScanStop', 'ServiceScanFailure', 'CacheHit', 'CacheMiss',
-		'OnDemandServiceScanFailure', 'EventTypeUnknown']
+		'OnDemandServiceScanFailure', 'ResponseSigned', 'RequestCoalesced',
+		'NegativeCacheHit', 'OnDemandScanStats',
+		'ScanWaitTimeout', 'DatabasePoolStats', 'EventTypeUnknown']
 	EVENT_TYPES = {}
 	METRIC_PREFIX = "NOTARY_METRIC"
 
@@ -232,14 +391,28 @@ class ndb(object):
 	# (e.g. the scan may start every 24 hours but sites may be updated in a random order)
 	OBSERVATION_UPDATE_LIMIT = 60 * 60 * 48 # 2 days
 
+	# observations of the same key whose timespans are this many seconds apart or less
+	# show no real gap, and can be merged into one observation.
+	COMPACTION_MAX_GAP = 1 # seconds
+
+	# the most values to put in a single 'IN' clause.
+	# SQLite allows at most 999 parameters per query by default.
+	BULK_QUERY_SIZE = 500
+
+	# how many rows to fetch from the database at a time when reading every observation.
+	STREAM_BATCH_SIZE = 10000
+
 	_conn_count_lock = threading.Lock()
 	_open_connections = 0
 
-	def __init__(self, args):
+	def __init__(self, args, check_schema=True):
 		"""
 		Initialize a new ndb object.
 
 		Some extra work is done here to make it easier for callers to import this module.
+
+		Raise SchemaError if the database needs to be upgraded,
+		unless check_schema is False (only upgrade_db.py should need that).
 		"""
 
 		# sanity/safety check:
@@ -255,6 +428,9 @@ class ndb(object):
 
 		self.__actual_init(**good_args)
 
+		if (check_schema):
+			self.__check_schema()
+
 	# note: keep these arg names the same as the argparser args - see __filter_args()
 	# we supply default values so everything can be passed as a named argument.
 	def __actual_init(self, dburl=False,
@@ -264,7 +440,12 @@ class ndb(object):
 						dbtype=DEFAULT_DB_TYPE,
 						dbecho=DEFAULT_ECHO,
 						write_config_file=False, read_config_file=False,
-						metricsdb=False, metricslog=False):
+						metricsdb=False, metricslog=False,
+						service_id_cache_size=DEFAULT_SERVICE_ID_CACHE_SIZE, preload_service_ids=False,
+						db_pool_size=DEFAULT_POOL_SIZE, db_max_overflow=DEFAULT_MAX_OVERFLOW,
+						db_pool_timeout=DEFAULT_POOL_TIMEOUT, db_pool_recycle=DEFAULT_POOL_RECYCLE,
+						db_pre_ping=False, db_statement_timeout=DEFAULT_STATEMENT_TIMEOUT,
+						sqlite_wal=False, sqlite_cache_size=DEFAULT_SQLITE_CACHE_SIZE, sqlite_mmap_size=DEFAULT_SQLITE_MMAP_SIZE):
 		"""
 		Initialize a new ndb object.
 
@@ -274,8 +455,12 @@ class ndb(object):
 
 		connstr = ''
 		self._Session = None
+		self._WriteSession = None
+		self.sqlite_cache_size = sqlite_cache_size
+		self.sqlite_mmap_size = sqlite_mmap_size
 		self.metricsdb = metricsdb
 		self.metricslog = metricslog
+		self.service_ids = ServiceIdCache(service_id_cache_size)
 
 		if (dbecho):
 			dbecho = True
@@ -316,9 +501,47 @@ class ndb(object):
 			raise Exception(errmsg)
 
 		# set up sqlalchemy objects
-		self.db = create_engine(connstr, echo=dbecho)
+		url = make_url(connstr)
+		pool_args = {'poolclass': TimedQueuePool, 'pool_size': db_pool_size,
+			'max_overflow': db_max_overflow, 'pool_timeout': db_pool_timeout,
+			'pool_recycle': db_pool_recycle or -1}
+		engine_args = {'echo': dbecho}
+		is_sqlite = url.drivername.startswith('sqlite')
+		# the settings only make sense for database files; in-memory databases can't be shared between connections
+		use_sqlite_wal = (sqlite_wal and is_sqlite and url.database not in (None, '', ':memory:'))
+		if not (is_sqlite):
+			engine_args.update(pool_args)
+		elif (use_sqlite_wal):
+			# keep sqlite connections open in a pool too,
+			# so each one keeps its page cache and memory map between uses.
+			engine_args.update(pool_args)
+			engine_args['connect_args'] = {'check_same_thread': False}
+		if (url.drivername.startswith('postgresql') and db_statement_timeout > 0):
+			engine_args['connect_args'] = {'options': '-c statement_timeout={0}'.format(db_statement_timeout)}
+		self.db = create_engine(connstr, **engine_args)
+
+		if (db_pre_ping):
+			listen(self.db, 'checkout', self._ping_connection)
+
+		# methods that change the database use write_db, so we can give writes their own connection
+		self.write_db = self.db
+		if (use_sqlite_wal):
+			listen(self.db, 'connect', self._on_sqlite_connect)
+
+			# sqlite only allows one writer at a time.
+			# send every write from this process through a single connection,
+			# so threads take turns instead of failing with 'database is locked'.
+			# the connection waits for writers in other processes (e.g. the scanner) for up to db_pool_timeout seconds.
+			self.write_db = create_engine(connstr, echo=dbecho, poolclass=TimedQueuePool,
+				pool_size=1, max_overflow=0, pool_timeout=db_pool_timeout,
+				connect_args={'check_same_thread': False, 'timeout': db_pool_timeout})
+			listen(self.write_db, 'connect', self._on_sqlite_writer_connect)
+			listen(self.write_db, 'begin', self._begin_sqlite_write)
 
 		self._Session = scoped_session(sessionmaker(bind=self.db))
+		self._WriteSession = self._Session
+		if (self.write_db != self.db):
+			self._WriteSession = scoped_session(sessionmaker(bind=self.write_db))
 
 		# in most cases we expect callers to handle any exceptions that get thrown here.
 		# we still want to make sure the error is logged, however.
@@ -339,6 +562,9 @@ class ndb(object):
 		# cache data used when logging metrics
 		self.__init_event_types()
 
+		if (preload_service_ids):
+			self.load_service_ids()
+
 		if (write_config_file):
 			self._write_db_config(locals())
 
@@ -350,7 +576,7 @@ class ndb(object):
 		# saves us from having to look up the ID every time we insert a metric record.
 
 		if self.is_metrics_enabled():
-			with self.get_session() as session:
+			with self._get_write_session() as session:
 				for name in self.EVENT_TYPE_NAMES:
 					try:
 						evt = session.query(EventTypes).filter(EventTypes.name == name).first()
@@ -370,6 +596,16 @@ class ndb(object):
 							logging.error("Cannot log performance metrics to a database without event types - metrics will be disabled.")
 							break
 
+	def __check_schema(self):
+		"""Raise SchemaError if the database was created by an older version and needs to be upgraded."""
+		# create_all() only creates tables that don't exist yet -
+		# it doesn't add new columns to existing tables.
+		# queries use the new columns everywhere, so nothing would work until they are added.
+		missing = self._get_missing_columns()
+		if (len(missing) > 0):
+			raise SchemaError("The notary database is missing the column(s) {0} - it was created by an older version of the notary. Please run 'python notary_util/upgrade_db.py' with the same database arguments to upgrade it. See doc/upgrades/ for details.".format(
+				", ".join(["{0}.{1}".format(table.name, column.name) for (table, column) in missing])))
+
 	def __del__(self):
 		"""Clean up any remaining database connections."""
 
@@ -377,6 +613,13 @@ class ndb(object):
 			logging.error("{0} database connections remain open! This may indicate a programming error - please use 'with ndb.get_session:' to manage your session scope.".format(
 				self.get_connection_count()))
 
+		if ((hasattr(self, '_WriteSession')) and (self._WriteSession not in (None, self._Session))):
+			try:
+				self._WriteSession.remove()
+				del self._WriteSession
+			except Exception as e:
+				logging.error("Error closing database sessions in destructor: '%s'" % (e))
+
 		if ((hasattr(self, '_Session')) and (self._Session != None)):
 			try:
 				self._Session.close_all()
@@ -385,6 +628,11 @@ class ndb(object):
 			except Exception as e:
 				logging.error("Error closing database sessions in destructor: '%s'" % (e))
 
+		if (hasattr(self, 'write_db')):
+			if (self.write_db != self.db):
+				self.write_db.dispose()
+			del self.write_db
+
 		if (hasattr(self, 'db')):
 			self.db.dispose()
 			del self.db
@@ -444,6 +692,38 @@ class ndb(object):
 			help="Track information about various notary events, and print info to stdout with the prefix '" + self.METRIC_PREFIX + "'. \
 			 See docs/metrics.txt for a detailed explanation. Default: \'%(default)s\'")
 
+		dbgroup.add_argument('--service-id-cache-size', default=self.DEFAULT_SERVICE_ID_CACHE_SIZE, type=int, metavar='ENTRIES',
+			help='Remember the IDs of this many recently used services, to save looking them up in the database. 0 disables the cache. Default: %(default)s')
+		dbgroup.add_argument('--preload-service-ids', action='store_true', default=False,
+			help='Fill the service ID cache from the database on startup rather than as services are used. Default: \'%(default)s\'')
+
+		poolgroup = parser.add_argument_group('database connection pool arguments',
+			'These only apply to databases that run as a server, such as postgresql.')
+		poolgroup.add_argument('--db-pool-size', default=self.DEFAULT_POOL_SIZE, type=int, metavar='CONNECTIONS',
+			help='Number of database connections to keep open. Default: %(default)s')
+		poolgroup.add_argument('--db-max-overflow', default=self.DEFAULT_MAX_OVERFLOW, type=int, metavar='CONNECTIONS',
+			help='Number of extra connections that can be opened when every pooled connection is in use. Default: %(default)s')
+		poolgroup.add_argument('--db-pool-timeout', default=self.DEFAULT_POOL_TIMEOUT, type=int, metavar='SECONDS',
+			help='Give up waiting for a free connection after this many seconds. Default: %(default)s')
+		poolgroup.add_argument('--db-pool-recycle', default=self.DEFAULT_POOL_RECYCLE, type=int, metavar='SECONDS',
+			help='Replace connections after they have been open this many seconds, e.g. if the database closes idle connections. 0 means never. Default: %(default)s')
+		poolgroup.add_argument('--db-pre-ping', action='store_true', default=False,
+			help='Test each connection before using it, and replace it if the database has closed it. Default: \'%(default)s\'')
+		poolgroup.add_argument('--db-statement-timeout', default=self.DEFAULT_STATEMENT_TIMEOUT, type=int, metavar='MILLISECONDS',
+			help='Cancel queries that take longer than this. Only supported by postgresql. 0 means no limit. Default: %(default)s')
+
+		sqlitegroup = parser.add_argument_group('sqlite arguments')
+		sqlitegroup.add_argument('--sqlite-wal', action='store_true', default=False,
+			help="Tune sqlite databases for a notary and scanner running at the same time: \
+			use a write-ahead log so reads and writes don't block each other, \
+			keep connections open in a pool (see the connection pool arguments), \
+			and send all writes from each process through a single connection. \
+			The database file must not be on a network drive. Default: \'%(default)s\'")
+		sqlitegroup.add_argument('--sqlite-cache-size', default=self.DEFAULT_SQLITE_CACHE_SIZE, type=int, metavar='MB',
+			help='With --sqlite-wal, the page cache size for each connection. Default: %(default)s')
+		sqlitegroup.add_argument('--sqlite-mmap-size', default=self.DEFAULT_SQLITE_MMAP_SIZE, type=int, metavar='MB',
+			help='With --sqlite-wal, read up to this much of the database through a memory map. 0 turns this off. Default: %(default)s')
+
 		return parser
 
 	@classmethod
@@ -566,6 +846,21 @@ class ndb(object):
 
 		return good_args
 
+	@contextmanager
+	def _get_write_session(self):
+		"""
+		Open a session for changing the database. Used the same way as get_session().
+		With --sqlite-wal, these sessions share a single connection, one thread at a time.
+		"""
+		session = self._WriteSession()
+		try:
+			yield session
+		except:
+			session.rollback()
+			raise
+		finally:
+			session.close()
+
 	@contextmanager
 	def get_session(self):
 		"""
@@ -600,6 +895,35 @@ class ndb(object):
 			session.close()
 
 
+	def _on_sqlite_connect(self, dbapi_connection, connection_record):
+		"""Apply the --sqlite-wal settings to a new sqlite connection."""
+		cursor = dbapi_connection.cursor()
+		# write-ahead logging is stored in the database file, so this only does anything the first time
+		cursor.execute("PRAGMA journal_mode=WAL")
+		# with a write-ahead log this is still safe from corruption;
+		# a power failure may only lose the last few commits
+		cursor.execute("PRAGMA synchronous=NORMAL")
+		# negative sizes are in KB
+		cursor.execute("PRAGMA cache_size=-{0}".format(self.sqlite_cache_size * 1024))
+		cursor.execute("PRAGMA mmap_size={0}".format(self.sqlite_mmap_size * 1024 * 1024))
+		cursor.close()
+
+	def _on_sqlite_writer_connect(self, dbapi_connection, connection_record):
+		"""Set up the connection used for all sqlite writes."""
+		self._on_sqlite_connect(dbapi_connection, connection_record)
+		# stop pysqlite from starting transactions itself; _begin_sqlite_write() does it instead
+		dbapi_connection.isolation_level = None
+
+	def _begin_sqlite_write(self, conn):
+		"""
+		Start a transaction on the sqlite write connection.
+
+		Take the write lock straight away, waiting for other processes if necessary.
+		A transaction that reads first and then tries to write
+		can fail with 'database is locked' without waiting, if another process wrote in between.
+		"""
+		conn.execute("BEGIN IMMEDIATE")
+
 	def _on_connection_checkout(self, dbapi_connection, connection_record, connection_proxy):
 		"""Count when a connection is checked out of the connection pool."""
 		with self._conn_count_lock:
@@ -614,6 +938,40 @@ class ndb(object):
 		"""Return the count of open database connections."""
 		return self._open_connections
 
+	def get_pool_stats(self):
+		"""
+		Return a dictionary with the number of open connections,
+		and the number of checkouts, timeouts, and the average and maximum seconds waited for a pooled connection.
+		"""
+		stats = {'checkouts': 0, 'timeouts': 0, 'avg_wait': 0.0, 'max_wait': 0.0}
+		if (isinstance(self.db.pool, TimedQueuePool)):
+			stats = self.db.pool.get_stats()
+		stats['open'] = self.get_connection_count()
+		return stats
+
+	def _ping_connection(self, dbapi_connection, connection_record, connection_proxy):
+		"""Make sure a connection still works before it is checked out of the pool."""
+		try:
+			cursor = dbapi_connection.cursor()
+			cursor.execute("SELECT 1")
+			cursor.close()
+		except Exception as e:
+			# the pool will throw this connection away and try again with a new one
+			logging.warning("Database connection failed ping; reconnecting: '{0}'".format(e))
+			raise DisconnectionError()
+
+	@contextmanager
+	def _get_write_connection(self):
+		"""
+		Open a raw connection for changing the database. Used the same way as _get_connection().
+		With --sqlite-wal, these connections share a single connection, one thread at a time.
+		"""
+		conn = self.write_db.connect()
+		try:
+			yield conn
+		finally:
+			conn.close()
+
 	@contextmanager
 	def _get_connection(self):
 		"""
@@ -631,6 +989,242 @@ class ndb(object):
 
 	# actual data methods follow
 
+	def _get_missing_columns(self):
+		"""Return a list of (table, column) for columns in our schema that don't exist in the database."""
+		missing = []
+		inspector = inspect(self.db)
+		for table in ORMBase.metadata.sorted_tables:
+			existing = [column['name'] for column in inspector.get_columns(table.name)]
+			missing.extend([(table, column) for column in table.columns if column.name not in existing])
+		return missing
+
+	def upgrade_schema(self):
+		"""
+		Add any columns and indexes that are missing because the database was created by an older version.
+		Return a list of the names of the columns that were added.
+		"""
+		added = []
+		with self._get_write_connection() as conn:
+			with conn.begin():
+				for (table, column) in self._get_missing_columns():
+					if not (column.nullable):
+						raise ValueError("Column '{0}.{1}' cannot be added to an existing table.".format(table.name, column.name))
+					conn.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+						table.name, column.name, column.type.compile(dialect=self.db.dialect)))
+					added.append("{0}.{1}".format(table.name, column.name))
+
+		inspector = inspect(self.db)
+		for table in ORMBase.metadata.sorted_tables:
+			existing = [index['name'] for index in inspector.get_indexes(table.name)]
+			for index in table.indexes:
+				if (index.name not in existing):
+					index.create(self.write_db)
+		return added
+
+	def backfill_service_state(self, batch_size=10000):
+		"""
+		Fill in the last_seen, current_key, and current_observation_id of every service
+		from its most recent observation.
+
+		Observation writes keep these up to date, so this is only needed to upgrade databases
+		created by older versions or changed by other programs.
+		Services are updated batch_size at a time, each in its own transaction,
+		so a large database isn't locked for the whole run.
+		Return the number of services with an observation.
+		"""
+		services = Services.__table__
+		with self._get_write_connection() as conn:
+			(low, high) = self._get_service_id_range(conn)
+			if (low == None):
+				return 0
+			for batch_start in range(low, high + 1, batch_size):
+				with conn.begin():
+					self._refresh_service_state(conn,
+						and_(services.c.service_id >= batch_start, services.c.service_id < batch_start + batch_size))
+			return conn.execute(select([func.count(services.c.service_id)],
+				services.c.current_observation_id != None)).first()[0]
+
+	def _refresh_service_state(self, conn, condition):
+		"""
+		Set last_seen, current_key, and current_observation_id
+		from the most recent observation of every service that matches 'condition'.
+		"""
+		services = Services.__table__
+		newest_id = select([Observations.observation_id],
+			Observations.service_id == services.c.service_id).\
+			order_by(Observations.end.desc(), Observations.observation_id.desc()).limit(1).as_scalar()
+		newest_end = select([Observations.end],
+			Observations.observation_id == services.c.current_observation_id).as_scalar()
+		newest_key = select([Observations.key],
+			Observations.observation_id == services.c.current_observation_id).as_scalar()
+
+		conn.execute(services.update().where(condition).values(current_observation_id=newest_id))
+		conn.execute(services.update().where(condition).values(last_seen=newest_end, current_key=newest_key))
+
+	def get_service_id_range(self):
+		"""Return the lowest and highest service_id as a tuple, or (None, None) if there are no services."""
+		with self._get_connection() as conn:
+			return self._get_service_id_range(conn)
+
+	def _get_service_id_range(self, conn):
+		"""Return the lowest and highest service_id as a tuple, or (None, None) if there are no services."""
+		row = conn.execute(select([func.min(Services.service_id), func.max(Services.service_id)])).first()
+		return (row[0], row[1])
+
+	def compact_observations(self, first_service_id, last_service_id, max_gap=COMPACTION_MAX_GAP):
+		"""
+		Merge observations of the same service and key whose timespans overlap,
+		or are no more than max_gap seconds apart, into a single observation.
+		Only services with first_service_id <= service_id <= last_service_id are compacted,
+		in a single transaction - keep the range small so other writers aren't blocked for long.
+
+		Return a list of the (start, end) timespans that were merged into another observation and removed,
+		or None if the observations changed while we were working and nothing was done.
+		"""
+		observations = Observations.__table__
+		removed = []
+		deletes = []
+		updates = []
+		moves = []
+
+		def finish(kept):
+			if (kept != None and kept['b_new_end'] != kept['b_old_end']):
+				updates.append({'b_observation_id': kept['b_observation_id'],
+					'b_old_end': kept['b_old_end'], 'b_new_end': kept['b_new_end']})
+
+		try:
+			with self._get_write_connection() as conn:
+				with conn.begin():
+					rows = conn.execute(select([Observations.observation_id, Observations.service_id,
+						Observations.key, Observations.start, Observations.end]).where(\
+						and_(Observations.service_id >= first_service_id,\
+						Observations.service_id <= last_service_id\
+						)).order_by(Observations.service_id, Observations.key, Observations.start).with_for_update())
+
+					kept = None
+					for (observation_id, service_id, key, start, end) in rows:
+						if (kept != None and kept['service_id'] == service_id and kept['key'] == key and
+							start <= kept['b_new_end'] + max_gap):
+							deletes.append({'b_observation_id': observation_id, 'b_end': end})
+							moves.append({'b_service_id': service_id, 'b_old_id': observation_id,
+								'b_new_id': kept['b_observation_id']})
+							removed.append((start, end))
+							kept['b_new_end'] = max(kept['b_new_end'], end)
+						else:
+							finish(kept)
+							kept = {'service_id': service_id, 'key': key, 'b_observation_id': observation_id,
+								'b_old_end': end, 'b_new_end': end}
+					finish(kept)
+
+					if (len(deletes) == 0):
+						return removed
+
+					# only change rows that are still the way we read them.
+					# if another process (e.g. a scanner) changed any of them, give up on this batch.
+					# deleting first keeps (service_id, key, end) unique when the kept observation takes over an end time.
+					changed = conn.execute(observations.delete().where(\
+						and_(observations.c.observation_id == bindparam('b_observation_id'),\
+						observations.c.end == bindparam('b_end')\
+						)), deletes).rowcount
+					if (len(updates) > 0):
+						changed += conn.execute(observations.update().where(\
+							and_(observations.c.observation_id == bindparam('b_observation_id'),\
+							observations.c.end == bindparam('b_old_end')\
+							)).values(end=bindparam('b_new_end')), updates).rowcount
+					if (changed != len(deletes) + len(updates)):
+						raise ValueError("Observations changed during compaction.")
+
+					# keep each service's current observation pointing at a row that still exists.
+					# the merged observation has the same key and end time, so nothing else changes.
+					services = Services.__table__
+					conn.execute(services.update().where(\
+						and_(services.c.service_id == bindparam('b_service_id'),\
+						services.c.current_observation_id == bindparam('b_old_id')\
+						)).values(current_observation_id=bindparam('b_new_id')), moves)
+		except ValueError as e:
+			logging.warning("Skipped compacting services {0} to {1}: '{2}'".format(first_service_id, last_service_id, e))
+			return None
+
+		return removed
+
+	def expire_observations(self, cutoff, batch_size, archive=None):
+		"""
+		Delete up to batch_size observations that ended before cutoff, in a single transaction.
+
+		If given, archive(rows) is called with a list of the (service, key, start, end) records
+		before they are deleted; if it raises an exception nothing is deleted.
+		Each service's last_seen and current_key are kept, so we still know when it was last seen.
+		Return the number of observations deleted.
+
+		Raise ValueError if cutoff is within OBSERVATION_UPDATE_LIMIT of now:
+		scans may still extend observations that recent, so they must not be deleted.
+		"""
+		if (cutoff > int(time.time()) - self.OBSERVATION_UPDATE_LIMIT):
+			raise ValueError("Observations that ended in the past {0} hours may still be extended and cannot be expired (attempted to use cutoff {1})".format(
+				self.OBSERVATION_UPDATE_LIMIT / 3600, cutoff))
+
+		with self._get_write_connection() as conn:
+			with conn.begin():
+				rows = conn.execute(select([Observations.observation_id, Observations.service_id,
+					Services.name, Observations.key, Observations.start, Observations.end]).where(\
+					and_(Observations.service_id == Services.service_id,\
+					Observations.end < cutoff\
+					)).limit(batch_size)).fetchall()
+				if (len(rows) == 0):
+					return 0
+
+				if (archive != None):
+					archive([(name, key, start, end) for (observation_id, service_id, name, key, start, end) in rows])
+
+				services = Services.__table__
+				for chunk in _chunks(rows, self.BULK_QUERY_SIZE / 2):
+					observation_ids = [row[0] for row in chunk]
+					conn.execute(Observations.__table__.delete().where(\
+						Observations.observation_id.in_(observation_ids)))
+					conn.execute(services.update().where(\
+						and_(services.c.service_id.in_(set([row[1] for row in chunk])),\
+						services.c.current_observation_id.in_(observation_ids)\
+						)).values(current_observation_id=None))
+				return len(rows)
+
+	def expire_metrics(self, cutoff, batch_size):
+		"""
+		Delete up to batch_size metrics recorded before cutoff, in a single transaction.
+		Return the number of metrics deleted.
+		"""
+		with self._get_write_connection() as conn:
+			with conn.begin():
+				# metrics are written in order, so the oldest are found first even without an index on date
+				old = select([Metrics.event_id], Metrics.date < cutoff).limit(batch_size)
+				event_ids = [row[0] for row in conn.execute(old)]
+				for chunk in _chunks(event_ids, self.BULK_QUERY_SIZE):
+					conn.execute(Metrics.__table__.delete().where(Metrics.event_id.in_(chunk)))
+				return len(event_ids)
+
+	def load_service_ids(self):
+		"""Fill the service ID cache with as many services as it will hold."""
+		with self._get_connection() as conn:
+			rows = conn.execute(select([Services.name, Services.service_id]).limit(self.service_ids.max_entries))
+			for (name, service_id) in rows:
+				self.service_ids.add(name, service_id)
+
+	def get_service_id_cache_stats(self):
+		"""Return a dictionary with the number of entries, hits, and misses for the service ID cache."""
+		return self.service_ids.get_stats()
+
+	def _get_service_id(self, conn, service):
+		"""
+		Return the service_id for a service name, or None if the service doesn't exist.
+		'conn' can be either a session or a connection.
+		"""
+		service_id = self.service_ids.get(service)
+		if (service_id == None):
+			row = conn.execute(select([Services.service_id], Services.name == service)).first()
+			if (row != None):
+				service_id = row[0]
+				self.service_ids.add(service, service_id)
+		return service_id
+
 	def count_services(self):
 		"""Return a count of the service records."""
 		with self._get_connection() as conn:
@@ -647,23 +1241,12 @@ class ndb(object):
 	def get_newest_service_names(self, end_limit):
 		"""Get service names with an observation newer than end_limit."""
 		with self._get_connection() as conn:
-			return self._get_newest_service_names(conn, end_limit)
-
-	def _get_newest_service_names(self, conn, end_limit):
-		"""Get service names with an observation newer than end_limit."""
-		# internal function so we don't have to open a separate database connection
-		return conn.execute(select([Services.name]).where(\
-				and_(Services.service_id == Observations.service_id,\
-				Observations.end > end_limit\
-				))).fetchall()
+			return conn.execute(select([Services.name], Services.last_seen > end_limit)).fetchall()
 
 	def get_oldest_service_names(self, end_limit):
 		"""Get service names with a MOST RECENT observation that is older than end_limit."""
 		with self._get_connection() as conn:
-			return conn.execute(select([Services.name]).where(\
-				and_(Services.service_id == Observations.service_id,\
-				~Services.name.in_(self._get_newest_service_names(conn, end_limit))\
-				))).fetchall()
+			return conn.execute(select([Services.name], Services.last_seen <= end_limit)).fetchall()
 
 	def insert_service(self, session, service_name):
 		"""Add a new Service to the database, and return the Service object."""
@@ -679,6 +1262,8 @@ class ndb(object):
 				logging.error("Error inserting service '%s': '%s'" % (service_name, e))
 				srv = None
 
+		if (srv != None):
+			self.service_ids.add(service_name, srv.service_id)
 		return srv
 
 	def insert_bulk_services(self, services):
@@ -692,7 +1277,7 @@ class ndb(object):
 			logging.error("Could not add services - no services in list.")
 			return
 
-		with self._get_connection() as conn:
+		with self._get_write_connection() as conn:
 			try:
 				# select duplicates that already exist in the database
 				dupes = conn.execute(select([Services.name], Services.name.in_(services))).fetchall()
@@ -717,6 +1302,97 @@ class ndb(object):
 
 		return
 
+	def insert_bulk_observations(self, observations, services=()):
+		"""
+		Add many Observations at once, in a single transaction.
+		This is much faster than adding them one record at a time.
+
+		'observations': a list of (service, key, start, end) tuples.
+		They are assumed to be valid already (e.g. exported from another notary),
+		so they don't need to be in chronological order.
+		'services': names of services to add even if they have no observations.
+		Any services that don't exist yet are added.
+
+		Observations are merged with the ones already in the database, so the same records can be imported
+		more than once: if an observation of the same service and key with the same start time exists,
+		its end time is extended instead, and records that are already in the database are skipped.
+		This lets a copy of a notary's database be kept up to date by importing only the observations
+		added or extended since the last import (see stream_observations()).
+
+		If any record still can't be added (e.g. because another program wrote the same observation
+		at the same time) the records are added one at a time instead, skipping any that fail.
+		"""
+		names = set(services)
+		names.update([ob[0] for ob in observations])
+		if (len(names) == 0):
+			return
+
+		try:
+			with self._get_write_connection() as conn:
+				with conn.begin():
+					service_ids = self._get_or_insert_service_ids(conn, list(names))
+					if (len(observations) > 0):
+						(inserts, updates) = self._merge_observations(conn, observations, service_ids)
+						self._bulk_insert(conn, Observations.__table__, inserts)
+						if (len(updates) > 0):
+							conn.execute(Observations.__table__.update().where(\
+								and_(Observations.service_id == bindparam('b_service_id'),\
+								Observations.key == bindparam('b_key'),\
+								Observations.start == bindparam('b_start')\
+								)).values(end=bindparam('b_new_end')), updates)
+						# the new observations may be older than ones we already have,
+						# so look for each service's most recent observation again.
+						updated = list(set([insert['service_id'] for insert in inserts] +
+							[update['b_service_id'] for update in updates]))
+						for chunk in _chunks(updated, self.BULK_QUERY_SIZE):
+							self._refresh_service_state(conn, Services.service_id.in_(chunk))
+			# only cache IDs once we know any new services were committed
+			for (service, service_id) in service_ids.iteritems():
+				self.service_ids.add(service, service_id)
+		except IntegrityError as e:
+			logging.error("Error adding {0} observations at once: '{1}'. Adding them one at a time instead.".format(
+				len(observations), e))
+			for chunk in _chunks(list(names), self.BULK_QUERY_SIZE):
+				self.insert_bulk_services(chunk)
+			for (service, key, start, end) in observations:
+				self._insert_observation(service, key, start, end)
+
+	def _merge_observations(self, conn, observations, service_ids):
+		"""
+		Compare (service, key, start, end) tuples with the observations already in the database.
+		Return (rows to insert, end times to extend) for insert_bulk_observations().
+		"""
+		existing_ends = {}
+		taken_ends = set()
+		for chunk in _chunks(list(set([service_ids[ob[0]] for ob in observations])), self.BULK_QUERY_SIZE):
+			rows = conn.execute(select([Observations.service_id, Observations.key, Observations.start, Observations.end]).\
+				where(Observations.service_id.in_(chunk)))
+			for (service_id, key, start, end) in rows:
+				existing_ends[(service_id, key, start)] = end
+				taken_ends.add((service_id, key, end))
+
+		# if a timespan is listed more than once, keep the latest end time
+		new_ends = {}
+		for (service, key, start, end) in observations:
+			timespan = (service_ids[service], key, start)
+			new_ends[timespan] = max(end, new_ends.get(timespan, end))
+
+		inserts = []
+		updates = []
+		for ((service_id, key, start), end) in new_ends.iteritems():
+			# skip anything we already have, and anything that would break the unique end time constraint
+			if ((service_id, key, end) in taken_ends):
+				continue
+			old_end = existing_ends.get((service_id, key, start))
+			if (old_end == None):
+				inserts.append({'service_id': service_id, 'key': key, 'start': start, 'end': end})
+			elif (end > old_end):
+				updates.append({'b_service_id': service_id, 'b_key': key, 'b_start': start, 'b_new_end': end})
+			else:
+				continue
+			taken_ends.add((service_id, key, end))
+		return (inserts, updates)
+
 	#######
 	def count_observations(self):
 		"""Return a count of the observation records."""
@@ -729,27 +1405,185 @@ class ndb(object):
 			order_by(Services.name).\
 			values(Services.name, Observations.key, Observations.start, Observations.end)
 
+	def _in_byte_order(self, column):
+		"""Return a string column that sorts and compares byte by byte, whatever the database's collation."""
+		collation = self.BYTE_ORDER_COLLATIONS.get(self.db.dialect.name)
+		if (collation == None):
+			return column
+		return column.collate(collation)
+
+	def _select_observations(self, columns, after_service=None, last_service=None, since=None):
+		"""
+		Return a query for columns of every observation and its service, sorted by service name, key, and start time.
+
+		Names and keys are sorted byte by byte (as python sorts them), not by the database's collation.
+		With e.g. an en_US collation postgresql ignores punctuation, so 'www.example.com' would come before
+		'www-foo.com'. Snapshots need services in python's order, and exports resumed with
+		after_service must compare names the same way they were sorted.
+		"""
+		name = self._in_byte_order(Services.name)
+		query = select(columns).where(\
+			Observations.service_id == Services.service_id\
+			).order_by(name, self._in_byte_order(Observations.key), Observations.start)
+		if (after_service != None):
+			query = query.where(name > after_service)
+		if (last_service != None):
+			query = query.where(name <= last_service)
+		if (since != None):
+			query = query.where(Observations.end >= since)
+		return query
+
+	def stream_observations(self, after_service=None, last_service=None, since=None, batch_size=STREAM_BATCH_SIZE):
+		"""
+		Yield (service, key, start, end) for every observation, sorted by service name, key, and start time
+		(byte by byte - see _select_observations()).
+
+		If after_service is given, start with the first service whose name sorts after it;
+		if last_service is given, stop after that service.
+		This lets a long export be done in parts, or resumed after the last service it finished.
+
+		If since is given, only yield observations that were added or extended at or after that time,
+		i.e. whose end time is since or later. Importing these into a copy of the database
+		with insert_bulk_observations() brings it up to date.
+
+		Rows are read batch_size at a time through a server-side cursor where the database supports one,
+		so the whole table never has to fit in memory.
+		"""
+		query = self._select_observations([Services.name, Observations.key, Observations.start, Observations.end],
+			after_service, last_service, since)
+
+		with self._get_connection() as conn:
+			rows = conn.execution_options(stream_results=True).execute(query)
+			while True:
+				batch = rows.fetchmany(batch_size)
+				if (len(batch) == 0):
+					break
+				for row in batch:
+					yield tuple(row)
+
+	def copy_observations_to(self, output_file, after_service=None, last_service=None, since=None):
+		"""
+		Write every observation to output_file as a '(service, key, start, end)' line,
+		the format read by file2db.py. Lines are in the same order as stream_observations(),
+		and after_service, last_service, and since work the same way.
+
+		On postgresql the database formats the lines itself and sends them with COPY ... TO STDOUT,
+		which is several times faster than fetching the rows.
+		output_file.write() may then be given several lines at once, or only part of one.
+		"""
+		if (self.db.dialect.driver != 'psycopg2'):
+			for (service, key, start, end) in self.stream_observations(after_service, last_service, since):
+				output_file.write("(%s, %s, %s, %s)\n" % (service, key, start, end))
+			return
+
+		line = literal('(') + Services.name + literal(', ') + Observations.key + literal(', ') +\
+			cast(Observations.start, String) + literal(', ') + cast(Observations.end, String) + literal(')')
+		query = self._select_observations([line], after_service, last_service, since).compile(dialect=self.db.dialect)
+		with self._get_connection() as conn:
+			cursor = conn.connection.cursor()
+			try:
+				sql = "COPY ({0}) TO STDOUT".format(cursor.mogrify(unicode(query), query.params))
+				cursor.copy_expert(sql, output_file)
+			except self.db.dialect.dbapi.Error as e:
+				raise DBAPIError.instance(sql, None, e, self.db.dialect.dbapi.Error)
+			finally:
+				cursor.close()
+
+	def _bulk_insert(self, conn, table, rows):
+		"""
+		Insert a list of dictionaries of column values into table. Every dictionary must have the same keys.
+
+		On postgresql the rows are sent with COPY ... FROM STDIN,
+		which is much faster than inserting them one at a time. Other databases use executemany.
+		"""
+		if (len(rows) == 0):
+			return
+		if (conn.dialect.driver != 'psycopg2'):
+			conn.execute(table.insert(), rows)
+			return
+
+		columns = [column for column in table.columns if column.name in rows[0]]
+		data = ''.join(['\t'.join([_copy_value(column, row[column.name]) for column in columns]) + '\n' for row in rows])
+		sql = 'COPY {0} ({1}) FROM STDIN'.format(table.name, ', '.join(['"{0}"'.format(column.name) for column in columns]))
+		# COPY isn't available through sqlalchemy, so use the connection's database driver directly.
+		# it is still part of the connection's transaction.
+		cursor = conn.connection.cursor()
+		try:
+			cursor.copy_expert(sql, StringIO(data))
+		except conn.dialect.dbapi.Error as e:
+			# raise the same exceptions an insert would, e.g. IntegrityError
+			raise DBAPIError.instance(sql, None, e, conn.dialect.dbapi.Error)
+		finally:
+			cursor.close()
+
 	def get_observations(self, session, service):
 		"""Get all observations for a given service."""
 		try:
-			return session.query(Services).join(Observations).\
-				filter(Services.name == service).\
-				values(Services.name, Observations.key, Observations.start, Observations.end)
+			service_id = self._get_service_id(session, service)
+			if (service_id == None):
+				return []
+			return session.query(Observations).\
+				filter(Observations.service_id == service_id).\
+				values(literal(service).label('name'), Observations.key, Observations.start, Observations.end)
+		except Exception as e:
+			logging.error("Error getting observations: '%s'" % (e))
+			# re-raise the error so the caller definitely knows something bad happened,
+			# as opposed to there being no observation records
+			raise
+
+	def get_observations_by_key(self, service, min_end=None):
+		"""
+		Get all observations for a given service, grouped by key.
+		If min_end is given, leave out observations that ended before then.
+
+		Returns a list of (key, timespans) tuples,
+		where timespans is a list of (start, end) tuples sorted by start time.
+		"""
+		# the unique constraint on (service_id, key, start) gives the database an index
+		# that returns rows in exactly this order, so it doesn't need to sort them.
+		# this lets us group the rows in a single pass.
+		keys = []
+		try:
+			with self._get_connection() as conn:
+				service_id = self._get_service_id(conn, service)
+				if (service_id == None):
+					return keys
+				query = select([Observations.key, Observations.start, Observations.end],\
+					Observations.service_id == service_id\
+					).order_by(Observations.key, Observations.start)
+				if (min_end != None):
+					query = query.where(Observations.end >= min_end)
+				rows = conn.execute(query)
+
+				for (key, start, end) in rows:
+					if (len(keys) == 0 or keys[-1][0] != key):
+						keys.append((key, []))
+					keys[-1][1].append((start, end))
 		except Exception as e:
 			logging.error("Error getting observations: '%s'" % (e))
 			# re-raise the error so the caller definitely knows something bad happened,
 			# as opposed to there being no observation records
 			raise
 
+		return keys
+
 	def _insert_observation(self, service, key, start_time, end_time):
 		"""Insert a new Observation about a service/key pair."""
-		with self.get_session() as session:
-			srv = self.insert_service(session, service)
-			if (srv != None):
+		with self._get_write_session() as session:
+			service_id = self.service_ids.get(service)
+			if (service_id == None):
+				srv = self.insert_service(session, service)
+				if (srv != None):
+					service_id = srv.service_id
+			if (service_id != None):
 				try:
-					newob = Observations(service_id=srv.service_id, key=key, start=start_time, end=end_time)
+					newob = Observations(service_id=service_id, key=key, start=start_time, end=end_time)
 					newob.validate()
 					session.add(newob)
+					# flush so the database assigns the new observation_id
+					session.flush()
+					self._update_service_state(session, [{'b_service_id': service_id, 'b_key': key,
+						'b_end': end_time, 'b_observation_id': newob.observation_id}])
 					session.commit()
 				except (ProgrammingError, IntegrityError, OperationalError, ValueError) as e:
 					logging.error("Error committing observation on key '%s' for service '%s': '%s'" % (key, service, e))
@@ -768,9 +1602,9 @@ class ndb(object):
 			old_end_time = curtime
 
 		try:
-			with self.get_session() as session:
-				ob = session.query(Observations).join(Services)\
-					.filter(Services.name == service)\
+			with self._get_write_session() as session:
+				ob = session.query(Observations)\
+					.filter(Observations.service_id == self._get_service_id(session, service))\
 					.filter(Observations.key == fp)\
 					.filter(Observations.end == old_end_time).first()
 				if (ob != None):
@@ -779,6 +1613,8 @@ class ndb(object):
 							new_end_time))
 					ob.validate()
 					ob.end = new_end_time
+					self._update_service_state(session, [{'b_service_id': ob.service_id, 'b_key': fp,
+						'b_end': new_end_time, 'b_observation_id': ob.observation_id}])
 					session.commit()
 				else:
 					logging.error("Attempted to update the end time for service '%s' key '%s',\
@@ -794,26 +1630,18 @@ class ndb(object):
 		"""
 
 		cur_time = int(time.time())
-		most_recent_time_by_key = {}
 		most_recent_key = None
 		most_recent_time = 0
 
 		try:
-			with self.get_session() as session:
-				obs = self.get_observations(session, service)
-
-				# calculate the most recently seen key
-				# TODO: there has got to be a more efficient way to do this with a query
-				for (service, key, start, end) in obs:
-					if key not in most_recent_time_by_key or end > most_recent_time_by_key[key]:
-						most_recent_time_by_key[key] = end
-
-					for k in most_recent_time_by_key:
-						if most_recent_time_by_key[k] > most_recent_time:
-							most_recent_key = k
-							most_recent_time = most_recent_time_by_key[k]
+			with self._get_connection() as conn:
+				service_id = self._get_service_id(conn, service)
+				if (service_id != None):
+					state = self._get_service_state(conn, [service_id])
+					if (service_id in state):
+						(most_recent_key, most_recent_time, observation_id) = state[service_id]
 		except Exception as e:
-			# error already reported by get_observations()
+			logging.error("Error getting observations: '%s'" % (e))
 			return
 
 		if most_recent_key == fp: # "fingerprint"
@@ -834,6 +1662,198 @@ class ndb(object):
 				# if there was a previous key that ended within the time cutoff, update its end time.
 				self._update_observation_end_time(service, most_recent_key, most_recent_time, cur_time - 1)
 
+	def report_observations(self, results):
+		"""
+		Insert or update Observation records for a list of (service, fp) results.
+
+		This has the same effect as calling report_observation() for each result in order,
+		but reads and writes the records for every service in a single transaction
+		rather than using several transactions per service.
+		"""
+		if (len(results) == 0):
+			return
+
+		cur_time = int(time.time())
+
+		# later results for the same service must see the changes made by earlier ones.
+		# split the results into rounds that each contain every service at most once.
+		rounds = []
+		round_by_service = {}
+		for (service, fp) in results:
+			r = round_by_service.get(service, 0)
+			round_by_service[service] = r + 1
+			if (r == len(rounds)):
+				rounds.append([])
+			rounds[r].append((service, fp))
+
+		# (service_id, key) of the observations this batch starts at cur_time
+		started = set()
+
+		try:
+			with self._get_write_connection() as conn:
+				with conn.begin():
+					service_ids = self._get_or_insert_service_ids(conn, round_by_service.keys())
+					for results_round in rounds:
+						self._report_observations_round(conn, results_round, service_ids, cur_time, started)
+			# only cache IDs once we know any new services were committed
+			for (service, service_id) in service_ids.iteritems():
+				self.service_ids.add(service, service_id)
+		except IntegrityError as e:
+			# e.g. another process added the same service or observation at the same time.
+			# report_observation() logs and skips these problems for each service,
+			# so fall back to that rather than losing the whole batch.
+			logging.error("Error reporting {0} observations at once: '{1}'. Reporting them one at a time instead.".format(
+				len(results), e))
+			for (service, fp) in results:
+				self.report_observation(service, fp)
+
+	def _get_or_insert_service_ids(self, conn, services):
+		"""Return a dictionary of service name -> service_id, adding any services that don't exist yet."""
+		service_ids = {}
+		for service in services:
+			service_id = self.service_ids.get(service)
+			if (service_id != None):
+				service_ids[service] = service_id
+
+		unknown = [service for service in services if service not in service_ids]
+		for chunk in _chunks(unknown, self.BULK_QUERY_SIZE):
+			for (service_id, name) in conn.execute(
+				select([Services.service_id, Services.name], Services.name.in_(chunk))):
+				service_ids[name] = service_id
+
+		new_services = [name for name in services if name not in service_ids]
+		if (len(new_services) > 0):
+			self._bulk_insert(conn, Services.__table__, [{'name': name} for name in new_services])
+			for chunk in _chunks(new_services, self.BULK_QUERY_SIZE):
+				for (service_id, name) in conn.execute(
+					select([Services.service_id, Services.name], Services.name.in_(chunk))):
+					service_ids[name] = service_id
+
+		return service_ids
+
+	def _update_service_state(self, conn, states):
+		"""
+		Record the most recent observation of services in t_services.
+
+		'states': a list of dictionaries with the keys 'b_service_id', 'b_key', 'b_end', and 'b_observation_id'.
+		Services that already have a more recent observation are left alone,
+		so observations can be written in any order.
+		'conn' can be either a session or a connection.
+		"""
+		services = Services.__table__
+		conn.execute(services.update().where(\
+			and_(services.c.service_id == bindparam('b_service_id'),\
+			or_(services.c.last_seen == None, services.c.last_seen <= bindparam('b_end'))\
+			)).values(last_seen=bindparam('b_end'), current_key=bindparam('b_key'),
+				current_observation_id=bindparam('b_observation_id')), states)
+
+	def _get_service_state(self, conn, service_ids):
+		"""
+		Return a dictionary of service_id -> (key, end, observation_id)
+		for the observation each service was most recently seen with.
+		Services with no observations are left out, as are services whose most recent observation
+		has been expired: there is nothing left to extend, so the next scan starts a new observation.
+		"""
+		state = {}
+		unknown = []
+		for chunk in _chunks(service_ids, self.BULK_QUERY_SIZE):
+			rows = conn.execute(select([Services.service_id, Services.current_key, Services.last_seen,
+				Services.current_observation_id], Services.service_id.in_(chunk)))
+			for (service_id, key, end, observation_id) in rows:
+				if (end == None):
+					unknown.append(service_id)
+				elif (observation_id != None):
+					state[service_id] = (key, end, observation_id)
+
+		# services that have observations but were never filled in
+		# (e.g. because they were added by an older version before upgrading)
+		# have to be found by searching their history.
+		for chunk in _chunks(unknown, self.BULK_QUERY_SIZE):
+			newest = select([Observations.service_id, func.max(Observations.end).label('end')],
+				Observations.service_id.in_(chunk)).group_by(Observations.service_id).alias('newest')
+			rows = conn.execute(select([Observations.service_id, Observations.key, Observations.end,
+				Observations.observation_id]).where(\
+				and_(Observations.service_id == newest.c.service_id,\
+				Observations.end == newest.c.end\
+				)))
+			for (service_id, key, end, observation_id) in rows:
+				state[service_id] = (key, end, observation_id)
+		return state
+
+	def _report_observations_round(self, conn, results, service_ids, cur_time, started):
+		"""
+		Insert or update Observation records for results that each have a different service.
+		External callers should use report_observations() instead.
+
+		'started': the (service_id, key) of every observation earlier rounds started at cur_time.
+		Observations this round starts are added to it.
+		"""
+		state = self._get_service_state(conn, [service_ids[service] for (service, fp) in results])
+		inserts = []
+		updates = []
+		# the new state of each service whose current observation changes
+		service_states = []
+
+		def update_end_time(service, service_id, key, old_end_time, new_end_time):
+			if (new_end_time <= old_end_time):
+				logging.error("Error committing observation on key '%s' for service '%s': '%s'" % (key, service,
+					'New end time must be > current end time. (attempted to use new end time {0})'.format(new_end_time)))
+				return False
+			updates.append({'b_service_id': service_id, 'b_key': key,
+				'b_old_end': old_end_time, 'b_new_end': new_end_time})
+			return True
+
+		for (service, fp) in results:
+			service_id = service_ids[service]
+
+			# the same rules as report_observation() -
+			# see there for why each case is handled the way it is.
+			(most_recent_key, most_recent_time, observation_id) = state.get(service_id, (None, 0, None))
+
+			within_limit = ((cur_time - most_recent_time) <= self.OBSERVATION_UPDATE_LIMIT)
+			if (most_recent_key == fp and within_limit):
+				if (update_end_time(service, service_id, fp, most_recent_time, cur_time)):
+					service_states.append({'b_service_id': service_id, 'b_key': fp,
+						'b_end': cur_time, 'b_observation_id': observation_id})
+			elif ((service_id, fp) in started):
+				# the key changed and then changed back within this second.
+				# (service_id, key, start) is unique, so there can't be a second observation of it starting now;
+				# report_observation() would log the failed insert and change nothing.
+				logging.error("Error committing observation on key '%s' for service '%s': '%s'" % (fp, service,
+					'An observation of this key already started at {0}'.format(cur_time)))
+			else:
+				inserts.append({'service_id': service_id, 'key': fp, 'start': cur_time, 'end': cur_time})
+				started.add((service_id, fp))
+				# if the previous key was first seen this second, ending it a second earlier
+				# would put its end before its start, so leave it as it is.
+				if (most_recent_key != None and most_recent_key != fp and within_limit and
+					(service_id, most_recent_key) not in started):
+					update_end_time(service, service_id, most_recent_key, most_recent_time, cur_time - 1)
+
+		if (len(inserts) > 0):
+			self._bulk_insert(conn, Observations.__table__, inserts)
+			# look up the IDs the database gave the new observations.
+			# each service has at most one result in a round, so (service_id, key, start) finds them.
+			new_ids = {}
+			for chunk in _chunks([insert['service_id'] for insert in inserts], self.BULK_QUERY_SIZE):
+				rows = conn.execute(select([Observations.service_id, Observations.key, Observations.observation_id]).where(\
+					and_(Observations.service_id.in_(chunk),\
+					Observations.start == cur_time\
+					)))
+				for (service_id, key, observation_id) in rows:
+					new_ids[(service_id, key)] = observation_id
+			for insert in inserts:
+				service_states.append({'b_service_id': insert['service_id'], 'b_key': insert['key'],
+					'b_end': cur_time, 'b_observation_id': new_ids[(insert['service_id'], insert['key'])]})
+		if (len(updates) > 0):
+			conn.execute(Observations.__table__.update().where(\
+				and_(Observations.service_id == bindparam('b_service_id'),\
+				Observations.key == bindparam('b_key'),\
+				Observations.end == bindparam('b_old_end')\
+				)).values(end=bindparam('b_new_end')), updates)
+		if (len(service_states) > 0):
+			self._update_service_state(conn, service_states)
+
 	def is_metrics_enabled(self):
 		"""Retun true if the metrics tracking system is currently running, false otherwise."""
 		if (self.metricsdb or self.metricslog):
@@ -841,8 +1861,11 @@ class ndb(object):
 		return False
 
 	# rate limit metrics so spamming queries doesn't take down the system.
+	# limit each event type separately, so metrics reported together
+	# (e.g. GetObservationsForService, ResponseSigned and DatabasePoolStats for the same request)
+	# don't crowd each other out.
 	# TODO: we could group metrics up to report in one big transaction, or use a background worker
-	@ratelimited(1)
+	@ratelimited(1, key=lambda self, event_type, comment="": event_type)
 	def report_metric(self, event_type, comment=""):
 		"""Record a metric event in the database or the log."""
 		if self.is_metrics_enabled():
@@ -853,7 +1876,7 @@ class ndb(object):
 				if (self.metricsdb):
 					# wrap metric write attempts in a try/catch block so errors don't bring down the server
 					try:
-						with self.get_session() as session:
+						with self._get_write_session() as session:
 							metric = Metrics(event_type_id=self.EVENT_TYPES[event_type],\
 								date=int(time.time()), comment=str(comment))
 							session.add(metric)
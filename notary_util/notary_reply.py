@@ -0,0 +1,179 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Build the signed XML replies that notaries send to clients.
+
+Clients check a reply by packing the XML they receive into the same binary format
+that the notary signed (see verify_notary_signature() in client/client_common.py),
+so the XML we write and the data we sign must always describe exactly the same observations.
+
+Replies can also be stored as compact cache entries, which hold the signature
+and the packed data that was signed instead of the much larger XML text.
+render_cache_entry() turns a stored entry back into exactly the same XML.
+"""
+
+import base64
+import binascii
+import struct
+
+import notary_common
+
+
+SIG_TYPE = "rsa-md5"
+XML_VERSION = "1"
+
+# the layout here is exactly what xml.dom.minidom's toprettyxml() produces
+# (attributes sorted by name, tab indentation),
+# which is what notaries have always sent.
+REPLY_START = '<notary_reply sig="%s" sig_type="%s" version="%s">\n'
+KEY_START = '\t<key fp="%s" type="%s">\n'
+TIMESTAMP = '\t\t<timestamp end="%d" start="%d"/>\n'
+KEY_END = '\t</key>\n'
+REPLY_END = '</notary_reply>\n'
+
+# binary layout of the signed data - see verify_notary_signature() in client/client_common.py
+KEY_HEAD = struct.Struct('!HBBB') # number of timespans, 0, fingerprint length, 3
+TIMESPAN = struct.Struct('!II') # start, end
+FP_LENGTH = 16 # clients expect MD5 fingerprints
+
+# cache entries start with a small header:
+# format version, service type, and the length of the raw signature.
+# the signature follows, then the data that was signed.
+# XML always starts with '<', which can never be a version byte,
+# so we can still tell which values were cached as XML.
+ENTRY_VERSION = 1
+ENTRY_HEAD = struct.Struct('!BcH')
+
+
+def pack_fingerprint(fp):
+	"""Convert a colon-separated hex fingerprint such as 'aa:bb:cc' to raw bytes."""
+	if (len(fp) % 3 == 2 and fp[2::3] == ':' * (len(fp) // 3)):
+		# every byte is written with two hex digits; convert them all at once
+		return binascii.unhexlify(fp.replace(':', ''))
+
+	# convert each byte separately, the same way clients do
+	return ''.join(struct.pack('B', int(hex_byte, 16)) for hex_byte in fp.split(':'))
+
+def unpack_fingerprint(fp_bytes):
+	"""Convert raw fingerprint bytes to colon-separated hex, e.g. 'aa:bb:cc'."""
+	hex_fp = binascii.hexlify(fp_bytes)
+	return ':'.join([hex_fp[i:i + 2] for i in xrange(0, len(hex_fp), 2)])
+
+def build_reply(service, service_type, keys, signer):
+	"""
+	Build and sign the XML reply for a service in one pass over its observations.
+
+	'keys': a list of (key, timespans) tuples, where timespans is a list of
+	(start, end) tuples sorted by start time.
+	'signer': an object with a sign() function, such as util.crypto.Signer.
+	"""
+	key_type = notary_common.SERVICE_TYPES[service_type]
+	xml_parts = []
+	packed_keys = []
+
+	for (key, timespans) in keys:
+		xml_parts.append(KEY_START % (key, key_type))
+
+		num_timespans = len(timespans)
+		packed = [KEY_HEAD.pack(num_timespans & 0xffff, 0, FP_LENGTH, 3), pack_fingerprint(key)]
+
+		for (start, end) in timespans:
+			xml_parts.append(TIMESTAMP % (end, start))
+			packed.append(TIMESPAN.pack(start & 0xffffffff, end & 0xffffffff))
+
+		xml_parts.append(KEY_END)
+		packed_keys.append(''.join(packed))
+
+	# the signed data lists keys in the reverse order from the XML
+	packed_keys.reverse()
+	packed_data = str(service) + '\x00' + ''.join(packed_keys)
+	sig = signer.sign(packed_data)
+
+	return (REPLY_START % (sig, SIG_TYPE, XML_VERSION)) + ''.join(xml_parts) + REPLY_END
+
+def build_cache_entry(service, service_type, keys, signer):
+	"""
+	Sign the observations for a service and return a compact cache entry.
+
+	Arguments are the same as for build_reply(),
+	but 'signer' must also have a sign_raw() function.
+
+	Returns None if the observations can't be rendered back to exactly the XML
+	that build_reply() would create (e.g. if a key is not a canonical MD5 fingerprint);
+	callers should cache the XML instead.
+	"""
+	packed_keys = []
+
+	for (key, timespans) in keys:
+		fp_bytes = pack_fingerprint(key)
+		if (len(fp_bytes) != FP_LENGTH or unpack_fingerprint(fp_bytes) != key or len(timespans) > 0xffff):
+			return None
+
+		packed = [KEY_HEAD.pack(len(timespans), 0, FP_LENGTH, 3), fp_bytes]
+		for (start, end) in timespans:
+			if not (0 <= start <= 0xffffffff and 0 <= end <= 0xffffffff):
+				return None
+			packed.append(TIMESPAN.pack(start, end))
+		packed_keys.append(''.join(packed))
+
+	# the signed data lists keys in the reverse order from the XML
+	packed_keys.reverse()
+	packed_data = str(service) + '\x00' + ''.join(packed_keys)
+	sig = signer.sign_raw(packed_data)
+
+	return ENTRY_HEAD.pack(ENTRY_VERSION, str(service_type), len(sig)) + sig + packed_data
+
+def render_cache_entry(entry):
+	"""
+	Return the XML reply for a value stored in the cache.
+
+	Values that were cached as XML are returned unchanged.
+	Raises ValueError if the entry can't be read.
+	"""
+	if (entry.startswith('<')):
+		return entry
+
+	try:
+		(version, service_type, sig_len) = ENTRY_HEAD.unpack_from(entry, 0)
+		if (version != ENTRY_VERSION):
+			raise ValueError("unknown cache entry version %d" % (version))
+
+		offset = ENTRY_HEAD.size
+		sig = base64.standard_b64encode(entry[offset:offset + sig_len])
+		offset = entry.index('\x00', offset + sig_len) + 1 # skip the service name
+		key_type = notary_common.SERVICE_TYPES[service_type]
+
+		key_blocks = []
+		while (offset < len(entry)):
+			(num_timespans, zero, fp_len, three) = KEY_HEAD.unpack_from(entry, offset)
+			offset += KEY_HEAD.size
+			xml_parts = [KEY_START % (unpack_fingerprint(entry[offset:offset + fp_len]), key_type)]
+			offset += fp_len
+
+			for i in xrange(num_timespans):
+				(start, end) = TIMESPAN.unpack_from(entry, offset)
+				offset += TIMESPAN.size
+				xml_parts.append(TIMESTAMP % (end, start))
+
+			xml_parts.append(KEY_END)
+			key_blocks.append(''.join(xml_parts))
+	except (struct.error, KeyError) as e:
+		raise ValueError("invalid cache entry: %s" % (e))
+
+	# the signed data lists keys in the reverse order from the XML
+	key_blocks.reverse()
+	return (REPLY_START % (sig, SIG_TYPE, XML_VERSION)) + ''.join(key_blocks) + REPLY_END
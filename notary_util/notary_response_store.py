@@ -0,0 +1,258 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A read-only file of signed replies for every service, so a notary can serve requests without a database.
+
+build_response_store.py signs a reply for every service in the database and writes them to one file.
+notary_http.py --response-store answers requests from that file through mmap,
+so the operating system's page cache holds whichever parts are being used
+and the server itself needs very little memory, however many services there are.
+
+Layout (version 1; all numbers are big-endian):
+
+  header: MAGIC, then HEADER: format version, number of bucket bits, unused,
+      length of the public key, number of services, time the file was built (unix time),
+      and the offset of the bucket table.
+  the PEM public key of the notary that signed the replies.
+  records, one per service, in any order: RECORD_HEAD (length of the service name, length of the entry),
+      the service name, then a cache entry from notary_reply.build_cache_entry(),
+      or the XML reply for a service that can't be stored as a cache entry.
+  bucket table: (2 ** bucket bits) + 1 uint32s. The services whose hash starts with
+      the bits b are at index positions table[b] up to (but not including) table[b + 1].
+  index: INDEX_ENTRY (hash, record offset) for every service, sorted by hash.
+
+A service's hash is the first 8 bytes of the md5 of its name.
+"""
+
+import array
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+MAGIC = 'NOTARYRESPONSES\n'
+VERSION = 1
+
+HEADER = struct.Struct('!BBHIQQQ')
+RECORD_HEAD = struct.Struct('!HI')
+INDEX_ENTRY = struct.Struct('!QQ')
+HASH = struct.Struct('!Q')
+BUCKET = struct.Struct('!I')
+BUCKET_RANGE = struct.Struct('!II')
+
+# use enough buckets that each holds about this many services, so a lookup only searches a few index entries
+BUCKET_SIZE = 16
+MAX_BUCKET_BITS = 24
+
+RELOAD_INTERVAL = 60 # seconds
+
+
+class ResponseStoreError(Exception):
+	"""The file is not a valid response store."""
+	pass
+
+
+def service_hash(service):
+	"""Return the hash used to find a service in the index."""
+	return HASH.unpack_from(hashlib.md5(service).digest())[0]
+
+
+class ResponseStoreWriter(object):
+	"""
+	Write a response store file.
+
+	Call add() for each service, then close().
+	The file is written under a temporary name and only replaces 'path' when close() finishes,
+	so servers reading the old file never see a partly written one.
+	"""
+
+	def __init__(self, path, public_key, built_time=None):
+		self.path = path
+		self.temp_path = path + '.tmp'
+		self.public_key = public_key
+		self.built_time = built_time if (built_time != None) else int(time.time())
+		self.num_services = 0
+		# INDEX_ENTRYs in the order services were added; they are sorted by hash in close()
+		self.index = bytearray()
+		self.output_file = open(self.temp_path, 'wb')
+		self.output_file.write(MAGIC + HEADER.pack(VERSION, 0, 0, len(public_key), 0, 0, 0) + public_key)
+		self.offset = len(MAGIC) + HEADER.size + len(public_key)
+
+	def add(self, service, entry):
+		"""Add the cache entry or XML reply for a service. Each service must only be added once."""
+		if (isinstance(service, unicode)):
+			service = service.encode('utf-8')
+		if (isinstance(entry, unicode)):
+			entry = entry.encode('utf-8')
+		self.index += INDEX_ENTRY.pack(service_hash(service), self.offset)
+		self.output_file.write(RECORD_HEAD.pack(len(service), len(entry)) + service + entry)
+		self.offset += RECORD_HEAD.size + len(service) + len(entry)
+		self.num_services += 1
+
+	def _sort_index(self, bucket_bits):
+		"""Sort the index by hash. Return it and the bucket table."""
+		# the index can have tens of millions of entries, so instead of sorting it all at once
+		# place each entry in its bucket and then sort each (small) bucket.
+		size = INDEX_ENTRY.size
+		shift = 64 - bucket_bits
+		buckets = array.array('I', (HASH.unpack_from(self.index, i)[0] >> shift for i in xrange(0, len(self.index), size)))
+
+		table = array.array('I', [0]) * ((1 << bucket_bits) + 1)
+		for bucket in buckets:
+			table[bucket + 1] += 1
+		for b in xrange(1, len(table)):
+			table[b] += table[b - 1]
+
+		index = bytearray(len(self.index))
+		next_position = table[:-1]
+		for (i, bucket) in enumerate(buckets):
+			position = next_position[bucket] * size
+			index[position:position + size] = self.index[i * size:(i + 1) * size]
+			next_position[bucket] += 1
+		del buckets
+
+		for b in xrange(len(table) - 1):
+			(start, end) = (table[b] * size, table[b + 1] * size)
+			if (end - start > size):
+				index[start:end] = ''.join(sorted([str(index[i:i + size]) for i in xrange(start, end, size)]))
+		return (index, table)
+
+	def close(self):
+		"""Write the index and header, and move the finished file into place."""
+		bucket_bits = 0
+		while ((bucket_bits < MAX_BUCKET_BITS) and ((BUCKET_SIZE << (bucket_bits + 1)) <= self.num_services)):
+			bucket_bits += 1
+
+		(index, table) = self._sort_index(bucket_bits)
+		self.index = None
+		table_offset = self.offset
+		self.output_file.write(''.join([BUCKET.pack(position) for position in table]))
+		self.output_file.write(index)
+
+		self.output_file.seek(len(MAGIC))
+		self.output_file.write(HEADER.pack(VERSION, bucket_bits, 0, len(self.public_key),
+			self.num_services, self.built_time, table_offset))
+		self.output_file.flush()
+		os.fsync(self.output_file.fileno())
+		self.output_file.close()
+		os.rename(self.temp_path, self.path)
+
+
+class ResponseStore(object):
+	"""
+	Look up replies in a response store file.
+
+	The file is mapped into memory rather than read, so opening even a very large store is instant
+	and only the pages that lookups touch are ever read from disk.
+	If the file is replaced (e.g. by running build_response_store.py again)
+	the new one is used within RELOAD_INTERVAL seconds.
+	Replace the file by renaming a new one over it: changes written into the old file
+	show through to lookups in progress.
+	A ResponseStore can be shared by any number of threads.
+	"""
+
+	def __init__(self, path, reload_interval=RELOAD_INTERVAL):
+		self.path = path
+		self.reload_interval = reload_interval
+		self.lock = threading.Lock()
+		self.state = self._open()
+		self.next_check = time.time() + reload_interval
+
+	def _open(self):
+		"""Map the file into memory and return a tuple of everything lookups need."""
+		with open(self.path, 'rb') as store_file:
+			stat = os.fstat(store_file.fileno())
+			if (stat.st_size < len(MAGIC) + HEADER.size):
+				raise ResponseStoreError("'{0}' is not a notary response store.".format(self.path))
+			# the mapping stays valid after the file is closed
+			data = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		if (data[:len(MAGIC)] != MAGIC):
+			raise ResponseStoreError("'{0}' is not a notary response store.".format(self.path))
+		(version, bucket_bits, unused, key_length, num_services, built_time, table_offset) = \
+			HEADER.unpack_from(data, len(MAGIC))
+		if (version != VERSION):
+			raise ResponseStoreError("'{0}' has unsupported version {1}.".format(self.path, version))
+		index_offset = table_offset + (((1 << bucket_bits) + 1) * BUCKET.size)
+		if (index_offset + (num_services * INDEX_ENTRY.size) != len(data)):
+			raise ResponseStoreError("'{0}' is truncated.".format(self.path))
+
+		key_offset = len(MAGIC) + HEADER.size
+		public_key = data[key_offset:key_offset + key_length]
+		return (data, 64 - bucket_bits, table_offset, index_offset, num_services, built_time, public_key,
+			(stat.st_ino, stat.st_mtime, stat.st_size))
+
+	def _reload_if_changed(self):
+		"""Switch to a new file if the store has been replaced."""
+		with self.lock:
+			if (time.time() < self.next_check):
+				return
+			self.next_check = time.time() + self.reload_interval
+			try:
+				stat = os.stat(self.path)
+				if ((stat.st_ino, stat.st_mtime, stat.st_size) != self.state[7]):
+					# lookups already in progress keep using the old mapping,
+					# which is closed when the last of them is done with it.
+					self.state = self._open()
+			except (OSError, IOError, ResponseStoreError) as e:
+				# keep serving the file we have
+				logging.error("Could not reload response store '{0}': {1}".format(self.path, e))
+
+	def get(self, service):
+		"""Return the stored cache entry or XML reply for a service, or None if there isn't one."""
+		if (time.time() >= self.next_check):
+			self._reload_if_changed()
+		(data, shift, table_offset, index_offset, num_services, built_time, public_key, file_id) = self.state
+
+		if (isinstance(service, unicode)):
+			service = service.encode('utf-8')
+		key = service_hash(service)
+		(low, end) = BUCKET_RANGE.unpack_from(data, table_offset + ((key >> shift) * BUCKET.size))
+
+		# find the first index entry with this hash
+		high = end
+		while (low < high):
+			middle = (low + high) // 2
+			if (HASH.unpack_from(data, index_offset + (middle * INDEX_ENTRY.size))[0] < key):
+				low = middle + 1
+			else:
+				high = middle
+
+		# different services can have the same hash, so check the name of each one
+		while (low < end):
+			(entry_hash, offset) = INDEX_ENTRY.unpack_from(data, index_offset + (low * INDEX_ENTRY.size))
+			if (entry_hash != key):
+				break
+			(name_length, entry_length) = RECORD_HEAD.unpack_from(data, offset)
+			offset += RECORD_HEAD.size
+			if (name_length == len(service) and data[offset:offset + name_length] == service):
+				offset += name_length
+				return data[offset:offset + entry_length]
+			low += 1
+		return None
+
+	def get_public_key(self):
+		"""Return the public key of the notary that signed the stored replies."""
+		return self.state[6]
+
+	def get_stats(self):
+		"""Return (number of services, time the store was built)."""
+		return (self.state[4], self.state[5])
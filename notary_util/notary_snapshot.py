@@ -0,0 +1,401 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Read and write notary observations in a compact binary snapshot format.
+
+A snapshot is much smaller and faster to read than the text tuple format,
+and its index lets a reader skip straight to the block holding a given service.
+
+Layout (version 1; all fixed-size numbers are big-endian):
+
+  header: MAGIC, then one byte each for the format version and the compression used for blocks.
+
+  blocks: each holds whole services, sorted by name, and starts with
+      'B', then the compressed length, uncompressed length, and CRC32 of the uncompressed data (3 x uint32),
+      then the compressed data:
+      - varint: number of services
+      - for each service:
+          - varint: number of leading bytes its name shares with the previous name in the block;
+            varint: number of remaining bytes; the remaining bytes.
+          - varint: number of keys
+          - for each key:
+              - varint 0, then the 16 raw bytes of a well-formed md5 fingerprint; or
+                varint (length + 1), then the key text, for any other key.
+              - varint: number of timespans
+              - for each timespan: zigzag varint (start - previous timestamp), varint (end - start).
+                The previous timestamp is the end of the timespan before, or 0 at the start of the block.
+
+  index: 'I', then the compressed length and CRC32 of the uncompressed data (2 x uint32),
+      then the compressed data:
+      - varint: number of blocks
+      - for each block: varint file offset, varint number of services, varint number of observations,
+        then the first and last service names, each as a varint length and the name.
+
+  footer: the file offset of the index (uint64), then INDEX_MAGIC.
+
+Varints are unsigned, seven bits per byte with the lowest bits first;
+the high bit of each byte is set if more bytes follow.
+"""
+
+import binascii
+import re
+import struct
+import zlib
+
+
+MAGIC = 'NOTARYSNAPSHOT\r\n'
+INDEX_MAGIC = 'NOTARYINDEX\r\n'
+VERSION = 1
+COMPRESSION_ZLIB = 1
+DEFAULT_BLOCK_SIZE = 20000 # observations
+COMPRESSION_LEVEL = 6
+
+FINGERPRINT_LENGTH = 16 # bytes
+# keys that convert to FINGERPRINT_LENGTH bytes and back to exactly the same text.
+# cheaper to check than converting each key with notary_reply, which matters when exporting millions of keys.
+MD5_FINGERPRINT = re.compile('^[0-9a-f]{2}(?::[0-9a-f]{2}){15}$')
+
+HEADER = struct.Struct('!BB')
+BLOCK_HEAD = struct.Struct('!cIII')
+INDEX_HEAD = struct.Struct('!cII')
+FOOTER = struct.Struct('!Q')
+
+BLOCK_MARKER = 'B'
+INDEX_MARKER = 'I'
+
+_SMALL_VARINTS = [chr(i) for i in xrange(0x80)]
+_HEX_BYTES = ['%02x' % i for i in xrange(0x100)]
+
+
+class SnapshotError(Exception):
+	"""The data being read is not a valid snapshot."""
+	pass
+
+
+def is_snapshot(head):
+	"""Return True if head, the first bytes of a file, is the start of a snapshot."""
+	return head.startswith(MAGIC)
+
+def _varint(value):
+	"""Return an unsigned integer encoded as a varint."""
+	if (value < 0x80):
+		return _SMALL_VARINTS[value]
+	# timestamps and durations usually fit in four bytes; write those without a loop
+	if (value < 0x10000000):
+		if (value < 0x4000):
+			return chr((value & 0x7f) | 0x80) + chr(value >> 7)
+		if (value < 0x200000):
+			return chr((value & 0x7f) | 0x80) + chr(((value >> 7) & 0x7f) | 0x80) + chr(value >> 14)
+		return chr((value & 0x7f) | 0x80) + chr(((value >> 7) & 0x7f) | 0x80) + chr(((value >> 14) & 0x7f) | 0x80) +\
+			chr(value >> 21)
+	data = []
+	while (value >= 0x80):
+		data.append(chr((value & 0x7f) | 0x80))
+		value >>= 7
+	data.append(chr(value))
+	return ''.join(data)
+
+def _read_varint(data, pos):
+	"""Read a varint from bytearray data at pos. Return (value, position after it)."""
+	byte = data[pos]
+	if (byte < 0x80):
+		return (byte, pos + 1)
+	value = byte & 0x7f
+	shift = 7
+	while True:
+		pos += 1
+		byte = data[pos]
+		value |= (byte & 0x7f) << shift
+		if (byte < 0x80):
+			return (value, pos + 1)
+		shift += 7
+
+def _name(name):
+	"""Return a length-prefixed name."""
+	return _varint(len(name)) + name
+
+def _read_name(data, pos):
+	(length, pos) = _read_varint(data, pos)
+	return (str(data[pos:pos + length]), pos + length)
+
+
+class SnapshotWriter(object):
+	"""
+	Write services and their observations to a snapshot file.
+
+	Call write_service() for each service, in order of service name, then close().
+	Services are gathered into blocks of about block_size observations,
+	so only one block is ever held in memory.
+	"""
+
+	def __init__(self, output_file, block_size=DEFAULT_BLOCK_SIZE):
+		self.output_file = output_file
+		self.block_size = block_size
+		self.offset = 0
+		self.index = []
+		self.num_services = 0
+		self.num_observations = 0
+		self.last_service = None
+		self._write(MAGIC + HEADER.pack(VERSION, COMPRESSION_ZLIB))
+		self._start_block()
+
+	def _write(self, data):
+		self.output_file.write(data)
+		self.offset += len(data)
+
+	def _start_block(self):
+		self.block = []
+		self.block_services = []
+		self.block_observations = 0
+		self.previous_name = ''
+		self.previous_time = 0
+
+	def write_service(self, service, keys):
+		"""
+		Add a service.
+		'keys': a list of (key, timespans) tuples, where timespans is a list of (start, end) tuples.
+		Timespans may be in any order, but they take less space when sorted by start time.
+		Raises ValueError if the service is out of order or a timespan is invalid;
+		the snapshot can't be finished after that.
+		"""
+		if (isinstance(service, unicode)):
+			service = service.encode('utf-8')
+		if (self.last_service != None and service <= self.last_service):
+			raise ValueError("Service '{0}' must sort after '{1}'.".format(service, self.last_service))
+		self.last_service = service
+
+		# this runs for every service in the database, so look everything up only once
+		append = self.block.append
+		varint = _varint
+		shared = 0
+		for (a, b) in zip(service, self.previous_name):
+			if (a != b):
+				break
+			shared += 1
+		append(varint(shared) + _name(service[shared:]) + varint(len(keys)))
+
+		previous_time = self.previous_time
+		for (key, timespans) in keys:
+			if (isinstance(key, unicode)):
+				key = key.encode('utf-8')
+			if (MD5_FINGERPRINT.match(key)):
+				append('\x00' + binascii.unhexlify(key.replace(':', '')) + varint(len(timespans)))
+			else:
+				append(varint(len(key) + 1) + key + varint(len(timespans)))
+			for (start, end) in timespans:
+				if (start < 0 or end < start):
+					raise ValueError("Invalid timespan ({0}, {1}) for service '{2}'.".format(start, end, service))
+				delta = start - previous_time
+				# zigzag: interleave positive and negative deltas so small ones of either sign stay short
+				append(varint(delta << 1 if delta >= 0 else ((-delta) << 1) - 1) + varint(end - start))
+				previous_time = end
+			self.block_observations += len(timespans)
+
+		self.previous_time = previous_time
+		self.previous_name = service
+		self.block_services.append(service)
+		if (self.block_observations >= self.block_size):
+			self._finish_block()
+
+	def _finish_block(self):
+		if (len(self.block_services) == 0):
+			return
+		data = _varint(len(self.block_services)) + ''.join(self.block)
+		compressed = zlib.compress(data, COMPRESSION_LEVEL)
+		self.index.append((self.offset, len(self.block_services), self.block_observations,
+			self.block_services[0], self.block_services[-1]))
+		self.num_services += len(self.block_services)
+		self.num_observations += self.block_observations
+		self._write(BLOCK_HEAD.pack(BLOCK_MARKER, len(compressed), len(data), zlib.crc32(data) & 0xffffffff))
+		self._write(compressed)
+		self._start_block()
+
+	def close(self):
+		"""Write the last block, the index, and the footer. Does not close the output file."""
+		self._finish_block()
+		index_offset = self.offset
+		data = [_varint(len(self.index))]
+		for (offset, num_services, num_observations, first, last) in self.index:
+			data.append(_varint(offset) + _varint(num_services) + _varint(num_observations) + _name(first) + _name(last))
+		data = ''.join(data)
+		compressed = zlib.compress(data, COMPRESSION_LEVEL)
+		self._write(INDEX_HEAD.pack(INDEX_MARKER, len(compressed), zlib.crc32(data) & 0xffffffff))
+		self._write(compressed)
+		self._write(FOOTER.pack(index_offset) + INDEX_MAGIC)
+
+
+class SnapshotReader(object):
+	"""
+	Read services and their observations from a snapshot file.
+
+	read_services() reads the file from start to end, so it also works on pipes.
+	get_index() and reading with an after_service need a file that can seek.
+	"""
+
+	def __init__(self, input_file, head=''):
+		"""
+		'head': any bytes already read from the start of input_file, e.g. to check is_snapshot().
+		"""
+		self.input_file = input_file
+		start = head + self._read(len(MAGIC) + HEADER.size - len(head))
+		if (not is_snapshot(start)):
+			raise SnapshotError("'{0}' is not a notary snapshot.".format(getattr(input_file, 'name', input_file)))
+		(self.version, self.compression) = HEADER.unpack(start[len(MAGIC):])
+		if (self.version != VERSION or self.compression != COMPRESSION_ZLIB):
+			raise SnapshotError("Unsupported snapshot version {0} with compression {1}.".format(
+				self.version, self.compression))
+		self.index = None
+
+	def _read(self, size):
+		data = self.input_file.read(size)
+		if (len(data) != size):
+			raise SnapshotError("Snapshot is truncated.")
+		return data
+
+	def _decompress(self, compressed, crc):
+		try:
+			data = zlib.decompress(compressed)
+		except zlib.error as e:
+			raise SnapshotError("Snapshot block is corrupt: {0}".format(e))
+		if (zlib.crc32(data) & 0xffffffff != crc):
+			raise SnapshotError("Snapshot block failed its checksum.")
+		return data
+
+	def get_index(self):
+		"""
+		Return a list of (offset, number of services, number of observations, first service, last service)
+		for each block, or None if the file can't seek.
+		"""
+		if (self.index != None):
+			return self.index
+		try:
+			position = self.input_file.tell()
+			self.input_file.seek(-(FOOTER.size + len(INDEX_MAGIC)), 2)
+		except (IOError, OSError):
+			return None
+
+		footer = self._read(FOOTER.size + len(INDEX_MAGIC))
+		if (footer[FOOTER.size:] != INDEX_MAGIC):
+			raise SnapshotError("Snapshot index is missing; the file may be truncated.")
+		self.input_file.seek(FOOTER.unpack(footer[:FOOTER.size])[0])
+		(marker, length, crc) = INDEX_HEAD.unpack(self._read(INDEX_HEAD.size))
+		if (marker != INDEX_MARKER):
+			raise SnapshotError("Snapshot footer does not point to the index.")
+		data = bytearray(self._decompress(self._read(length), crc))
+		self.input_file.seek(position)
+
+		try:
+			(num_blocks, pos) = _read_varint(data, 0)
+			index = []
+			for i in xrange(num_blocks):
+				(offset, pos) = _read_varint(data, pos)
+				(num_services, pos) = _read_varint(data, pos)
+				(num_observations, pos) = _read_varint(data, pos)
+				(first, pos) = _read_name(data, pos)
+				(last, pos) = _read_name(data, pos)
+				index.append((offset, num_services, num_observations, first, last))
+		except IndexError:
+			raise SnapshotError("Snapshot index is corrupt.")
+		self.index = index
+		return index
+
+	def read_services(self, after_service=None):
+		"""
+		Yield (service, keys) for each service in the snapshot, in order of service name,
+		where keys is a list of (key, timespans) tuples.
+
+		If after_service is given, start with the first service whose name sorts after it,
+		using the index to skip the blocks before it.
+		"""
+		if (after_service != None):
+			index = self.get_index()
+			if (index == None):
+				raise SnapshotError("Can only start after a service when reading a file, not a pipe.")
+			blocks = [entry for entry in index if entry[4] > after_service]
+			if (len(blocks) == 0):
+				return
+			self.input_file.seek(blocks[0][0])
+
+		while True:
+			marker = self._read(1)
+			if (marker == INDEX_MARKER):
+				return
+			if (marker != BLOCK_MARKER):
+				raise SnapshotError("Snapshot block is corrupt.")
+			(marker, length, size, crc) = BLOCK_HEAD.unpack(marker + self._read(BLOCK_HEAD.size - 1))
+			data = self._decompress(self._read(length), crc)
+			if (len(data) != size):
+				raise SnapshotError("Snapshot block has the wrong size.")
+			for (service, keys) in self._read_block(bytearray(data)):
+				if (after_service == None or service > after_service):
+					yield (service, keys)
+
+	def _read_block(self, data):
+		"""Return a list of (service, keys) decoded from the uncompressed data of one block."""
+		# this runs for every observation in the snapshot, so it reads the most common
+		# one-byte values itself instead of calling _read_varint()
+		services = []
+		hex_bytes = _HEX_BYTES
+		read_varint = _read_varint
+		name = ''
+		previous_time = 0
+		try:
+			(num_services, pos) = read_varint(data, 0)
+			for i in xrange(num_services):
+				(shared, pos) = read_varint(data, pos)
+				(suffix, pos) = _read_name(data, pos)
+				name = name[:shared] + suffix
+				(num_keys, pos) = read_varint(data, pos)
+				keys = []
+				for k in xrange(num_keys):
+					if (data[pos] == 0):
+						pos += 1 + FINGERPRINT_LENGTH
+						key = ':'.join([hex_bytes[byte] for byte in data[pos - FINGERPRINT_LENGTH:pos]])
+					else:
+						(length, pos) = read_varint(data, pos)
+						key = str(data[pos:pos + length - 1])
+						pos += length - 1
+					num_timespans = data[pos]
+					if (num_timespans < 0x80):
+						pos += 1
+					else:
+						(num_timespans, pos) = read_varint(data, pos)
+					timespans = []
+					for t in xrange(num_timespans):
+						delta = data[pos]
+						if (delta < 0x80):
+							pos += 1
+						else:
+							(delta, pos) = read_varint(data, pos)
+						duration = data[pos]
+						if (duration < 0x80):
+							pos += 1
+						else:
+							(duration, pos) = read_varint(data, pos)
+						if (delta & 1):
+							previous_time -= (delta + 1) >> 1
+						else:
+							previous_time += delta >> 1
+						timespans.append((previous_time, previous_time + duration))
+						previous_time += duration
+					keys.append((key, timespans))
+				services.append((name, keys))
+		except IndexError:
+			raise SnapshotError("Snapshot block is corrupt.")
+		if (pos != len(data)):
+			raise SnapshotError("Snapshot block has unexpected data at the end.")
+		return services
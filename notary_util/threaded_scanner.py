@@ -31,50 +31,168 @@ import time
 
 import notary_common
 import notary_logs
-from notary_db import ndb
+from notary_db import ndb, SchemaError
 
 # TODO: HACK
 # add ..\util to the import path so we can import ssl_scan_sock
 sys.path.insert(0,
 	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from util.ssl_scan_async import AsyncScanner, DEFAULT_MAX_CONNECTIONS
 from util.ssl_scan_sock import attempt_observation_for_service, SSLScanTimeoutException, SSLAlertException
 
 DEFAULT_SCANS = 10
 DEFAULT_WAIT = 20
 DEFAULT_INFILE = "-"
 LOGFILE = "scanner.log"
+DEFAULT_MAX_PENDING = 10000
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_WAIT = 1 # seconds
 
 stats = None
-results = None
+writer = None
 
-class ResultStore(object):
+
+# functions to help with argument validation.
+# as in notary_http, the names appear in argparse's error messages
+# (e.g. "invalid positive_integer value: '0'").
+def positive_integer(value):
+	"""Convert value to a positive integer, or raise an exception if we cannot."""
+	ivalue = int(value)
+	if ivalue < 1:
+		raise argparse.ArgumentTypeError("'{0}' is not a positive integer.".format(value))
+	return ivalue
+
+def positive_number(value):
+	"""Convert value to a number > 0, or raise an exception if we cannot."""
+	fvalue = float(value)
+	if fvalue <= 0:
+		raise argparse.ArgumentTypeError("'{0}' is not a positive number.".format(value))
+	return fvalue
+
+
+class ResultWriter(threading.Thread):
 	"""
-	Store and retrieve observation results in a thread-safe way.
+	Save scan results to the database from a separate thread,
+	so slow database writes don't hold up scanning.
+
+	Results are written in batches of up to batch_size,
+	or sooner once the oldest waiting result is batch_wait seconds old.
+	Scanners should call wait_for_room() or has_room() before starting new scans,
+	so results can't pile up without limit if the database falls behind.
 	"""
-	def __init__(self):
-		self.results = []
-		self.lock = threading.Lock()
+	def __init__(self, db, max_pending=DEFAULT_MAX_PENDING, batch_size=DEFAULT_BATCH_SIZE, batch_wait=DEFAULT_BATCH_WAIT):
+		# an empty batch means the writer has stopped, and with no room for results scanning would never continue
+		if (max_pending < 1):
+			raise ValueError("ResultWriter must allow at least one pending result.")
+		if (batch_size < 1):
+			raise ValueError("ResultWriter batches must hold at least one result.")
+		if (batch_wait < 0):
+			raise ValueError("ResultWriter batch wait cannot be negative.")
+
+		threading.Thread.__init__(self, name="ResultWriter")
+		self.daemon = True
+		self.db = db
+		self.max_pending = max_pending
+		self.batch_size = batch_size
+		self.batch_wait = batch_wait
+
+		self.cond = threading.Condition()
+		self.pending = [] # (result, time added)
+		self.stopping = False
+		self.finished = False # the thread has written everything and exited
+		self.written_count = 0
+		self.batch_count = 0
+		self.last_lag = 0.0
+		self.max_lag = 0.0
 
 	def add(self, result):
 		"""
-		Add a result to the set.
+		Queue a result to be written.
+		This never blocks, so results from scans that are already running are never lost;
+		use wait_for_room() to hold off starting new scans.
+		Results added after the writer has stopped are written straight away by the caller.
 		"""
-		with self.lock:
-			self.results.append(result)
+		with self.cond:
+			if not (self.finished):
+				self.pending.append((result, time.time()))
+				self.cond.notify_all()
+				return
+
+		# e.g. a scan that was still running when we gave up waiting for scans
+		logging.warning("Result for '{0}' arrived after the result writer stopped; writing it now.".format(result[0]))
+		self._write([(result, time.time())])
+
+	def has_room(self):
+		"""Return True if there is room for more results."""
+		with self.cond:
+			return len(self.pending) < self.max_pending
+
+	def wait_for_room(self):
+		"""Wait until there is room for more results."""
+		with self.cond:
+			while (len(self.pending) >= self.max_pending and not self.stopping):
+				self.cond.wait()
+
+	def stop(self):
+		"""Write any remaining results and stop the thread."""
+		with self.cond:
+			self.stopping = True
+			self.cond.notify_all()
+		self.join()
+
+	def get_stats(self):
+		"""Return a dictionary of statistics about written results."""
+		with self.cond:
+			return {
+				'pending': len(self.pending),
+				'written': self.written_count,
+				'batches': self.batch_count,
+				'last_lag': self.last_lag,
+				'max_lag': self.max_lag,
+			}
+
+	def _next_batch(self):
+		"""Wait for a full batch, or for the oldest result to have waited long enough, and return it."""
+		with self.cond:
+			while not (self.stopping):
+				if (len(self.pending) >= self.batch_size):
+					break
+				if (len(self.pending) > 0):
+					remaining = self.pending[0][1] + self.batch_wait - time.time()
+					if (remaining <= 0):
+						break
+					self.cond.wait(remaining)
+				else:
+					self.cond.wait()
+
+			batch = self.pending[:self.batch_size]
+			del self.pending[:self.batch_size]
+			if (len(batch) == 0):
+				# add() can't give us any more results once we return
+				self.finished = True
+			# let scanners waiting for room continue
+			self.cond.notify_all()
+			return batch
 
-	def get(self):
-		"""
-		Return the list of existing results
-		and empty the set.
-		"""
-		# use a lock so we don't lose any results
-		# between retrieving the current set
-		# and adding new ones
-		with self.lock:
-			# copy existing results so we can clear the list
-			results_so_far = list(self.results)
-			self.results = []
-			return results_so_far
+	def run(self):
+		while True:
+			batch = self._next_batch()
+			if (len(batch) == 0):
+				# we only return an empty batch once we've been stopped
+				return
+			self._write(batch)
+
+	def _write(self, batch):
+		"""Write a batch of (result, time added) tuples to the database and update the statistics."""
+		_record_observations_in_db(self.db, [result for (result, added) in batch])
+
+		# lag: how long the oldest result in the batch waited to be saved
+		lag = time.time() - batch[0][1]
+		with self.cond:
+			self.written_count += len(batch)
+			self.batch_count += 1
+			self.last_lag = lag
+			self.max_lag = max(self.max_lag, lag)
 
 class ScanThread(threading.Thread): 
 	"""
@@ -90,57 +208,21 @@ class ScanThread(threading.Thread):
 		self.sni = sni
 		self.global_stats.threads[sid] = time.time() 
 
-	def _get_errno(self, e):
-		"""
-		Return the error number attached to an Exception,
-		or 0 if none exists.
-		"""
-		try: 
-			return e.args[0]
-		except Exception:
-			return 0 # no error
-
-	def _record_failure(self, e):
-		"""Record an exception that happened during a scan."""
-		stats.failures += 1
-		self.db.report_metric('ServiceScanFailure', str(e))
-		if (isinstance(e, SSLScanTimeoutException)):
-			stats.failure_timeouts += 1
-			return
-		if (isinstance(e, SSLAlertException)):
-			stats.failure_ssl_alert += 1
-			return
-		if (isinstance(e, ValueError)):
-			stats.failure_other += 1
-			return
-
-		err = self._get_errno(e)
-		if err == errno.ECONNREFUSED or err == errno.EINVAL:
-			stats.failure_conn_refused += 1
-		elif err == errno.EHOSTUNREACH or err == errno.ENETUNREACH: 
-			stats.failure_no_route += 1
-		elif err == errno.ECONNRESET: 
-			stats.failure_conn_reset += 1
-		elif err == -2 or err == -3 or err == -5 or err == 8: 
-			stats.failure_dns += 1
-		else: 	
-			stats.failure_other += 1
-
 	def run(self):
 		"""
 		Scan a remote service and retrieve the fingerprint for its TLS certificate.
-		The fingerprint is appended to the global results list.
+		The fingerprint is passed to the global result writer.
 		"""
 		try:
 			fp = attempt_observation_for_service(self.sid, self.timeout_sec, self.sni)
 			if (fp != None):
-				results.add((self.sid, fp))
+				writer.add((self.sid, fp))
 			else:
 				# error already logged, but tally error count
 				stats.failures += 1
 				stats.failure_socket += 1
 		except Exception, e:
-			self._record_failure(e)
+			_record_failure(self.db, e)
 			logging.error("Error scanning '{0}' - {1}".format(self.sid, e))
 			logging.exception(e)
 
@@ -173,6 +255,69 @@ class GlobalStats(object):
 		self.failure_other = 0 
 	
 
+def _get_errno(e):
+	"""
+	Return the error number attached to an Exception,
+	or 0 if none exists.
+	"""
+	try: 
+		return e.args[0]
+	except Exception:
+		return 0 # no error
+
+def _record_failure(db, e):
+	"""Record an exception that happened during a scan."""
+	stats.failures += 1
+	db.report_metric('ServiceScanFailure', str(e))
+	if (isinstance(e, SSLScanTimeoutException)):
+		stats.failure_timeouts += 1
+		return
+	if (isinstance(e, SSLAlertException)):
+		stats.failure_ssl_alert += 1
+		return
+	if (isinstance(e, ValueError)):
+		stats.failure_other += 1
+		return
+
+	err = _get_errno(e)
+	if err == errno.ECONNREFUSED or err == errno.EINVAL:
+		stats.failure_conn_refused += 1
+	elif err == errno.EHOSTUNREACH or err == errno.ENETUNREACH: 
+		stats.failure_no_route += 1
+	elif err == errno.ECONNRESET: 
+		stats.failure_conn_reset += 1
+	elif err == -2 or err == -3 or err == -5 or err == 8: 
+		stats.failure_dns += 1
+	else: 	
+		stats.failure_other += 1
+
+def _log_progress(start_time):
+	"""Log how many scans have finished and why any have failed."""
+	so_far = int(time.time() - start_time)
+	logging.info("%s seconds passed.  %s complete, %s " \
+		"failures.  %s Active threads" % \
+		(so_far, stats.num_completed,
+		stats.failures, stats.active_threads))
+	logging.info("  details: timeouts = %s, " \
+		"ssl-alerts = %s, no-route = %s, " \
+		"conn-refused = %s, conn-reset = %s,"\
+		"dns = %s, socket = %s, other = %s" % \
+		(stats.failure_timeouts,
+		stats.failure_ssl_alert,
+		stats.failure_no_route,
+		stats.failure_conn_refused,
+		stats.failure_conn_reset,
+		stats.failure_dns,
+		stats.failure_socket,
+		stats.failure_other))
+	writer_stats = writer.get_stats()
+	logging.info("  results: written = %s, pending = %s, " \
+		"write lag = %.1fs, max write lag = %.1fs" % \
+		(writer_stats['written'],
+		writer_stats['pending'],
+		writer_stats['last_lag'],
+		writer_stats['max_lag']))
+
 def _record_observations_in_db(db, results):
 	"""
 	Record a set of service observations in the database.
@@ -180,8 +325,7 @@ def _record_observations_in_db(db, results):
 	if len(results) == 0:
 		return
 	try:
-		for r in results:
-			db.report_observation(r[0], r[1])
+		db.report_observations(results)
 	except Exception as e:
 		# TODO: we should probably retry here 
 		logging.critical("DB Error: Failed to write results of length {0}".format(
@@ -189,6 +333,94 @@ def _record_observations_in_db(db, results):
 		logging.exception(e)
 
 
+def _scan_with_threads(db, all_sids, rate, timeout_sec, sni, verbose, start_time):
+	"""Scan services by starting a new thread for each one."""
+	# create a thread to scan each service
+	# and record results as they come in
+	for sid in all_sids:
+		try:
+			# ignore non SSL services
+			# TODO: use a regex instead
+			if sid.split(",")[1] == notary_common.SSL_TYPE:
+				# don't start new scans while the database is falling behind
+				writer.wait_for_room()
+				stats.num_started += 1
+				t = ScanThread(db, sid, stats, timeout_sec, sni)
+				t.start()
+
+			if (stats.num_started % rate) == 0:
+				time.sleep(1)
+				_log_progress(start_time)
+
+			if stats.num_started  % 1000 == 0:
+				if (verbose):
+					logging.info("long running threads")
+					cur_time = time.time()
+					for sid in stats.threads.keys():
+						spawn_time = stats.threads.get(sid, cur_time)
+						duration = cur_time - spawn_time
+						if duration > 20:
+							logging.info("'%s' has been running for %s" %\
+							 (sid, duration))
+
+		except IndexError:
+			logging.error("Service '%s' has no index [1] after splitting on ','.\n" % (sid))
+		except KeyboardInterrupt:
+			exit(1)
+
+	# finishing the for-loop means we kicked-off all threads,
+	# but they may not be done yet.  Wait for a bit, if needed.
+	giveup_time = time.time() + (2 * timeout_sec)
+	while stats.active_threads > 0:
+		time.sleep(1)
+		if time.time() > giveup_time:
+			if stats.active_threads > 0:
+				logging.error("Giving up scans after {0}. {1} threads still active!".format(
+					giveup_time, stats.active_threads))
+			break
+
+def _scan_with_event_loop(db, all_sids, rate, timeout_sec, sni, max_connections, start_time):
+	"""
+	Scan services with a single event loop rather than one thread per service.
+	"""
+	def ssl_sids():
+		for sid in all_sids:
+			try:
+				# ignore non SSL services
+				# TODO: use a regex instead
+				if sid.split(",")[1] != notary_common.SSL_TYPE:
+					continue
+			except IndexError:
+				logging.error("Service '%s' has no index [1] after splitting on ','.\n" % (sid))
+				continue
+			stats.num_started += 1
+			stats.active_threads += 1
+			yield sid
+
+	def on_result(sid, fp, error):
+		if (fp != None):
+			writer.add((sid, fp))
+		else:
+			_record_failure(db, error)
+			logging.error("Error scanning '{0}' - {1}".format(sid, error))
+		stats.num_completed += 1
+		stats.active_threads -= 1
+
+	scanner = AsyncScanner(timeout_sec, sni, max_connections)
+	# don't start new scans while the database is falling behind
+	t = threading.Thread(target=scanner.scan, args=(ssl_sids(), rate, on_result, writer.has_room))
+	t.daemon = True
+	t.start()
+
+	# every scan has its own timeout, so the event loop always finishes
+	try:
+		while t.is_alive():
+			t.join(1)
+			_log_progress(start_time)
+	except KeyboardInterrupt:
+		exit(1)
+
+
 def get_parser():
 	"""Return an argument parser for this module."""
 	parser = argparse.ArgumentParser(parents=[ndb.get_parser()],
@@ -203,6 +435,18 @@ def get_parser():
 	parser.add_argument('--sni', action='store_true', default=False,
 				help="use Server Name Indication. See section 3.1 of http://www.ietf.org/rfc/rfc4366.txt.\
 				Default: \'%(default)s\'")
+	parser.add_argument('--async', action='store_true', default=False, dest='async_scan',
+				help="Run all scans from a single event loop instead of starting a thread for each service.\
+				This uses far less memory and can keep many more scans in progress at once.\
+				Default: \'%(default)s\'")
+	parser.add_argument('--max-connections', default=DEFAULT_MAX_CONNECTIONS, type=int, metavar='MAX_CONNECTIONS',
+				help="With --async, the most scans to have in progress at once. Default: %(default)s.")
+	parser.add_argument('--max-pending-results', default=DEFAULT_MAX_PENDING, type=positive_integer, metavar='MAX_PENDING',
+				help="Stop starting new scans while this many results are waiting to be saved to the database. Default: %(default)s.")
+	parser.add_argument('--write-batch-size', default=DEFAULT_BATCH_SIZE, type=positive_integer, metavar='BATCH_SIZE',
+				help="Save at most this many results to the database at a time. Default: %(default)s.")
+	parser.add_argument('--write-interval', default=DEFAULT_BATCH_WAIT, type=positive_number, metavar='SECONDS',
+				help="Save results to the database at least this often, even if there are fewer than a full batch. Default: %(default)s.")
 	parser.add_argument('--logfile', action='store_true', default=False,
 				help="Log to a file on disk rather than standard out.\
 				A rotating set of {0} logs will be used, each capturing up to {1} bytes.\
@@ -220,17 +464,19 @@ def get_parser():
 
 
 def main(db, service_id_file, logfile=False, verbose=False, quiet=False, rate=DEFAULT_SCANS,
-		timeout_sec=DEFAULT_WAIT, sni=False):
+		timeout_sec=DEFAULT_WAIT, sni=False, async_scan=False, max_connections=DEFAULT_MAX_CONNECTIONS,
+		max_pending=DEFAULT_MAX_PENDING, batch_size=DEFAULT_BATCH_SIZE, batch_wait=DEFAULT_BATCH_WAIT):
 	"""
 	Run the main program.
 	Scan a list of services and update Observation records in the notary database.
 	"""
 
 	global stats
-	global results
+	global writer
 
 	stats = GlobalStats()
-	results = ResultStore()
+	writer = ResultWriter(db, max_pending, batch_size, batch_wait)
+	writer.start()
 
 	notary_logs.setup_logs(logfile, LOGFILE, verbose=verbose, quiet=quiet)
 
@@ -247,81 +493,33 @@ def main(db, service_id_file, logfile=False, verbose=False, quiet=False, rate=DE
 	    (timeout_sec, rate))
 	db.report_metric('ServiceScanStart', "ServiceCount: " + str(len(all_sids)))
 
-	# create a thread to scan each service
-	# and record results as they come in
-	for sid in all_sids:
-		try:
-			# ignore non SSL services
-			# TODO: use a regex instead
-			if sid.split(",")[1] == notary_common.SSL_TYPE:
-				stats.num_started += 1
-				t = ScanThread(db, sid, stats, timeout_sec, sni)
-				t.start()
+	if (async_scan):
+		_scan_with_event_loop(db, all_sids, rate, timeout_sec, sni, max_connections, start_time)
+	else:
+		_scan_with_threads(db, all_sids, rate, timeout_sec, sni, verbose, start_time)
 
-			if (stats.num_started % rate) == 0:
-				time.sleep(1)
-				_record_observations_in_db(db, results.get())
-
-				so_far = int(time.time() - start_time)
-				logging.info("%s seconds passed.  %s complete, %s " \
-					"failures.  %s Active threads" % \
-					(so_far, stats.num_completed,
-					stats.failures, stats.active_threads))
-				logging.info("  details: timeouts = %s, " \
-					"ssl-alerts = %s, no-route = %s, " \
-					"conn-refused = %s, conn-reset = %s,"\
-					"dns = %s, socket = %s, other = %s" % \
-					(stats.failure_timeouts,
-					stats.failure_ssl_alert,
-					stats.failure_no_route,
-					stats.failure_conn_refused,
-					stats.failure_conn_reset,
-					stats.failure_dns,
-					stats.failure_socket,
-					stats.failure_other))
-
-			if stats.num_started  % 1000 == 0:
-				if (verbose):
-					logging.info("long running threads")
-					cur_time = time.time()
-					for sid in stats.threads.keys():
-						spawn_time = stats.threads.get(sid, cur_time)
-						duration = cur_time - spawn_time
-						if duration > 20:
-							logging.info("'%s' has been running for %s" %\
-							 (sid, duration))
-
-		except IndexError:
-			logging.error("Service '%s' has no index [1] after splitting on ','.\n" % (sid))
-		except KeyboardInterrupt:
-			exit(1)
-
-	# finishing the for-loop means we kicked-off all threads,
-	# but they may not be done yet.  Wait for a bit, if needed.
-	giveup_time = time.time() + (2 * timeout_sec)
-	while stats.active_threads > 0:
-		time.sleep(1)
-		if time.time() > giveup_time:
-			if stats.active_threads > 0:
-				logging.error("Giving up scans after {0}. {1} threads still active!".format(
-					giveup_time, stats.active_threads))
-			break
-
-	# record any observations made since we finished the
-	# main for-loop
-	_record_observations_in_db(db, results.get())
+	# record any observations that haven't been written yet
+	writer.stop()
 
 	duration = int(time.time() - start_time)
 	localtime = time.asctime(time.localtime(start_time))
 	print("Ending scan at: %s" % localtime)
 	print("Scan of %s services took %s seconds.  %s Failures" % \
 		(stats.num_started, duration, stats.failures))
+	cache_stats = db.get_service_id_cache_stats()
+	print("Service ID cache: %s hits, %s misses" % \
+		(cache_stats['hits'], cache_stats['misses']))
 	db.report_metric('ServiceScanStop')
 	exit(0)
 
 if __name__ == "__main__":
 	args = get_parser().parse_args()
 	# pass ndb the args so it can use any relevant ones from its own parser
-	db = ndb(args)
+	try:
+		db = ndb(args)
+	except SchemaError as e:
+		print(e, file=sys.stderr)
+		exit(1)
 	main(db, args.service_id_file, args.logfile, args.verbose, args.quiet, args.scans,
-		args.timeout, args.sni)
+		args.timeout, args.sni, args.async_scan, args.max_connections,
+		args.max_pending_results, args.write_batch_size, args.write_interval)
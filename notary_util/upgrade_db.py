@@ -0,0 +1,61 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Upgrade a network notary database created by an older version to the current schema.
+
+Adds any missing columns and indexes, then fills in each service's most recent observation
+(t_services.last_seen, current_key, and current_observation_id).
+It is safe to run more than once.
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from notary_db import ndb
+
+
+DEFAULT_BATCH_SIZE = 10000 # services
+
+def get_parser():
+	"""Return an argument parser for this module."""
+	parser = argparse.ArgumentParser(parents=[ndb.get_parser()],
+	description=__doc__,
+	epilog="See doc/upgrades/ for the steps needed to upgrade from each version.")
+
+	parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, metavar='SERVICES',
+				help="Update this many services in each transaction. Default: %(default)s")
+	return parser
+
+def main(db, batch_size=DEFAULT_BATCH_SIZE):
+	"""Run the main program."""
+	added = db.upgrade_schema()
+	if (len(added) > 0):
+		print("Added column(s) {0}.".format(", ".join(added)))
+
+	start_time = time.time()
+	print("Filling in the most recent observation for {0} services...".format(db.count_services()))
+	count = db.backfill_service_state(batch_size)
+	print("Done in {0:.1f} seconds. {1} services have observations.".format(time.time() - start_time, count))
+
+if __name__ == "__main__":
+	args = get_parser().parse_args()
+	# pass ndb the args so it can use any relevant ones from its own parser.
+	# don't refuse to open the database for being out of date - that's what we're here to fix.
+	db = ndb(args, check_schema=False)
+	main(db, args.batch_size)
@@ -0,0 +1,123 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the memory used by pycache to store notary replies as XML
+and as compact cache entries from notary_reply.build_cache_entry(),
+and the time taken to render a cached entry back to XML.
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+# TODO: HACK
+# add ..\notary_util and ..\util to the import path
+import sys
+import os
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from M2Crypto import RSA
+
+from notary_util import notary_common
+from notary_util import notary_reply
+from util import crypto
+from util import keygen
+from util import pycache
+
+
+DEFAULT_TIMESPANS = [1, 10, 100, 1000]
+DEFAULT_ENTRIES = 1000
+SERVICE_TYPE = notary_common.SSL_TYPE
+MAX_KEYS = 5
+EXPIRY = 60 * 60 # seconds
+
+
+def make_keys(num_timespans):
+	"""Create a list of (key, timespans) with num_timespans timespans spread across a few keys."""
+	num_keys = min(num_timespans, MAX_KEYS)
+	keys = []
+	start = 1400000000
+	for k in range(num_keys):
+		fp = ':'.join(['%02x' % ((k + b) % 256) for b in range(16)])
+		timespans = []
+		for t in range(num_timespans // num_keys + (1 if k < num_timespans % num_keys else 0)):
+			timespans.append((start, start + 3600))
+			start += 7200
+		keys.append((fp, timespans))
+	return keys
+
+def bytes_per_entry(values):
+	"""Store each (service, value) pair in pycache and return the average bytes used per entry."""
+	pycache.clear()
+	pycache.set_cache_size(1024 * 1024 * 1024)
+	for (service, value) in values:
+		pycache.set(service, value, EXPIRY)
+	used = pycache.get_cache_size()
+	count = pycache.get_cache_count()
+	pycache.clear()
+	return float(used) / count
+
+def time_render(entry, seconds):
+	"""Return the average number of seconds taken to render one cache entry."""
+	runs = 0
+	start = time.time()
+	while (time.time() - start < seconds):
+		notary_reply.render_cache_entry(entry)
+		runs += 1
+	return (time.time() - start) / runs
+
+def main(timespan_counts, num_entries, seconds):
+	# generate the key in-process so we don't depend on the version of the openssl binary
+	rsa = RSA.gen_key(keygen.NEW_KEY_LENGTH, 65537, lambda *args: None)
+	signer = crypto.Signer(rsa.as_pem(cipher=None))
+
+	print("{0:>10} {1:>12} {2:>14} {3:>8} {4:>12}".format(
+		"timespans", "xml (bytes)", "entry (bytes)", "saving", "render (ms)"))
+	for num_timespans in timespan_counts:
+		keys = make_keys(num_timespans)
+		xml_values = []
+		entry_values = []
+		for i in range(num_entries):
+			service = "host{0}.example.com:443,{1}".format(i, SERVICE_TYPE)
+			entry = notary_reply.build_cache_entry(service, SERVICE_TYPE, keys, signer)
+			xml = notary_reply.build_reply(service, SERVICE_TYPE, keys, signer)
+			if (notary_reply.render_cache_entry(entry) != xml):
+				print("ERROR: cache entry for {0} timespans does not render the same reply!".format(num_timespans),
+					file=sys.stderr)
+				exit(1)
+			xml_values.append((service, xml))
+			entry_values.append((service, entry))
+
+		xml_size = bytes_per_entry(xml_values)
+		entry_size = bytes_per_entry(entry_values)
+		render = time_render(entry_values[0][1], seconds)
+		print("{0:>10} {1:>12.0f} {2:>14.0f} {3:>7.0%} {4:>12.3f}".format(
+			num_timespans, xml_size, entry_size, 1 - (entry_size / xml_size), render * 1000))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--timespans', type=int, nargs='+', default=DEFAULT_TIMESPANS,
+		help="Number of timespans to put in each reply. Default: %(default)s")
+	parser.add_argument('--entries', type=int, default=DEFAULT_ENTRIES,
+		help="Number of entries to cache for each measurement. Default: %(default)s")
+	parser.add_argument('--seconds', type=float, default=1,
+		help="Number of seconds to measure rendering time for. Default: %(default)s")
+	args = parser.parse_args()
+	main(args.timespans, args.entries, args.seconds)
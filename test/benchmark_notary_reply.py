@@ -0,0 +1,143 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the time taken to build notary replies with xml.dom.minidom
+(the way notaries used to build them) and with notary_reply.build_reply().
+
+Signing is replaced with a fixed signature so only the XML and packing work is measured.
+"""
+
+from __future__ import print_function
+
+import argparse
+import struct
+import time
+from xml.dom.minidom import getDOMImplementation
+
+# TODO: HACK
+# add ..\notary_util to the import path
+import sys
+import os
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from notary_util import notary_common
+from notary_util import notary_reply
+
+
+DEFAULT_TIMESPANS = [1, 100, 10000]
+DEFAULT_SECONDS = 2
+SERVICE = 'benchmark.example.com:443,2'
+SERVICE_TYPE = notary_common.SSL_TYPE
+MAX_KEYS = 5
+
+
+class FixedSigner(object):
+	"""Return the same signature for everything, so signing time doesn't skew results."""
+	def sign(self, content):
+		return 'c2lnbmF0dXJl'
+
+
+def minidom_reply(service, service_type, keys, signer):
+	"""Build a reply the same way calculate_service_xml() did before notary_reply existed."""
+	dom_impl = getDOMImplementation()
+	new_doc = dom_impl.createDocument(None, "notary_reply", None)
+	top_element = new_doc.documentElement
+	top_element.setAttribute("version", "1")
+	top_element.setAttribute("sig_type", "rsa-md5")
+
+	packed_data = ""
+
+	for (k, timespans) in keys:
+		key_elem = new_doc.createElement("key")
+		key_elem.setAttribute("type", notary_common.SERVICE_TYPES[service_type])
+		key_elem.setAttribute("fp", k)
+		top_element.appendChild(key_elem)
+		num_timespans = len(timespans)
+		head = struct.pack("BBBBB", (num_timespans >> 8) & 255, num_timespans & 255, 0, 16, 3)
+
+		fp_bytes = ""
+		for hex_byte in k.split(":"):
+			fp_bytes += struct.pack("B", int(hex_byte, 16))
+
+		ts_bytes = ""
+		for (ts_start, ts_end) in timespans:
+			ts_elem = new_doc.createElement("timestamp")
+			ts_elem.setAttribute("end", str(ts_end))
+			ts_elem.setAttribute("start", str(ts_start))
+			key_elem.appendChild(ts_elem)
+			ts_bytes += struct.pack("BBBB", ts_start >> 24 & 255,
+				ts_start >> 16 & 255,
+				ts_start >> 8 & 255,
+				ts_start & 255)
+			ts_bytes += struct.pack("BBBB", ts_end >> 24 & 255,
+				ts_end >> 16 & 255,
+				ts_end >> 8 & 255,
+				ts_end & 255)
+		packed_data = (head + fp_bytes + ts_bytes) + packed_data
+
+	packed_data = service.encode() + struct.pack("B", 0) + packed_data
+	top_element.setAttribute("sig", signer.sign(packed_data))
+	return top_element.toprettyxml()
+
+def make_keys(num_timespans):
+	"""Create a list of (key, timespans) with num_timespans timespans spread across a few keys."""
+	num_keys = min(num_timespans, MAX_KEYS)
+	keys = []
+	start = 1400000000
+	for k in range(num_keys):
+		fp = ':'.join(['%02x' % ((k + b) % 256) for b in range(16)])
+		timespans = []
+		for t in range(num_timespans // num_keys + (1 if k < num_timespans % num_keys else 0)):
+			timespans.append((start, start + 3600))
+			start += 7200
+		keys.append((fp, timespans))
+	return keys
+
+def time_builder(builder, keys, seconds):
+	"""Return the average number of seconds taken to build one reply."""
+	signer = FixedSigner()
+	runs = 0
+	start = time.time()
+	while (time.time() - start < seconds):
+		builder(SERVICE, SERVICE_TYPE, keys, signer)
+		runs += 1
+	return (time.time() - start) / runs
+
+def main(timespan_counts, seconds):
+	print("{0:>10} {1:>14} {2:>17} {3:>8}".format("timespans", "minidom (ms)", "notary_reply (ms)", "speedup"))
+	for num_timespans in timespan_counts:
+		keys = make_keys(num_timespans)
+
+		# make sure we're comparing equivalent output
+		if (minidom_reply(SERVICE, SERVICE_TYPE, keys, FixedSigner()) !=
+			notary_reply.build_reply(SERVICE, SERVICE_TYPE, keys, FixedSigner())):
+			print("ERROR: replies for {0} timespans do not match!".format(num_timespans), file=sys.stderr)
+			exit(1)
+
+		old = time_builder(minidom_reply, keys, seconds)
+		new = time_builder(notary_reply.build_reply, keys, seconds)
+		print("{0:>10} {1:>14.3f} {2:>17.3f} {3:>7.1f}x".format(num_timespans, old * 1000, new * 1000, old / new))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--timespans', type=int, nargs='+', default=DEFAULT_TIMESPANS,
+		help="Number of timespans to put in each reply. Default: %(default)s")
+	parser.add_argument('--seconds', type=float, default=DEFAULT_SECONDS,
+		help="Number of seconds to run each measurement for. Default: %(default)s")
+	args = parser.parse_args()
+	main(args.timespans, args.seconds)
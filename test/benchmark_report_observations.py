@@ -0,0 +1,93 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the time taken to record scan results one at a time with ndb.report_observation()
+and all at once with ndb.report_observations().
+
+Each method records results for its own set of new services,
+then records a second scan of the same services, which updates the existing observations.
+Use the usual database arguments to choose which database to test -
+e.g. '--dbname bench.sqlite' or '--dbtype postgresql ...'.
+The services added are left in the database.
+"""
+
+from __future__ import print_function
+
+import argparse
+import random
+import time
+
+# TODO: HACK
+# add ..\notary_util to the import path
+import sys
+import os
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from notary_util.notary_db import ndb
+
+
+DEFAULT_RESULTS = 10000
+
+
+def make_results(prefix, num_results):
+	"""Return a list of (service, fp) results for num_results new services."""
+	results = []
+	for i in range(num_results):
+		fp = ':'.join(['%02x' % random.randint(0, 255) for b in range(16)])
+		results.append(("{0}-{1}.example.com:443,2".format(prefix, i), fp))
+	return results
+
+def one_at_a_time(db, results):
+	for (service, fp) in results:
+		db.report_observation(service, fp)
+
+def all_at_once(db, results):
+	db.report_observations(results)
+
+def time_method(method, db, results):
+	"""Return the number of seconds taken to record results."""
+	start = time.time()
+	method(db, results)
+	return time.time() - start
+
+def main(db, num_results):
+	run_id = "bench{0}".format(int(time.time()))
+	print("{0:>22} {1:>10} {2:>14} {3:>10} {4:>14}".format(
+		"method", "new (s)", "new (res/s)", "update (s)", "update (res/s)"))
+
+	for (name, method) in [('report_observation', one_at_a_time), ('report_observations', all_at_once)]:
+		results = make_results("{0}-{1}".format(run_id, name), num_results)
+		count_before = db.count_observations()
+
+		new_time = time_method(method, db, results)
+		# make sure the second scan gets a later end time
+		time.sleep(1.1)
+		update_time = time_method(method, db, results)
+
+		if (db.count_observations() - count_before != num_results):
+			print("ERROR: {0} recorded the wrong number of observations!".format(name), file=sys.stderr)
+			exit(1)
+		print("{0:>22} {1:>10.2f} {2:>14.0f} {3:>10.2f} {4:>14.0f}".format(
+			name, new_time, num_results / new_time, update_time, num_results / update_time))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(parents=[ndb.get_parser()], description=__doc__)
+	parser.add_argument('--results', type=int, default=DEFAULT_RESULTS,
+		help="Number of results to record with each method. Default: %(default)s")
+	args = parser.parse_args()
+	main(ndb(args), args.results)
@@ -0,0 +1,167 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure how long it takes to build a response store and to look up replies in it
+(notary_http.py --response-store).
+
+Every service gets a copy of the same realistic cache entry, so this measures only the store
+and not signing. Lookups are timed after the store is built, when most of it is likely
+still in the operating system's page cache.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+# TODO: HACK
+# add ..\notary_util to the import path
+import sys
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from notary_util import notary_reply
+from notary_util import notary_response_store
+
+
+DEFAULT_SERVICES = 1000000
+DEFAULT_LOOKUPS = 100000
+PUBLIC_KEY = '-----BEGIN PUBLIC KEY-----\nnot a real key\n-----END PUBLIC KEY-----\n'
+KEYS = [('00:11:22:33:44:55:66:77:88:99:aa:bb:cc:dd:ee:ff', [(1400000000, 1400100000), (1400200000, 1400300000)]),
+	('ff:ee:dd:cc:bb:aa:99:88:77:66:55:44:33:22:11:00', [(1400100001, 1400199999)])]
+
+
+class FixedSigner(object):
+	"""Return a signature of the right size without doing any work."""
+	def sign_raw(self, data):
+		return '\x5a' * 128
+
+def service_name(i):
+	return "host{0}.example.com:443,2".format(i)
+
+def get_rss():
+	"""
+	Return (memory of our own, pages of mapped files) resident for this process in MB,
+	or None if we can't tell.
+	Mapped pages are shared with the page cache and can be dropped whenever memory is needed.
+	"""
+	rss = {}
+	try:
+		with open('/proc/self/status') as status:
+			for line in status:
+				if (line.startswith('RssAnon:') or line.startswith('RssFile:')):
+					rss[line.split(':')[0]] = int(line.split()[1]) / 1024.0
+	except IOError:
+		pass
+	if (len(rss) != 2):
+		return None
+	return (rss['RssAnon'], rss['RssFile'])
+
+def build(path, num_services, entry):
+	"""Write a store with num_services services to path."""
+	start = time.time()
+	writer = notary_response_store.ResponseStoreWriter(path, PUBLIC_KEY)
+	for i in xrange(num_services):
+		writer.add(service_name(i), entry)
+	writer.close()
+	return time.time() - start
+
+def time_lookups(store, services):
+	"""Look up each service and return the sorted lookup times in microseconds."""
+	timer = time.time
+	get = store.get
+	times = []
+	for service in services:
+		start = timer()
+		get(service)
+		times.append((timer() - start) * 1000000)
+	times.sort()
+	return times
+
+def summarize(name, times):
+	print("{0:>8} {1:>10.2f} {2:>10.2f} {3:>10.2f} {4:>10.2f}".format(name, sum(times) / len(times),
+		times[len(times) // 2], times[int(len(times) * 0.99)], times[-1]))
+
+def main(path, num_services, num_lookups, skip_build):
+	entry = notary_reply.build_cache_entry(service_name(0), '2', KEYS, FixedSigner())
+
+	if (not skip_build):
+		build_time = build(path, num_services, entry)
+		print("Built a store of {0} services in {1:.1f} seconds ({2:.0f} per second).".format(
+			num_services, build_time, num_services / build_time))
+
+	open_start = time.time()
+	store = notary_response_store.ResponseStore(path)
+	open_time = time.time() - open_start
+	num_services = store.get_stats()[0]
+	print("Opened {0} ({1:.0f} MB, {2} services) in {3:.2f} ms.".format(
+		path, os.path.getsize(path) / (1024.0 * 1024), num_services, open_time * 1000))
+
+	hits = [service_name(random.randrange(num_services)) for i in xrange(num_lookups)]
+	misses = ["missing{0}.example.com:443,2".format(i) for i in xrange(num_lookups)]
+	for service in hits[:1000]:
+		if (store.get(service) != entry):
+			print("ERROR: wrong entry for '{0}'!".format(service), file=sys.stderr)
+			exit(1)
+
+	print("{0:>8} {1:>10} {2:>10} {3:>10} {4:>10}".format("lookups", "mean (us)", "p50 (us)", "p99 (us)", "max (us)"))
+	summarize("hit", time_lookups(store, hits))
+	summarize("miss", time_lookups(store, misses))
+
+	render_start = time.time()
+	for service in hits:
+		notary_reply.render_cache_entry(store.get(service))
+	print("Looking up and rendering a reply takes {0:.2f} us on average.".format(
+		(time.time() - render_start) * 1000000 / num_lookups))
+
+	rss = get_rss()
+	if (rss != None):
+		print("Resident memory: {0:.0f} MB, plus {1:.0f} MB of the mapped store.".format(*rss))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--services', type=int, default=DEFAULT_SERVICES,
+		help="Number of services to put in the store. Default: %(default)s")
+	parser.add_argument('--lookups', type=int, default=DEFAULT_LOOKUPS,
+		help="Number of hits and of misses to look up. Default: %(default)s")
+	parser.add_argument('--store', metavar='FILE',
+		help="Write the store to this file and keep it, instead of using a temporary file.")
+	parser.add_argument('--skip-build', action='store_true', default=False,
+		help="Only time lookups in an existing store given with --store.")
+	parser.add_argument('--seed', type=int, default=0,
+		help="Seed for choosing services to look up, so runs can be compared. Default: %(default)s")
+	args = parser.parse_args()
+	random.seed(args.seed)
+
+	if (args.skip_build and not args.store):
+		parser.error("--skip-build requires --store.")
+
+	temp_dir = None
+	path = args.store
+	if (path == None):
+		temp_dir = tempfile.mkdtemp()
+		path = os.path.join(temp_dir, 'responses')
+	try:
+		main(path, args.services, args.lookups, args.skip_build)
+	finally:
+		if (temp_dir != None):
+			shutil.rmtree(temp_dir)
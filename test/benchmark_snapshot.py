@@ -0,0 +1,138 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compare the size of exported observations and the time taken to write and read them
+in the text tuple format and in binary snapshots (db2file.py --binary).
+
+Observations are generated in memory with random keys and timestamps,
+so this measures only the file formats and not the database.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import StringIO
+import time
+import zlib
+
+# TODO: HACK
+# add ..\notary_util to the import path
+import sys
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from notary_util import file2db
+from notary_util import notary_snapshot
+
+
+DEFAULT_SERVICES = 100000
+DEFAULT_KEYS = 2 # per service
+DEFAULT_TIMESPANS = 3 # per key
+FIRST_SEEN = 1300000000
+DAY = 24 * 60 * 60 # seconds
+
+
+def make_services(num_services, num_keys, num_timespans):
+	"""Return a sorted list of (service, keys) with random keys and timespans."""
+	services = []
+	for i in xrange(num_services):
+		service = "host{0}.example{1}.com:443,2".format(random.randint(0, 10 ** 6), i)
+		keys = []
+		for k in xrange(random.randint(1, num_keys * 2 - 1)):
+			key = ':'.join(['%02x' % random.randint(0, 255) for b in xrange(notary_snapshot.FINGERPRINT_LENGTH)])
+			start = FIRST_SEEN + random.randint(0, 365 * DAY)
+			timespans = []
+			for t in xrange(random.randint(1, num_timespans * 2 - 1)):
+				end = start + random.randint(0, 30 * DAY)
+				timespans.append((start, end))
+				start = end + random.randint(1, 10 * DAY)
+			keys.append((key, timespans))
+		services.append((service, sorted(keys)))
+	services.sort()
+	return services
+
+def write_tuples(services):
+	"""Return services in the tuple format, written the same way as db2file.py."""
+	output = StringIO.StringIO()
+	for (service, keys) in services:
+		for (key, timespans) in keys:
+			for (start, end) in timespans:
+				output.write("(%s, %s, %s, %s)\n" % (service, key, start, end))
+	return output.getvalue()
+
+def write_snapshot(services):
+	"""Return services as a binary snapshot."""
+	output = StringIO.StringIO()
+	writer = notary_snapshot.SnapshotWriter(output)
+	for (service, keys) in services:
+		writer.write_service(service, keys)
+	writer.close()
+	return output.getvalue()
+
+def read_records(read_function, data):
+	"""Read every record in data with one of file2db's read functions and return how many there were."""
+	count = 0
+	invalid = StringIO.StringIO()
+	for record in read_function(StringIO.StringIO(data), invalid):
+		count += 1
+	if (invalid.getvalue() != ''):
+		print("ERROR: found invalid records!", file=sys.stderr)
+		exit(1)
+	return count
+
+def timed(function, *args):
+	"""Return (the result of function(*args), the number of seconds it took)."""
+	start = time.time()
+	result = function(*args)
+	return (result, time.time() - start)
+
+def main(num_services, num_keys, num_timespans):
+	services = make_services(num_services, num_keys, num_timespans)
+	num_observations = sum([len(timespans) for (service, keys) in services for (key, timespans) in keys])
+	print("{0} services, {1} observations.".format(num_services, num_observations))
+
+	(tuples, tuple_write) = timed(write_tuples, services)
+	(gzipped, gzip_write) = timed(zlib.compress, tuples, 6)
+	(snapshot, snapshot_write) = timed(write_snapshot, services)
+	(tuple_count, tuple_read) = timed(read_records, file2db.read_tuples, tuples)
+	(snapshot_count, snapshot_read) = timed(read_records, file2db.read_snapshot, snapshot)
+	if (tuple_count != num_observations or snapshot_count != num_observations):
+		print("ERROR: read {0} tuples and {1} snapshot records for {2} observations!".format(
+			tuple_count, snapshot_count, num_observations), file=sys.stderr)
+		exit(1)
+
+	print("{0:>16} {1:>14} {2:>10} {3:>10}".format("format", "size (bytes)", "write (s)", "read (s)"))
+	print("{0:>16} {1:>14} {2:>10.2f} {3:>10.2f}".format("tuples", len(tuples), tuple_write, tuple_read))
+	print("{0:>16} {1:>14} {2:>10.2f} {3:>10}".format("tuples + zlib", len(gzipped), tuple_write + gzip_write, "-"))
+	print("{0:>16} {1:>14} {2:>10.2f} {3:>10.2f}".format("snapshot", len(snapshot), snapshot_write, snapshot_read))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--services', type=int, default=DEFAULT_SERVICES,
+		help="Number of services to generate. Default: %(default)s")
+	parser.add_argument('--keys', type=int, default=DEFAULT_KEYS,
+		help="Average number of keys for each service. Default: %(default)s")
+	parser.add_argument('--timespans', type=int, default=DEFAULT_TIMESPANS,
+		help="Average number of timespans for each key. Default: %(default)s")
+	parser.add_argument('--seed', type=int, default=0,
+		help="Seed for the random data, so runs can be compared. Default: %(default)s")
+	args = parser.parse_args()
+	random.seed(args.seed)
+	main(args.services, args.keys, args.timespans)
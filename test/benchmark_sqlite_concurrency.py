@@ -0,0 +1,190 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure how well an sqlite notary database handles reads and writes at the same time,
+with and without --sqlite-wal.
+
+Reader threads look up observations like the web server does, while writer threads
+add observations one at a time (like on-demand scans in the web server)
+and writer processes record batches of results (like a scanner running alongside it). Each run uses a new database in a temporary directory.
+Writes that fail with 'database is locked' are counted as errors.
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+# TODO: HACK
+# add ..\notary_util to the import path
+import sys
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from notary_util.notary_db import ndb
+
+from sqlalchemy.exc import OperationalError
+
+
+DEFAULT_SECONDS = 10
+DEFAULT_READERS = 8
+DEFAULT_WRITER_THREADS = 2
+DEFAULT_WRITER_PROCESSES = 1
+DEFAULT_SERVICES = 2000
+DEFAULT_BATCH_SIZE = 1000
+
+
+class LockErrorCounter(logging.Handler):
+	"""Count the 'database is locked' errors ndb logs when a write fails."""
+
+	def __init__(self):
+		logging.Handler.__init__(self)
+		self.count = 0
+
+	def emit(self, record):
+		if ('database is locked' in record.getMessage()):
+			self.count += 1
+
+def service_name(i):
+	return "concurrency-{0}.example.com:443,2".format(i)
+
+def open_db(dbname, wal):
+	args = ['--dbname', dbname]
+	if (wal):
+		args.append('--sqlite-wal')
+	return ndb(ndb.get_parser().parse_args(args))
+
+def write_loop(db, writer_id, num_services, stop_time, counts):
+	"""Add observations with unique times until stop_time, counting the writes."""
+	# each writer uses its own key so observations never collide
+	key = 'aa:{0:02x}'.format(writer_id)
+	t = 0
+	while (time.time() < stop_time):
+		t += 1
+		db._insert_observation(service_name(random.randrange(num_services)), key, t, t)
+		counts['writes'] += 1
+
+def writer_process(dbname, wal, writer_id, num_services, batch_size, stop_time, results):
+	"""Record batches of scan results until stop_time, like the scanner does."""
+	logging.getLogger().handlers = []
+	errors = LockErrorCounter()
+	logging.getLogger().addHandler(errors)
+	db = open_db(dbname, wal)
+	writes = 0
+	failures = 0
+	batch = 0
+	while (time.time() < stop_time):
+		# use a new key every batch, so each result is a new observation
+		batch += 1
+		key = 'bb:{0:02x}:{1:04x}'.format(writer_id, batch)
+		results_batch = [(service_name(random.randrange(num_services)), key) for i in range(batch_size)]
+		try:
+			db.report_observations(results_batch)
+			writes += len(results_batch)
+		except OperationalError:
+			failures += len(results_batch)
+	results.put((writes + failures, failures + errors.count))
+
+def read_loop(db, num_services, stop_time, counts, lock):
+	reads = 0
+	failures = 0
+	while (time.time() < stop_time):
+		try:
+			db.get_observations_by_key(service_name(random.randrange(num_services)))
+			reads += 1
+		except Exception:
+			failures += 1
+	with lock:
+		counts['reads'] += reads
+		counts['read_failures'] += failures
+
+def run(wal, seconds, num_readers, num_writer_threads, num_writer_processes, num_services, batch_size):
+	"""Return a dictionary of reads, writes, and errors per second."""
+	tempdir = tempfile.mkdtemp()
+	try:
+		dbname = os.path.join(tempdir, 'notary.sqlite')
+		db = open_db(dbname, wal)
+		db.report_observations([(service_name(i), 'aa:bb') for i in range(num_services)])
+
+		errors = LockErrorCounter()
+		logging.getLogger().addHandler(errors)
+		stop_time = time.time() + seconds
+		results = multiprocessing.Queue()
+		processes = [multiprocessing.Process(target=writer_process,
+			args=(dbname, wal, i, num_services, batch_size, stop_time, results)) for i in range(num_writer_processes)]
+
+		lock = threading.Lock()
+		counts = {'reads': 0, 'read_failures': 0}
+		writer_counts = [{'writes': 0} for i in range(num_writer_threads)]
+		threads = [threading.Thread(target=read_loop, args=(db, num_services, stop_time, counts, lock))
+			for i in range(num_readers)]
+		threads += [threading.Thread(target=write_loop, args=(db, i, num_services, stop_time, writer_counts[i]))
+			for i in range(num_writer_threads)]
+
+		for p in processes:
+			p.start()
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		writes = sum([c['writes'] for c in writer_counts])
+		write_errors = errors.count
+		for p in processes:
+			(process_writes, process_errors) = results.get()
+			writes += process_writes
+			write_errors += process_errors
+			p.join()
+		logging.getLogger().removeHandler(errors)
+
+		return {'reads': counts['reads'] / float(seconds), 'read_failures': counts['read_failures'],
+			'writes': (writes - write_errors) / float(seconds), 'write_errors': write_errors}
+	finally:
+		shutil.rmtree(tempdir)
+
+def main(seconds, num_readers, num_writer_threads, num_writer_processes, num_services, batch_size):
+	print("{0} reader threads, {1} writer threads, and {2} writer processes (batches of {3}) for {4} seconds each.".format(
+		num_readers, num_writer_threads, num_writer_processes, batch_size, seconds))
+	print("{0:>12} {1:>10} {2:>14} {3:>10} {4:>14}".format(
+		"mode", "reads/s", "failed reads", "writes/s", "failed writes"))
+	for (name, wal) in [('default', False), ('--sqlite-wal', True)]:
+		r = run(wal, seconds, num_readers, num_writer_threads, num_writer_processes, num_services, batch_size)
+		print("{0:>12} {1:>10.0f} {2:>14} {3:>10.0f} {4:>14}".format(
+			name, r['reads'], r['read_failures'], r['writes'], r['write_errors']))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--seconds', type=int, default=DEFAULT_SECONDS,
+		help="How long to run each mode. Default: %(default)s")
+	parser.add_argument('--readers', type=int, default=DEFAULT_READERS,
+		help="Number of reader threads. Default: %(default)s")
+	parser.add_argument('--writer-threads', type=int, default=DEFAULT_WRITER_THREADS,
+		help="Number of writer threads in the same process as the readers. Default: %(default)s")
+	parser.add_argument('--writer-processes', type=int, default=DEFAULT_WRITER_PROCESSES,
+		help="Number of separate writer processes. Default: %(default)s")
+	parser.add_argument('--services', type=int, default=DEFAULT_SERVICES,
+		help="Number of services in the database. Default: %(default)s")
+	parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+		help="Number of results each writer process records at once. Default: %(default)s")
+	args = parser.parse_args()
+	main(args.seconds, args.readers, args.writer_threads, args.writer_processes, args.services, args.batch_size)
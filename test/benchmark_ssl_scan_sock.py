@@ -0,0 +1,84 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure how long ssl_scan_sock takes to scan a local TLS server.
+
+By default scans a fake server started by this script (see fake_tls_server.py).
+Use --service to scan a real server instead, e.g. one started with
+	openssl s_server -accept 4433 -cert cert.pem -key key.pem -www
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+# TODO: HACK
+# add ..\util to the import path
+import sys
+import os
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from fake_tls_server import FakeTLSServer
+from util.ssl_scan_sock import attempt_observation_for_service
+
+
+DEFAULT_SCANS = 50
+TIMEOUT = 10 # seconds
+
+
+def percentile(sorted_times, fraction):
+	return sorted_times[min(len(sorted_times) - 1, int(len(sorted_times) * fraction))]
+
+def main(service, num_scans, sni):
+	times = []
+	for i in range(num_scans):
+		start = time.time()
+		fp = attempt_observation_for_service(service, TIMEOUT, sni)
+		times.append(time.time() - start)
+		if (fp == None):
+			print("ERROR: scan of {0} failed!".format(service), file=sys.stderr)
+			exit(1)
+
+	times.sort()
+	print("Scanned {0} {1} times.".format(service, num_scans))
+	print("{0:>10} {1:>10} {2:>10} {3:>10} {4:>10}".format("min (ms)", "mean (ms)", "p50 (ms)", "p95 (ms)", "max (ms)"))
+	print("{0:>10.2f} {1:>10.2f} {2:>10.2f} {3:>10.2f} {4:>10.2f}".format(
+		times[0] * 1000, sum(times) / len(times) * 1000,
+		percentile(times, 0.5) * 1000, percentile(times, 0.95) * 1000, times[-1] * 1000))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--service',
+		help="Scan this service (e.g. localhost:4433) instead of a fake local server.")
+	parser.add_argument('--scans', type=int, default=DEFAULT_SCANS,
+		help="Number of scans to run. Default: %(default)s")
+	parser.add_argument('--sni', action='store_true', default=False,
+		help="Use Server Name Indication.")
+	args = parser.parse_args()
+
+	server = None
+	service = args.service
+	if (service == None):
+		server = FakeTLSServer()
+		service = server.get_service('localhost')
+	try:
+		main(service, args.scans, args.sni)
+	finally:
+		if (server != None):
+			server.stop()
@@ -0,0 +1,159 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A local server that answers scanner ClientHellos with canned TLS records,
+so scans can be tested without touching the network.
+"""
+
+import binascii
+import hashlib
+import os
+import socket
+import struct
+import sys
+import threading
+
+# TODO: HACK
+# add ..\util to the import path
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from util.ssl_scan_sock import _get_standard_client_hello
+
+# replies for each mode
+CERT = 'cert' # send the certificate
+ALERT = 'alert' # send an SSL alert
+SNI_ALERT = 'sni_alert' # send an alert to SNI requests and the certificate otherwise
+STALL = 'stall' # never reply
+CLOSE = 'close' # close the connection without replying
+
+_CERT_DATA = 'not really a certificate, but the scanner only hashes it'
+CERT_FINGERPRINT = ':'.join(binascii.b2a_hex(b) for b in hashlib.md5(_CERT_DATA).digest())
+_STANDARD_CLIENT_HELLO = binascii.a2b_hex(_get_standard_client_hello())
+
+
+def _three_bytes(n):
+	return struct.pack('!I', n)[1:]
+
+def _record(rec_type, data):
+	return struct.pack('!BBBH', rec_type, 3, 1, len(data)) + data
+
+def _handshake_reply():
+	"""Return a ServerHello and Certificate message in a single handshake record."""
+	server_hello = '\x02' + _three_bytes(2) + '\x03\x01'
+	certs = _three_bytes(len(_CERT_DATA)) + _CERT_DATA
+	certificate = '\x0b' + _three_bytes(len(certs) + 3) + _three_bytes(len(certs)) + certs
+	return _record(22, server_hello + certificate)
+
+def _alert_reply():
+	# fatal (2) unrecognized_name (112)
+	return _record(21, '\x02\x70')
+
+
+class FakeTLSServer(object):
+	"""
+	Listen on a local port and reply to each ClientHello according to 'mode'.
+
+	Replies are sent a few bytes at a time to make sure scanners
+	can put records back together.
+	"""
+
+	def __init__(self, mode=CERT):
+		self.mode = mode
+		self.connection_count = 0
+		self.sni_count = 0
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(('127.0.0.1', 0))
+		self.sock.listen(128)
+		self.sock.settimeout(0.1)
+		self.port = self.sock.getsockname()[1]
+		self.thread = threading.Thread(target=self._accept)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def get_service(self, host='127.0.0.1'):
+		"""Return the service name for this server."""
+		return "{0}:{1},2".format(host, self.port)
+
+	def stop(self):
+		self.stopped.set()
+		self.thread.join()
+		self.sock.close()
+
+	def _accept(self):
+		while not (self.stopped.is_set()):
+			try:
+				(conn, address) = self.sock.accept()
+			except socket.timeout:
+				continue
+			t = threading.Thread(target=self._reply, args=(conn,))
+			t.daemon = True
+			t.start()
+
+	def _get_hello_length(self, data):
+		"""Return the full length of the ClientHello, or None if we haven't read enough to know."""
+		if (len(data) < 5):
+			return None
+		if (ord(data[0]) & 0x80):
+			# the standard scanner sends an SSLv2-compatible hello with a two-byte header
+			return 2 + (struct.unpack('!H', data[0:2])[0] & 0x7fff)
+		return 5 + struct.unpack('!H', data[3:5])[0]
+
+	def _read_client_hello(self, conn):
+		data = ''
+		while (self._get_hello_length(data) == None or len(data) < self._get_hello_length(data)):
+			chunk = conn.recv(4096)
+			if (len(chunk) == 0):
+				return None
+			data += chunk
+		return data
+
+	def _reply(self, conn):
+		try:
+			conn.settimeout(5)
+			with self.lock:
+				self.connection_count += 1
+			if (self.mode == CLOSE):
+				return
+
+			client_hello = self._read_client_hello(conn)
+			if (client_hello == None):
+				return
+			sni = (client_hello != _STANDARD_CLIENT_HELLO)
+			if (sni):
+				with self.lock:
+					self.sni_count += 1
+
+			if (self.mode == STALL):
+				self.stopped.wait(5)
+				return
+			elif (self.mode == ALERT or (self.mode == SNI_ALERT and sni)):
+				reply = _alert_reply()
+			else:
+				reply = _handshake_reply()
+
+			for i in range(0, len(reply), 7):
+				conn.sendall(reply[i:i + 7])
+			# wait for the scanner to hang up
+			conn.recv(1)
+		except socket.error:
+			pass
+		finally:
+			conn.close()
@@ -121,6 +121,9 @@ class NotarySQLEnumeration(unittest.TestCase):
 		with self.ndb.get_session() as session:
 			self.ndb.get_observations(session, 'get_obs_test:443,2')
 
+	def test_get_observations_by_key(self):
+		self.ndb.get_observations_by_key('get_obs_test:443,2')
+
 	def test_insert_observation(self):
 		self.ndb._insert_observation('insert_obs_test:443,2', 'aa:bb', 1, 2)
 
@@ -138,6 +141,10 @@ class NotarySQLEnumeration(unittest.TestCase):
 	def test_report_observation(self):
 		self.ndb.report_observation('report_observation_test:443,2', 'aa:bb')
 
+	def test_report_observations(self):
+		self.ndb.report_observations([('report_observation_test:443,2', 'aa:bb'),
+			('report_observations_test:443,2', 'aa:bb')])
+
 	# less important SQL - used less often or in the background
 	def test_count_services(self):
 		self.ndb.count_services()
@@ -153,6 +160,25 @@ class NotarySQLEnumeration(unittest.TestCase):
 		self.ndb.insert_bulk_services(
 			['bulkinserttest:443,2', 'bulkinserttest_2:443,2', 'bulkinserttest_3:443,2'])
 
+	def test_insert_bulk_observations(self):
+		self.ndb.insert_bulk_observations([('bulkinsertobs:443,2', 'aa:bb', 1, 2), ('bulkinsertobs_2:443,2', 'aa:bb', 1, 2)],
+			['bulkinsertobs_3:443,2'])
+
+	def test_backfill_service_state(self):
+		self.ndb.backfill_service_state()
+
+	def test_stream_observations(self):
+		list(self.ndb.stream_observations('a', 'b', 1))
+
+	def test_compact_observations(self):
+		self.ndb.compact_observations(1, 1000)
+
+	def test_expire_observations(self):
+		self.ndb.expire_observations(1, 100)
+
+	def test_expire_metrics(self):
+		self.ndb.expire_metrics(1, 100)
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,77 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import time
+import unittest
+
+# TODO: HACK
+# add ..\util to the import path
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from util.cache import NegativeCache
+
+class NegativeCacheTestCases(unittest.TestCase):
+	"""Test the negative cache."""
+
+	def test_added_key_found(self):
+		nc = NegativeCache()
+		self.assertTrue(nc.contains('missing:443,2') == False)
+		nc.add('missing:443,2')
+		self.assertTrue(nc.contains('missing:443,2'))
+		self.assertTrue(nc.contains('missing:443,2'))
+		self.assertTrue(nc.get_hit_count() == 2)
+
+	def test_discarded_key_not_found(self):
+		nc = NegativeCache()
+		nc.add('missing:443,2')
+		nc.discard('missing:443,2')
+		self.assertTrue(nc.contains('missing:443,2') == False)
+		# discarding keys that don't exist should be ignored
+		nc.discard('never_added:443,2')
+
+	def test_entry_removed_after_expiry(self):
+		nc = NegativeCache(expiry=1)
+		nc.add('missing:443,2')
+		time.sleep(1.1)
+		self.assertTrue(nc.contains('missing:443,2') == False)
+		self.assertTrue(len(nc) == 0)
+
+	def test_expired_entries_cleaned_up_on_add(self):
+		nc = NegativeCache(expiry=1)
+		nc.add('missing:443,2')
+		nc.add('missing_2:443,2')
+		time.sleep(1.1)
+		nc.add('missing_3:443,2')
+		self.assertTrue(len(nc) == 1)
+
+	def test_oldest_entry_discarded_when_full(self):
+		nc = NegativeCache(max_entries=2)
+		nc.add('first:443,2')
+		nc.add('second:443,2')
+		# re-adding an entry makes it the newest
+		nc.add('first:443,2')
+		nc.add('third:443,2')
+		self.assertTrue(len(nc) == 2)
+		self.assertTrue(nc.contains('second:443,2') == False)
+		self.assertTrue(nc.contains('first:443,2'))
+		self.assertTrue(nc.contains('third:443,2'))
+
+	def test_invalid_sizes_rejected(self):
+		self.assertRaises(ValueError, NegativeCache, 0)
+		self.assertRaises(ValueError, NegativeCache, 10, 0)
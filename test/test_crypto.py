@@ -0,0 +1,73 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import threading
+import unittest
+
+# TODO: HACK
+# add ..\util to the import path
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from M2Crypto import RSA
+
+from util import crypto
+
+class CryptoTestCases(unittest.TestCase):
+	"""Test the crypto module."""
+
+	@classmethod
+	def setUpClass(cls):
+		# generate the key in-process so tests don't depend on the version of the openssl binary
+		rsa = RSA.gen_key(1024, 65537, lambda *args: None)
+		cls.private_key = rsa.as_pem(cipher=None)
+
+	def test_signer_matches_sign_content(self):
+		signer = crypto.Signer(self.private_key)
+		content = 'github.com:443,2\x00some packed data'
+		self.assertTrue(signer.sign(content) == crypto.sign_content(content, self.private_key))
+
+	def test_invalid_key_rejected(self):
+		self.assertRaises(ValueError, crypto.Signer, 'not a key')
+
+	def test_signer_tracks_stats(self):
+		signer = crypto.Signer(self.private_key)
+		self.assertTrue(signer.get_stats() == (0, 0.0, 0.0))
+
+		signer.sign('one')
+		signer.sign_raw('two')
+		(count, average, maximum) = signer.get_stats()
+		self.assertTrue(count == 2)
+		self.assertTrue(0 <= average <= maximum)
+
+	def test_signer_shared_between_threads(self):
+		signer = crypto.Signer(self.private_key)
+		content = 'shared content'
+		expected = signer.sign(content)
+		sigs = []
+
+		def sign():
+			sigs.append(signer.sign(content))
+
+		threads = [threading.Thread(target=sign) for i in range(5)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+		self.assertTrue(sigs == [expected] * len(threads))
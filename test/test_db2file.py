@@ -0,0 +1,109 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import StringIO
+import sys
+import unittest
+
+# TODO: HACK
+# add ..\notary_util to the import path
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from notary_util import notary_db
+from notary_util import db2file
+from notary_util import notary_snapshot
+
+class DB2FileTestCases(unittest.TestCase):
+	"""
+	Test exporting observations.
+	"""
+
+	TEST_DATABASE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+		'notary.unit_test.sqlite')
+
+	# every service written by these tests sorts between these names,
+	# so other records in the test database are left out.
+	FIRST = 'db2file_test'
+	LAST = 'db2file_test_z'
+
+	class DBArgs():
+		"""
+		Simple class to create an extendable namespace.
+		For passing arguments to ndb.
+		"""
+		pass
+
+	@classmethod
+	def setUpClass(cls):
+		db_args = cls.DBArgs()
+		db_args.dbname = cls.TEST_DATABASE
+		cls.ndb = notary_db.ndb(db_args)
+		for (service, key, start, end) in [('db2file_test_b:443,2', 'cc:dd', 30, 40),
+			('db2file_test_a:443,2', 'aa:bb', 10, 20), ('db2file_test_a:443,2', 'aa:bb', 1, 5),
+			('db2file_test_a:443,2', 'cc:dd', 6, 9), ('db2file_test_c:22,1', 'ee:ff', 50, 60)]:
+			cls.ndb._insert_observation(service, key, start, end)
+
+	def export(self, after_service=FIRST, last_service=LAST, long_output=False, binary=False):
+		output = StringIO.StringIO()
+		db2file.main(self.ndb, output, long_output, after_service, last_service, binary)
+		return output.getvalue()
+
+	#######
+
+	def test_tuples_one_per_line(self):
+		lines = [line for line in self.export().split('\n') if (line != '' and not line.startswith('#'))]
+		self.assertTrue(lines == ['(db2file_test_a:443,2, aa:bb, 1, 5)', '(db2file_test_a:443,2, aa:bb, 10, 20)',
+			'(db2file_test_a:443,2, cc:dd, 6, 9)', '(db2file_test_b:443,2, cc:dd, 30, 40)',
+			'(db2file_test_c:22,1, ee:ff, 50, 60)'])
+
+	def test_tuple_writer_splits_chunks_into_lines(self):
+		output = StringIO.StringIO()
+		writer = db2file.TupleWriter(output)
+		# COPY can hand over several lines, or part of one, in each write
+		data = '(a:443,2, aa:bb, 1, 5)\n(a:443,2, cc:dd, 6, 9)\n(b:443,2, aa:bb, 1, 5)\n(c:443,2, aa:bb, 1, 5)\n'
+		for chunk in [data[:10], data[10:60], data[60:61], data[61:]]:
+			writer.write(chunk)
+		writer.close()
+		self.assertTrue(output.getvalue() == data)
+		self.assertTrue(writer.num_services == 3)
+
+	def test_service_range(self):
+		output = self.export(after_service='db2file_test_a:443,2', last_service='db2file_test_b:443,2')
+		self.assertTrue('db2file_test_a' not in output)
+		self.assertTrue('(db2file_test_b:443,2, cc:dd, 30, 40)' in output)
+		self.assertTrue('db2file_test_c' not in output)
+
+	def test_long_output_prints_each_service_once(self):
+		output = self.export(long_output=True)
+		self.assertTrue(output.count("Start Host: 'db2file_test_a:443,2'") == 1)
+		self.assertTrue(output.count("Start Host: 'db2file_test_c:22,1'") == 1)
+		self.assertTrue(output.count("End Host") == 3)
+		self.assertTrue(output.count("ssl key: aa:bb") == 1)
+		self.assertTrue(output.count("ssh key: ee:ff") == 1)
+		self.assertTrue(output.count("start:\t") == 5)
+
+	def test_binary_snapshot(self):
+		output = StringIO.StringIO(self.export(binary=True))
+		services = list(notary_snapshot.SnapshotReader(output).read_services())
+		self.assertTrue(services == [('db2file_test_a:443,2', [('aa:bb', [(1, 5), (10, 20)]), ('cc:dd', [(6, 9)])]),
+			('db2file_test_b:443,2', [('cc:dd', [(30, 40)])]), ('db2file_test_c:22,1', [('ee:ff', [(50, 60)])])])
+
+	def test_group_by_service(self):
+		groups = list(db2file.group_by_service([('a', 'k1', 1, 2), ('a', 'k1', 3, 4), ('a', 'k2', 5, 6), ('b', 'k1', 7, 8)]))
+		self.assertTrue(groups == [('a', [('k1', [(1, 2), (3, 4)]), ('k2', [(5, 6)])]), ('b', [('k1', [(7, 8)])])])
+		self.assertTrue(list(db2file.group_by_service([])) == [])
@@ -0,0 +1,260 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+# TODO: HACK
+# add ..\notary_util to the import path
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from notary_util import notary_db
+from notary_util import db2file
+from notary_util import file2db
+from notary_util import notary_snapshot
+
+# set this to the name of a postgresql database the tests can write to
+# to also test importing and exporting with postgresql's COPY.
+# it is reached with the default host and user; set NOTARY_DB_PASSWORD if a password is needed.
+POSTGRESQL_TEST_DATABASE = os.environ.get('NOTARY_TEST_POSTGRESQL_DBNAME')
+
+class File2DBTestCases(unittest.TestCase):
+	"""
+	Test importing observations.
+	"""
+
+	TEST_DATABASE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+		'notary.unit_test.sqlite')
+	INVALID_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+		'file2db_test_invalid_lines.txt')
+
+	class DBArgs():
+		"""
+		Simple class to create an extendable namespace.
+		For passing arguments to ndb.
+		"""
+		pass
+
+	def setUp(self):
+		db_args = self.DBArgs()
+		db_args.dbname = self.TEST_DATABASE
+		self.ndb = notary_db.ndb(db_args)
+
+	def tearDown(self):
+		if (os.path.exists(self.INVALID_FILE)):
+			os.remove(self.INVALID_FILE)
+
+	def import_lines(self, lines, services_only=False, batch_size=2):
+		infile = StringIO.StringIO('\n'.join(lines) + '\n')
+		infile.name = 'test input'
+		return file2db.import_records(self.ndb, infile, services_only, batch_size, self.INVALID_FILE)
+
+	def get_service_state(self, service):
+		with self.ndb._get_connection() as conn:
+			service_id = self.ndb._get_service_id(conn, service)
+			return self.ndb._get_service_state(conn, [service_id]).get(service_id)
+
+	#######
+
+	def test_import_records(self):
+		lines = ['# a comment', '',
+			'(file2db_test_a:443,2, aa:bb, 10, 20)',
+			'(file2db_test_b:443,2, cc:dd, 1, 2)',
+			'(file2db_test_a:443,2, aa:bb, 1, 5)',
+			'(file2db_test_a:443,2, cc:dd, 21, 30)',
+			'(file2db_test_c:443,2, None, None, None)',
+			'(file2db_test_d:443,2, ee:ff, 9, 8)',
+			'not a record']
+		self.assertTrue(self.import_lines(lines) == 4)
+
+		self.assertTrue(self.ndb.get_observations_by_key('file2db_test_a:443,2') ==
+			[('aa:bb', [(1, 5), (10, 20)]), ('cc:dd', [(21, 30)])])
+		self.assertTrue(self.get_service_state('file2db_test_a:443,2')[0:2] == ('cc:dd', 30))
+		self.assertTrue(self.get_service_state('file2db_test_b:443,2')[0:2] == ('cc:dd', 2))
+
+		# services without observations are still added
+		with self.ndb._get_connection() as conn:
+			self.assertTrue(self.ndb._get_service_id(conn, 'file2db_test_c:443,2') != None)
+		self.assertTrue(self.ndb.get_observations_by_key('file2db_test_d:443,2') == [])
+
+		with open(self.INVALID_FILE) as invalid:
+			self.assertTrue(invalid.readlines() == ['(file2db_test_d:443,2, ee:ff, 9, 8)\n', 'not a record\n'])
+
+	def test_records_imported_twice(self):
+		lines = ['(file2db_twice_test:443,2, aa:bb, 10, 20)', '(file2db_twice_test:443,2, aa:bb, 30, 40)']
+		self.import_lines(lines)
+
+		# existing records are skipped, new ones are still added
+		self.import_lines(lines + ['(file2db_twice_test:443,2, aa:bb, 50, 60)'], batch_size=10)
+		self.assertTrue(self.ndb.get_observations_by_key('file2db_twice_test:443,2') ==
+			[('aa:bb', [(10, 20), (30, 40), (50, 60)])])
+		self.assertTrue(self.get_service_state('file2db_twice_test:443,2')[0:2] == ('aa:bb', 60))
+
+	def test_import_snapshot(self):
+		snapshot = StringIO.StringIO()
+		writer = notary_snapshot.SnapshotWriter(snapshot)
+		writer.write_service('file2db_snapshot_test_a:443,2', [('aa:bb', [(1, 5), (10, 20)]), ('not hex', [(1, 2)])])
+		writer.write_service('file2db_snapshot_test_b:443,2', [])
+		writer.write_service('file2db_snapshot_test_c:443,2 <bad>', [('cc:dd', [(1, 2)])])
+		writer.close()
+		snapshot.seek(0)
+		snapshot.name = 'test snapshot'
+
+		self.assertTrue(file2db.import_records(self.ndb, snapshot, batch_size=2, invalid_file=self.INVALID_FILE,
+			binary=True) == 2)
+		self.assertTrue(self.ndb.get_observations_by_key('file2db_snapshot_test_a:443,2') ==
+			[('aa:bb', [(1, 5), (10, 20)])])
+		with self.ndb._get_connection() as conn:
+			self.assertTrue(self.ndb._get_service_id(conn, 'file2db_snapshot_test_b:443,2') != None)
+
+		# invalid records are written out as tuples
+		with open(self.INVALID_FILE) as invalid:
+			self.assertTrue(invalid.readlines() == ['(file2db_snapshot_test_a:443,2, not hex, 1, 2)\n',
+				'(file2db_snapshot_test_c:443,2 <bad>, cc:dd, 1, 2)\n'])
+
+	def test_extended_observations_merged(self):
+		self.import_lines(['(file2db_merge_test:443,2, aa:bb, 10, 20)', '(file2db_merge_test:443,2, cc:dd, 30, 40)'])
+
+		# a later export has the same observation with a later end time, and an older copy of it
+		self.import_lines(['(file2db_merge_test:443,2, aa:bb, 10, 50)', '(file2db_merge_test:443,2, cc:dd, 30, 35)',
+			'(file2db_merge_test:443,2, aa:bb, 10, 45)'], batch_size=10)
+		self.assertTrue(self.ndb.get_observations_by_key('file2db_merge_test:443,2') ==
+			[('aa:bb', [(10, 50)]), ('cc:dd', [(30, 40)])])
+		self.assertTrue(self.get_service_state('file2db_merge_test:443,2')[0:2] == ('aa:bb', 50))
+
+	def test_services_only(self):
+		self.import_lines(['(file2db_services_only_test:443,2, aa:bb, 10, 20)'], services_only=True)
+		with self.ndb._get_connection() as conn:
+			self.assertTrue(self.ndb._get_service_id(conn, 'file2db_services_only_test:443,2') != None)
+		self.assertTrue(self.ndb.get_observations_by_key('file2db_services_only_test:443,2') == [])
+
+class ReplicationTestCases(unittest.TestCase):
+	"""
+	Test keeping a copy of a notary database up to date with db2file.py --since and file2db.py.
+	"""
+
+	class DBArgs():
+		"""
+		Simple class to create an extendable namespace.
+		For passing arguments to ndb.
+		"""
+		pass
+
+	def open_db(self, name):
+		db_args = self.DBArgs()
+		db_args.dbname = os.path.join(self.tempdir, name)
+		return notary_db.ndb(db_args)
+
+	def setUp(self):
+		self.tempdir = tempfile.mkdtemp()
+		self.source = self.open_db('source.sqlite')
+		self.copy = self.open_db('copy.sqlite')
+		self.invalid_file = os.path.join(self.tempdir, 'invalid_lines.txt')
+
+	def tearDown(self):
+		shutil.rmtree(self.tempdir)
+
+	def replicate(self, since=None, binary=False):
+		"""Export observations from the source database and import them into the copy."""
+		output = StringIO.StringIO()
+		db2file.main(self.source, output, binary=binary, since=since)
+		data = output.getvalue()
+		output.seek(0)
+		output.name = 'export'
+		file2db.import_records(self.copy, output, invalid_file=self.invalid_file, binary=binary)
+		return data
+
+	def check_round_trip(self, binary):
+		self.source._insert_observation('a.com:443,2', 'aa:bb', 100, 200)
+		self.source._insert_observation('b.com:443,2', 'cc:dd', 50, 60)
+		self.source._insert_observation('b.com:443,2', 'ee:ff', 70, 80)
+		self.replicate(binary=binary)
+		self.assertTrue(list(self.copy.stream_observations()) == list(self.source.stream_observations()))
+
+		self.source._update_observation_end_time('a.com:443,2', 'aa:bb', 200, 300)
+		self.source._insert_observation('c.com:443,2', 'aa:bb', 400, 400)
+		self.assertTrue(list(self.source.stream_observations(since=250)) ==
+			[('a.com:443,2', 'aa:bb', 100, 300), ('c.com:443,2', 'aa:bb', 400, 400)])
+
+		# importing the same changes again has no effect
+		for i in range(2):
+			self.replicate(since=250, binary=binary)
+			self.assertTrue(list(self.copy.stream_observations()) == list(self.source.stream_observations()))
+		with self.copy._get_connection() as conn:
+			service_id = self.copy._get_service_id(conn, 'a.com:443,2')
+			self.assertTrue(self.copy._get_service_state(conn, [service_id])[service_id][0:2] == ('aa:bb', 300))
+
+	#######
+
+	def test_round_trip_tuples(self):
+		self.check_round_trip(binary=False)
+
+	def test_round_trip_snapshot(self):
+		self.check_round_trip(binary=True)
+
+	def test_since_header(self):
+		self.source._insert_observation('a.com:443,2', 'aa:bb', 100, 200)
+		self.assertTrue('# Only observations added or extended since' in self.replicate(since=150))
+		self.assertTrue('(a.com:443,2, aa:bb, 100, 200)' not in self.replicate(since=250))
+
+@unittest.skipUnless(POSTGRESQL_TEST_DATABASE, "set NOTARY_TEST_POSTGRESQL_DBNAME to test with postgresql")
+class PostgresqlCopyTestCases(unittest.TestCase):
+	"""
+	Test importing and exporting observations with postgresql's COPY.
+	"""
+
+	INVALID_FILE = File2DBTestCases.INVALID_FILE
+
+	def setUp(self):
+		defaults = notary_db.ndb.SUPPORTED_DBS['postgresql']
+		db_args = notary_db.ndb.get_parser().parse_args(['--dbtype', 'postgresql', '--dbname', POSTGRESQL_TEST_DATABASE,
+			'--dbhost', defaults['defaulthostname'], '--dbuser', defaults['defaultusername']])
+		self.ndb = notary_db.ndb(db_args)
+
+	def tearDown(self):
+		if (os.path.exists(self.INVALID_FILE)):
+			os.remove(self.INVALID_FILE)
+
+	#######
+
+	def test_round_trip(self):
+		lines = ['(pg_copy_test_a:443,2, aa:bb, 1, 5)', '(pg_copy_test_a:443,2, aa:bb, 10, 20)',
+			'(pg_copy_test_b:443,2, cc:dd, 30, 40)']
+		infile = StringIO.StringIO('\n'.join(lines) + '\n')
+		infile.name = 'test input'
+		file2db.import_records(self.ndb, infile, invalid_file=self.INVALID_FILE)
+		self.assertTrue(self.ndb.get_observations_by_key('pg_copy_test_a:443,2') ==
+			[('aa:bb', [(1, 5), (10, 20)])])
+
+		output = StringIO.StringIO()
+		db2file.main(self.ndb, output, after_service='pg_copy_test', last_service='pg_copy_test_b:443,2')
+		self.assertTrue([line for line in output.getvalue().split('\n') if (line != '' and not line.startswith('#'))] == lines)
+
+	def test_values_escaped(self):
+		service = 'pg_copy_test_z\\\t\n:443,2'
+		self.ndb.insert_bulk_observations([(service, 'aa:\\b', 1, 2)])
+		self.assertTrue(self.ndb.get_observations_by_key(service) == [('aa:\\b', [(1, 2)])])
+
+	def test_existing_records_skipped(self):
+		service = 'pg_copy_test_existing:443,2'
+		self.ndb.insert_bulk_observations([(service, 'aa:bb', 1, 2)])
+		self.ndb.insert_bulk_observations([(service, 'aa:bb', 1, 2), (service, 'aa:bb', 3, 4)])
+		self.assertTrue(self.ndb.get_observations_by_key(service) == [('aa:bb', [(1, 2), (3, 4)])])
@@ -18,7 +18,9 @@ from __future__ import print_function
 
 import argparse
 import os
+import sqlite3
 import sys
+import threading
 import time
 import unittest
 
@@ -27,7 +29,11 @@ import unittest
 sys.path.insert(0,
 	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 
-from notary_util.notary_db import ndb
+from notary_util.notary_db import ndb, ratelimited, ServiceIdCache, Services, Observations, Metrics, EventTypes,\
+	TimedQueuePool, SchemaError
+
+from sqlalchemy.engine import create_engine
+from sqlalchemy.exc import DisconnectionError, TimeoutError
 
 def setUpModule():
 	"""
@@ -75,7 +81,7 @@ class NotaryDBTestCases(unittest.TestCase):
 
 	def test_call_ndb_after_extending_argparser(self):
 		parser = argparse.ArgumentParser(parents=[ndb.get_parser()])
-		args = parser.parse_args()
+		args = parser.parse_args(['--dbname', self.TEST_DATABASE])
 		db = ndb(args)
 		db.get_all_service_names()
 
@@ -89,6 +95,21 @@ class NotaryDBTestCases(unittest.TestCase):
 	def test_get_oldest_service_names(self):
 		self.ndb.get_oldest_service_names(0)
 
+	def test_newest_and_oldest_service_names(self):
+		service = 'newest_oldest_test:443,2'
+		self.ndb._insert_observation(service, 'aa:bb', 100, 200)
+		self.ndb._insert_observation(service, 'cc:dd', 10, 20)
+
+		# only the most recent observation counts, and each service is listed once
+		newest = [row[0] for row in self.ndb.get_newest_service_names(150)]
+		self.assertTrue(newest.count(service) == 1)
+		oldest = [row[0] for row in self.ndb.get_oldest_service_names(150)]
+		self.assertTrue(service not in oldest)
+		oldest = [row[0] for row in self.ndb.get_oldest_service_names(200)]
+		self.assertTrue(oldest.count(service) == 1)
+		newest = [row[0] for row in self.ndb.get_newest_service_names(200)]
+		self.assertTrue(service not in newest)
+
 	def test_report_metric(self):
 		orig = self.ndb.metricsdb
 		# metrics logging must be turned on for this function to be properly exercised
@@ -99,6 +120,36 @@ class NotaryDBTestCases(unittest.TestCase):
 		finally:
 			self.ndb.metricsdb = orig
 
+	def test_ratelimited(self):
+		calls = []
+		@ratelimited(1)
+		def limited(name):
+			calls.append(name)
+		limited('a')
+		limited('b')
+		self.assertTrue(calls == ['a'])
+
+		calls = []
+		@ratelimited(1, key=lambda name: name)
+		def limited_per_name(name):
+			calls.append(name)
+		for name in ['a', 'b', 'a', 'c', 'b']:
+			limited_per_name(name)
+		self.assertTrue(calls == ['a', 'b', 'c'])
+
+	def test_metrics_limited_per_event_type(self):
+		# notary_http reports these together for every reply it signs
+		comment = 'metrics_limited_per_event_type_test {0}'.format(time.time())
+		event_types = ['GetObservationsForService', 'ResponseSigned', 'DatabasePoolStats']
+		for event_type in event_types:
+			self.ndb.report_metric(event_type, comment)
+		self.ndb.report_metric('ResponseSigned', comment)
+
+		with self.ndb.get_session() as session:
+			recorded = [row[0] for row in session.query(EventTypes.name).join(
+				Metrics, Metrics.event_type_id == EventTypes.event_type_id).filter(Metrics.comment == comment)]
+		self.assertTrue(sorted(recorded) == sorted(event_types))
+
 	def test_insert_service(self):
 		service = 'insert_service_test:443,2'
 
@@ -120,6 +171,25 @@ class NotaryDBTestCases(unittest.TestCase):
 		with self.ndb.get_session() as session:
 			self.ndb.get_observations(session, 'get_obs_test:443,2')
 
+	def test_get_observations_by_key(self):
+		service = 'get_obs_by_key_test:443,2'
+		key1 = 'bb:bb'
+		key2 = 'aa:aa'
+
+		# insert out of order to make sure results are sorted
+		self.ndb._insert_observation(service, key1, 30, 40)
+		self.ndb._insert_observation(service, key2, 50, 60)
+		self.ndb._insert_observation(service, key1, 10, 20)
+
+		keys = self.ndb.get_observations_by_key(service)
+		self.assertTrue(keys == [(key2, [(50, 60)]), (key1, [(10, 20), (30, 40)])])
+
+		# observations that ended before min_end are left out
+		keys = self.ndb.get_observations_by_key(service, 40)
+		self.assertTrue(keys == [(key2, [(50, 60)]), (key1, [(30, 40)])])
+
+		self.assertTrue(self.ndb.get_observations_by_key('get_obs_by_key_missing:443,2') == [])
+
 	def test_insert_observation(self):
 		service = 'insert_obs_test:443,2'
 		key = 'aa:bb'
@@ -313,6 +383,323 @@ class NotaryDBTestCases(unittest.TestCase):
 		# so long as callers use report_obseration() instead of _insert_observation()
 		# no invalid data will be put into the database.
 
+	def test_report_observations(self):
+		new_service = 'report_observations_new:443,2'
+		same_key = 'report_observations_same_key:443,2'
+		new_key = 'report_observations_new_key:443,2'
+		old_key = 'report_observations_old_key:443,2'
+		now = int(time.time())
+		too_old = now - self.ndb.OBSERVATION_UPDATE_LIMIT - 100
+
+		self.ndb._insert_observation(same_key, 'aa:bb', now - 20, now - 10)
+		self.ndb._insert_observation(new_key, 'aa:bb', now - 20, now - 10)
+		self.ndb._insert_observation(old_key, 'aa:bb', too_old - 10, too_old)
+
+		count_srv_before = self.ndb.count_services()
+		count_obs_before = self.ndb.count_observations()
+		self.ndb.report_observations([(new_service, 'aa:bb'), (same_key, 'aa:bb'),
+			(new_key, 'cc:dd'), (old_key, 'aa:bb'),
+			# scanning a service twice has the same effect as scanning it once
+			(new_service, 'aa:bb')])
+		self.assertTrue(self.ndb.count_services() == count_srv_before + 1)
+		self.assertTrue(self.ndb.count_observations() == count_obs_before + 3)
+
+		# a new service gets a new observation
+		keys = self.ndb.get_observations_by_key(new_service)
+		self.assertTrue(len(keys) == 1)
+		(start, end) = keys[0][1][0]
+		self.assertTrue(start == end and start >= now)
+
+		# seeing the same key again extends the current observation
+		keys = self.ndb.get_observations_by_key(same_key)
+		self.assertTrue(len(keys) == 1 and len(keys[0][1]) == 1)
+		self.assertTrue(keys[0][1][0][0] == now - 20)
+		self.assertTrue(keys[0][1][0][1] >= now)
+
+		# seeing a new key starts a new observation and ends the previous key's one second earlier
+		keys = dict(self.ndb.get_observations_by_key(new_key))
+		self.assertTrue(keys['cc:dd'][0][0] >= now)
+		self.assertTrue(keys['aa:bb'][0][1] == keys['cc:dd'][0][0] - 1)
+
+		# observations older than the update limit are left alone
+		keys = self.ndb.get_observations_by_key(old_key)
+		self.assertTrue(keys[0][1][0] == (too_old - 10, too_old))
+		self.assertTrue(keys[0][1][1][0] >= now)
+
+		# empty lists should be ignored
+		self.ndb.report_observations([])
+
+	def test_report_observations_key_changes_within_one_second(self):
+		changing = 'report_observations_changing_key:443,2'
+		other = 'report_observations_changing_key_other:443,2'
+		now = int(time.time())
+
+		# one service changing keys mustn't make the whole batch fall back to report_observation()
+		def fail_fallback(service, fp):
+			self.fail("report_observations() fell back to reporting {0} one at a time.".format(service))
+		self.ndb.report_observation = fail_fallback
+		try:
+			self.ndb.report_observations([(changing, 'aa:bb'), (other, 'aa:bb'),
+				(changing, 'cc:dd'), (changing, 'aa:bb')])
+		finally:
+			del self.ndb.report_observation
+
+		# each key gets one observation, and the first one's end isn't moved before its start
+		keys = dict(self.ndb.get_observations_by_key(changing))
+		self.assertTrue(sorted(keys.keys()) == ['aa:bb', 'cc:dd'])
+		for timespans in keys.values():
+			self.assertTrue(len(timespans) == 1)
+			(start, end) = timespans[0]
+			self.assertTrue(start == end and start >= now)
+
+		keys = self.ndb.get_observations_by_key(other)
+		self.assertTrue(len(keys) == 1 and keys[0][0] == 'aa:bb')
+
+	def get_service_state(self, service):
+		"""Return the (current_key, last_seen, current_observation_id) stored for a service."""
+		with self.ndb.get_session() as session:
+			srv = session.query(Services).filter(Services.name == service).first()
+			return (srv.current_key, srv.last_seen, srv.current_observation_id)
+
+	def test_service_state_maintained(self):
+		service = 'service_state_test:443,2'
+		now = int(time.time())
+
+		self.ndb._insert_observation(service, 'aa:bb', now - 20, now - 10)
+		(key, last_seen, observation_id) = self.get_service_state(service)
+		self.assertTrue(key == 'aa:bb' and last_seen == now - 10)
+
+		# extending the current observation
+		self.ndb.report_observation(service, 'aa:bb')
+		(key, last_seen, current_id) = self.get_service_state(service)
+		self.assertTrue(key == 'aa:bb' and last_seen >= now and current_id == observation_id)
+
+		# a new key
+		self.ndb.report_observations([(service, 'cc:dd')])
+		(key, last_seen, current_id) = self.get_service_state(service)
+		self.assertTrue(key == 'cc:dd' and last_seen >= now and current_id != observation_id)
+		with self.ndb.get_session() as session:
+			self.assertTrue(list(self.ndb.get_observations(session, service)).count((service, key, last_seen, last_seen)) == 1)
+
+		# adding older history doesn't change the most recent observation
+		self.ndb._insert_observation(service, 'ee:ff', 1, 2)
+		self.assertTrue(self.get_service_state(service) == (key, last_seen, current_id))
+
+	def test_upgrade_schema(self):
+		database = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'notary.upgrade_test.sqlite')
+		if (os.path.exists(database)):
+			os.remove(database)
+		try:
+			# the tables as created by version 3.5
+			engine = create_engine('sqlite:///' + database)
+			engine.execute('CREATE TABLE t_services (service_id INTEGER NOT NULL, name VARCHAR NOT NULL, PRIMARY KEY (service_id), UNIQUE (name))')
+			engine.execute('CREATE TABLE t_observations (observation_id INTEGER NOT NULL, service_id INTEGER NOT NULL, key VARCHAR NOT NULL, start INTEGER NOT NULL, "end" INTEGER NOT NULL, PRIMARY KEY (observation_id))')
+			engine.execute("INSERT INTO t_services (service_id, name) VALUES (1, 'upgrade_test:443,2'), (2, 'upgrade_test_2:443,2')")
+			engine.execute("INSERT INTO t_observations (service_id, key, start, \"end\") VALUES (1, 'aa:bb', 10, 20), (1, 'cc:dd', 21, 30), (1, 'aa:bb', 1, 5)")
+			engine.dispose()
+
+			db_args = self.DBArgs()
+			db_args.dbname = database
+			# queries use the new columns, so the notary must not run until they are added
+			self.assertRaises(SchemaError, ndb, db_args)
+
+			db = ndb(db_args, check_schema=False)
+			added = db.upgrade_schema()
+			self.assertTrue(sorted(added) == ['t_services.current_key', 't_services.current_observation_id', 't_services.last_seen'])
+			self.assertTrue(db.upgrade_schema() == [])
+			ndb(db_args)
+
+			# services that haven't been filled in yet still get the right decision
+			now = int(time.time())
+			db.report_observations([('upgrade_test_2:443,2', 'aa:bb')])
+			self.assertTrue(db.count_observations() == 4)
+
+			self.assertTrue(db.backfill_service_state(batch_size=1) == 2)
+			self.assertTrue(sorted([row[0] for row in db.get_oldest_service_names(now - 1)]) == ['upgrade_test:443,2'])
+			self.assertTrue(sorted([row[0] for row in db.get_newest_service_names(now - 1)]) == ['upgrade_test_2:443,2'])
+			with db._get_connection() as conn:
+				state = db._get_service_state(conn, [1])
+			self.assertTrue(state[1][0:2] == ('cc:dd', 30))
+			del db
+		finally:
+			os.remove(database)
+
+	def test_compact_observations(self):
+		service = 'compact_observations_test:443,2'
+		for (key, start, end) in [('aa:bb', 1, 10), ('aa:bb', 11, 20), ('aa:bb', 15, 25), ('aa:bb', 100, 200),
+			('cc:dd', 21, 30), ('aa:bb', 150, 300)]:
+			self.ndb._insert_observation(service, key, start, end)
+		with self.ndb._get_connection() as conn:
+			service_id = self.ndb._get_service_id(conn, service)
+		(key, last_seen, current_id) = self.get_service_state(service)
+
+		removed = self.ndb.compact_observations(service_id, service_id)
+		self.assertTrue(sorted(removed) == [(11, 20), (15, 25), (150, 300)])
+		self.assertTrue(self.ndb.get_observations_by_key(service) ==
+			[('aa:bb', [(1, 25), (100, 300)]), ('cc:dd', [(21, 30)])])
+
+		# the current observation was merged into an earlier one
+		(key, last_seen, new_current_id) = self.get_service_state(service)
+		self.assertTrue(key == 'aa:bb' and last_seen == 300 and new_current_id != current_id)
+		with self.ndb.get_session() as session:
+			self.assertTrue(session.query(Observations).get(new_current_id).start == 100)
+
+		# nothing left to do
+		self.assertTrue(self.ndb.compact_observations(service_id, service_id) == [])
+
+	def test_expire_observations(self):
+		service = 'expire_observations_test:443,2'
+		# nothing else in the test database ends at 0
+		self.ndb._insert_observation(service, 'aa:bb', 0, 0)
+		self.ndb._insert_observation(service, 'cc:dd', 0, 0)
+		self.ndb._insert_observation(service, 'aa:bb', 1, 5)
+		self.ndb._insert_observation(service, 'ee:ff', 0, 0)
+		count_before = self.ndb.count_observations()
+
+		# nothing is deleted if archiving fails
+		def fail(rows):
+			raise IOError("disk full")
+		self.assertRaises(IOError, self.ndb.expire_observations, 1, 2, fail)
+		self.assertTrue(self.ndb.count_observations() == count_before)
+
+		archived = []
+		self.assertTrue(self.ndb.expire_observations(1, 2, archived.extend) == 2)
+		self.assertTrue(self.ndb.expire_observations(1, 2, archived.extend) == 1)
+		self.assertTrue(self.ndb.expire_observations(1, 2, archived.extend) == 0)
+		self.assertTrue(sorted(archived) == [(service, 'aa:bb', 0, 0), (service, 'cc:dd', 0, 0), (service, 'ee:ff', 0, 0)])
+		self.assertTrue(self.ndb.get_observations_by_key(service) == [('aa:bb', [(1, 5)])])
+		self.assertTrue(self.ndb.count_observations() == count_before - 3)
+
+		# observations the scanner may still extend can't be expired
+		self.assertRaises(ValueError, self.ndb.expire_observations, int(time.time()), 2)
+
+	def test_report_after_current_observation_expired(self):
+		single = 'expired_current_test:443,2'
+		batch = 'expired_current_batch_test:443,2'
+		now = int(time.time())
+		for service in [single, batch]:
+			self.ndb._insert_observation(service, 'aa:bb', now - 20, now - 10)
+			# as expire_observations() leaves a service whose current observation was deleted
+			with self.ndb.get_session() as session:
+				session.query(Observations).filter(Observations.observation_id ==
+					self.get_service_state(service)[2]).delete(synchronize_session=False)
+				session.query(Services).filter(Services.name == service).update(
+					{'current_observation_id': None}, synchronize_session=False)
+				session.commit()
+
+		# the next scan starts a new observation rather than trying to extend the deleted one
+		self.ndb.report_observation(single, 'aa:bb')
+		self.ndb.report_observations([(batch, 'aa:bb')])
+		for service in [single, batch]:
+			keys = self.ndb.get_observations_by_key(service)
+			self.assertTrue(len(keys) == 1 and len(keys[0][1]) == 1)
+			(start, end) = keys[0][1][0]
+			self.assertTrue(start == end and start >= now)
+			self.assertTrue(self.get_service_state(service)[2] != None)
+
+	def test_expire_metrics(self):
+		self.ndb.report_metric('CacheHit')
+		cutoff = int(time.time()) + 10
+		while (self.ndb.expire_metrics(cutoff, 2) > 0):
+			pass
+		with self.ndb._get_connection() as conn:
+			self.assertTrue(conn.execute('SELECT count(*) FROM t_metrics').first()[0] == 0)
+
+	def test_pool_stats(self):
+		pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=0, timeout=0.1)
+		conn = pool.connect()
+		self.assertRaises(TimeoutError, pool.connect)
+		conn.close()
+		pool.connect().close()
+		stats = pool.get_stats()
+		self.assertTrue(stats['checkouts'] == 3 and stats['timeouts'] == 1)
+		self.assertTrue(stats['max_wait'] >= 0.1)
+
+		# sqlite databases don't use a pool
+		stats = self.ndb.get_pool_stats()
+		self.assertTrue(stats['checkouts'] == 0 and stats['open'] == 0)
+
+	def test_ping_connection(self):
+		conn = sqlite3.connect(':memory:')
+		self.ndb._ping_connection(conn, None, None)
+		conn.close()
+		self.assertRaises(DisconnectionError, self.ndb._ping_connection, conn, None, None)
+
+	def test_sqlite_wal(self):
+		database = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'notary.wal_test.sqlite')
+		db_args = self.DBArgs()
+		db_args.dbname = database
+		db_args.sqlite_wal = True
+		db = ndb(db_args)
+		try:
+			with db._get_connection() as conn:
+				self.assertTrue(conn.execute('PRAGMA journal_mode').first()[0] == 'wal')
+				self.assertTrue(conn.execute('PRAGMA synchronous').first()[0] == 1) # NORMAL
+
+			# writes from several threads take turns on the single write connection
+			def write(db, i):
+				for j in range(10):
+					db._insert_observation('sqlite_wal_test_{0}:443,2'.format(i), 'aa:bb', j * 10, j * 10 + 5)
+			threads = [threading.Thread(target=write, args=(db, i)) for i in range(4)]
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+			self.assertTrue(db.count_observations() == 40)
+			self.assertTrue(db.write_db.pool.get_stats()['checkouts'] >= 40)
+			self.assertTrue(db.get_connection_count() == 0)
+		finally:
+			del db
+			for suffix in ['', '-wal', '-shm']:
+				if (os.path.exists(database + suffix)):
+					os.remove(database + suffix)
+
+	def test_service_ids_cached(self):
+		service = 'service_id_cache_test:443,2'
+		self.ndb._insert_observation(service, 'aa:bb', 1, 2)
+
+		# a fresh ndb has to look the service up once...
+		db_args = self.DBArgs()
+		db_args.dbname = self.TEST_DATABASE
+		db = ndb(db_args)
+		db.get_observations_by_key(service)
+		stats = db.get_service_id_cache_stats()
+		self.assertTrue(stats['hits'] == 0 and stats['misses'] == 1)
+
+		# ...and then uses the cache
+		self.assertTrue(db.get_observations_by_key(service) == [('aa:bb', [(1, 2)])])
+		db.report_observations([(service, 'aa:bb')])
+		stats = db.get_service_id_cache_stats()
+		self.assertTrue(stats['hits'] == 2 and stats['misses'] == 1)
+
+		# unknown services are not cached
+		self.assertTrue(db.get_observations_by_key('service_id_cache_unknown:443,2') == [])
+		self.assertTrue(db.get_service_id_cache_stats()['entries'] == 1)
+
+		# preloading fills the cache without any lookups
+		db_args.preload_service_ids = True
+		db = ndb(db_args)
+		self.assertTrue(db.get_service_id_cache_stats()['entries'] == self.ndb.count_services())
+		db.get_observations_by_key(service)
+		self.assertTrue(db.get_service_id_cache_stats()['misses'] == 0)
+
+	def test_service_id_cache_discards_least_recently_used(self):
+		cache = ServiceIdCache(2)
+		cache.add('first:443,2', 1)
+		cache.add('second:443,2', 2)
+		self.assertTrue(cache.get('first:443,2') == 1)
+		cache.add('third:443,2', 3)
+		self.assertTrue(len(cache) == 2)
+		self.assertTrue(cache.get('second:443,2') == None)
+		self.assertTrue(cache.get('third:443,2') == 3)
+		self.assertTrue(cache.get_stats() == {'entries': 2, 'hits': 2, 'misses': 1})
+
+		# a size of 0 disables the cache
+		cache = ServiceIdCache(0)
+		cache.add('first:443,2', 1)
+		self.assertTrue(cache.get('first:443,2') == None)
+		self.assertRaises(ValueError, ServiceIdCache, -1)
+
 	# less important SQL - used less often or in the background
 	def test_count_services(self):
 		count = self.ndb.count_services()
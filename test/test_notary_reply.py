@@ -0,0 +1,109 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+# TODO: HACK
+# add ..\notary_util and ..\client to the import path
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.insert(0,
+	os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'client'))
+
+from M2Crypto import BIO, RSA
+
+import client_common
+from notary_util import notary_reply
+from util import crypto
+
+class RecordingSigner(object):
+	"""Remember the data we were asked to sign, and return a fixed signature."""
+	def sign(self, content):
+		self.content = content
+		return 'c2lnbmF0dXJl'
+
+class NotaryReplyTestCases(unittest.TestCase):
+	"""Test building notary replies."""
+
+	SERVICE = 'github.com:443,2'
+	KEYS = [('00:11:22:33:44:55:66:77:88:99:aa:bb:cc:dd:ee:ff', [(10, 20), (30, 40)]),
+		('ff:ee:dd:cc:bb:aa:99:88:77:66:55:44:33:22:11:00', [(21, 29)])]
+
+	@classmethod
+	def setUpClass(cls):
+		# generate the key in-process so tests don't depend on the version of the openssl binary
+		cls.rsa = RSA.gen_key(1024, 65537, lambda *args: None)
+		cls.signer = crypto.Signer(cls.rsa.as_pem(cipher=None))
+
+	def test_reply_matches_minidom_layout(self):
+		# this is the output of the xml.dom.minidom code that notaries used to build replies with.
+		expected = '<notary_reply sig="c2lnbmF0dXJl" sig_type="rsa-md5" version="1">\n' +\
+			'\t<key fp="00:11:22:33:44:55:66:77:88:99:aa:bb:cc:dd:ee:ff" type="ssl">\n' +\
+			'\t\t<timestamp end="20" start="10"/>\n' +\
+			'\t\t<timestamp end="40" start="30"/>\n' +\
+			'\t</key>\n' +\
+			'\t<key fp="ff:ee:dd:cc:bb:aa:99:88:77:66:55:44:33:22:11:00" type="ssl">\n' +\
+			'\t\t<timestamp end="29" start="21"/>\n' +\
+			'\t</key>\n' +\
+			'</notary_reply>\n'
+		xml = notary_reply.build_reply(self.SERVICE, '2', self.KEYS, RecordingSigner())
+		self.assertTrue(xml == expected)
+
+	def test_signed_data_lists_keys_in_reverse(self):
+		signer = RecordingSigner()
+		notary_reply.build_reply(self.SERVICE, '2', self.KEYS, signer)
+
+		expected = self.SERVICE + '\x00' +\
+			'\x00\x01\x00\x10\x03' + '\xff\xee\xdd\xcc\xbb\xaa\x99\x88\x77\x66\x55\x44\x33\x22\x11\x00' +\
+			'\x00\x00\x00\x15\x00\x00\x00\x1d' +\
+			'\x00\x02\x00\x10\x03' + '\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xaa\xbb\xcc\xdd\xee\xff' +\
+			'\x00\x00\x00\x0a\x00\x00\x00\x14\x00\x00\x00\x1e\x00\x00\x00\x28'
+		self.assertTrue(signer.content == expected)
+
+	def test_pack_fingerprint(self):
+		self.assertTrue(notary_reply.pack_fingerprint('aa:bb:0c') == '\xaa\xbb\x0c')
+		# single hex digits should be packed the same way clients pack them
+		self.assertTrue(notary_reply.pack_fingerprint('aa:b:c') == '\xaa\x0b\x0c')
+
+	def test_clients_can_verify_reply(self):
+		bio = BIO.MemoryBuffer()
+		self.rsa.save_pub_key_bio(bio)
+		pub_key = bio.read()
+
+		xml = notary_reply.build_reply(self.SERVICE, '2', self.KEYS, self.signer)
+		self.assertTrue(client_common.verify_notary_signature(self.SERVICE, xml, pub_key) == 1)
+
+	def test_cache_entry_renders_same_reply(self):
+		entry = notary_reply.build_cache_entry(self.SERVICE, '2', self.KEYS, self.signer)
+		xml = notary_reply.build_reply(self.SERVICE, '2', self.KEYS, self.signer)
+		self.assertTrue(notary_reply.render_cache_entry(entry) == xml)
+		self.assertTrue(len(entry) < len(xml))
+
+	def test_cache_entry_not_built_for_non_canonical_keys(self):
+		for key in ['aa:b:c', 'AA:BB:CC:DD:EE:FF:00:11:22:33:44:55:66:77:88:99', 'aa:bb:cc']:
+			self.assertTrue(notary_reply.build_cache_entry(self.SERVICE, '2', [(key, [(1, 2)])], self.signer) == None)
+
+	def test_xml_cache_entry_returned_unchanged(self):
+		xml = notary_reply.build_reply(self.SERVICE, '2', self.KEYS, RecordingSigner())
+		self.assertTrue(notary_reply.render_cache_entry(xml) == xml)
+
+	def test_invalid_cache_entry_rejected(self):
+		entry = notary_reply.build_cache_entry(self.SERVICE, '2', self.KEYS, self.signer)
+		self.assertRaises(ValueError, notary_reply.render_cache_entry, '\x02' + entry[1:])
+		self.assertRaises(ValueError, notary_reply.render_cache_entry, entry[:-1])
+		self.assertRaises(ValueError, notary_reply.render_cache_entry, entry[:10])
@@ -0,0 +1,149 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# TODO: HACK
+# add ..\notary_util to the import path
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from M2Crypto import RSA
+
+from notary_util import build_response_store
+from notary_util import notary_db
+from notary_util import notary_reply
+from notary_util import notary_response_store
+from util import crypto
+
+class ResponseStoreTestCases(unittest.TestCase):
+	"""Test writing response stores and looking up replies in them."""
+
+	TEST_DATABASE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+		'notary.unit_test.sqlite')
+
+	PUBLIC_KEY = '-----BEGIN PUBLIC KEY-----\nnot a real key\n-----END PUBLIC KEY-----\n'
+
+	class DBArgs():
+		"""
+		Simple class to create an extendable namespace.
+		For passing arguments to ndb.
+		"""
+		pass
+
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.temp_dir, 'responses')
+
+	def tearDown(self):
+		shutil.rmtree(self.temp_dir)
+
+	def write(self, entries, path=None, built_time=None):
+		writer = notary_response_store.ResponseStoreWriter(path or self.path, self.PUBLIC_KEY, built_time)
+		for (service, entry) in entries:
+			writer.add(service, entry)
+		writer.close()
+
+	#######
+
+	def test_lookup(self):
+		entries = [('host{0}.com:443,2'.format(i), 'entry {0}'.format(i) * (i % 7)) for i in xrange(1000)]
+		self.write(entries, built_time=1400000000)
+		store = notary_response_store.ResponseStore(self.path)
+		for (service, entry) in entries:
+			self.assertTrue(store.get(service) == entry)
+		self.assertTrue(store.get(u'host5.com:443,2') == entries[5][1])
+		self.assertTrue(store.get('host1000.com:443,2') == None)
+		self.assertTrue(store.get('') == None)
+		self.assertTrue(store.get_public_key() == self.PUBLIC_KEY)
+		self.assertTrue(store.get_stats() == (1000, 1400000000))
+		self.assertTrue(not os.path.exists(self.path + '.tmp'))
+
+	def test_empty_store(self):
+		self.write([])
+		store = notary_response_store.ResponseStore(self.path)
+		self.assertTrue(store.get('a.com:443,2') == None)
+		self.assertTrue(store.get_stats()[0] == 0)
+
+	def test_hash_collisions(self):
+		# make every service have the same hash, so lookups must compare names
+		original_hash = notary_response_store.service_hash
+		notary_response_store.service_hash = lambda service: 42
+		try:
+			self.write([('b.com:443,2', 'b'), ('a.com:443,2', 'a'), ('c.com:443,2', 'c')])
+			store = notary_response_store.ResponseStore(self.path)
+			self.assertTrue(store.get('a.com:443,2') == 'a')
+			self.assertTrue(store.get('b.com:443,2') == 'b')
+			self.assertTrue(store.get('c.com:443,2') == 'c')
+			self.assertTrue(store.get('d.com:443,2') == None)
+		finally:
+			notary_response_store.service_hash = original_hash
+
+	def test_reload_after_rebuild(self):
+		self.write([('a.com:443,2', 'old')])
+		store = notary_response_store.ResponseStore(self.path, reload_interval=0)
+		self.assertTrue(store.get('a.com:443,2') == 'old')
+		self.write([('a.com:443,2', 'new'), ('b.com:443,2', 'b')])
+		self.assertTrue(store.get('a.com:443,2') == 'new')
+		self.assertTrue(store.get('b.com:443,2') == 'b')
+
+		# a broken file is not loaded, and the last good one is still used.
+		# (files must be replaced, not overwritten, as changes to the mapped file show through.)
+		with open(self.path + '.broken', 'wb') as broken:
+			broken.write('garbage' * 100)
+		os.rename(self.path + '.broken', self.path)
+		self.assertTrue(store.get('b.com:443,2') == 'b')
+
+	def test_invalid_file(self):
+		self.write([('a.com:443,2', 'a')])
+		with open(self.path, 'rb') as store_file:
+			data = store_file.read()
+
+		for invalid in ['', 'not a response store' * 10, data[:-1],
+			notary_response_store.MAGIC + chr(notary_response_store.VERSION + 1) + data[len(notary_response_store.MAGIC) + 1:]]:
+			with open(self.path, 'wb') as store_file:
+				store_file.write(invalid)
+			self.assertRaises(notary_response_store.ResponseStoreError, notary_response_store.ResponseStore, self.path)
+
+	def test_build_from_database(self):
+		db_args = self.DBArgs()
+		db_args.dbname = self.TEST_DATABASE
+		db = notary_db.ndb(db_args)
+		keys = [('00:11:22:33:44:55:66:77:88:99:aa:bb:cc:dd:ee:ff', [(10, 20), (30, 40)]),
+			('aa:bb', [(21, 29)])]
+		for (key, timespans) in keys:
+			for (start, end) in timespans:
+				db._insert_observation('response_store_test:443,2', key, start, end)
+		db._insert_observation('response_store_test:443,99', 'aa:bb', 1, 2)
+
+		# generate the key in-process so tests don't depend on the version of the openssl binary
+		signer = crypto.Signer(RSA.gen_key(1024, 65537, lambda *args: None).as_pem(cipher=None))
+		num_services = build_response_store.main(db, signer, self.PUBLIC_KEY, self.path)
+		self.assertTrue(num_services > 0)
+
+		store = notary_response_store.ResponseStore(self.path)
+		self.assertTrue(store.get_stats()[0] == num_services)
+		reply = notary_reply.render_cache_entry(store.get('response_store_test:443,2'))
+		self.assertTrue(reply == notary_reply.build_reply('response_store_test:443,2', '2', keys, signer))
+		self.assertTrue(store.get('response_store_test:443,99') == None)
+
+		# only recent observations
+		build_response_store.main(db, signer, self.PUBLIC_KEY, self.path, history_days=1)
+		self.assertTrue(notary_response_store.ResponseStore(self.path).get('response_store_test:443,2') == None)
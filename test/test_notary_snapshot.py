@@ -0,0 +1,126 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import StringIO
+import sys
+import unittest
+
+# TODO: HACK
+# add ..\notary_util to the import path
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from notary_util import notary_snapshot
+
+class Pipe(object):
+	"""A file that can only be read from start to end."""
+	def __init__(self, data):
+		self.data = StringIO.StringIO(data)
+
+	def read(self, size):
+		return self.data.read(size)
+
+	def tell(self):
+		raise IOError("Illegal seek")
+
+	def seek(self, offset, whence=0):
+		raise IOError("Illegal seek")
+
+class NotarySnapshotTestCases(unittest.TestCase):
+	"""Test writing and reading binary snapshots."""
+
+	MD5_KEY = '00:11:22:33:44:55:66:77:88:99:aa:bb:cc:dd:ee:ff'
+	SERVICES = [
+		('a.com:443,2', [(MD5_KEY, [(1400000000, 1400000100), (1400000050, 1400000060)]),
+			('AA:BB', [(5, 5)])]),
+		('a.com:8443,2', []),
+		('b.com:22,1', [('a:b:c', [(0, 1400000000)]), (MD5_KEY, [(1300000000, 1300000001)])]),
+		('c.com:443,2', [(MD5_KEY, [(1, 2)])]),
+		]
+
+	def write(self, services, block_size=notary_snapshot.DEFAULT_BLOCK_SIZE):
+		output = StringIO.StringIO()
+		writer = notary_snapshot.SnapshotWriter(output, block_size)
+		for (service, keys) in services:
+			writer.write_service(service, keys)
+		writer.close()
+		return output.getvalue()
+
+	def read(self, data, after_service=None):
+		return list(notary_snapshot.SnapshotReader(StringIO.StringIO(data)).read_services(after_service))
+
+	#######
+
+	def test_round_trip(self):
+		data = self.write(self.SERVICES)
+		self.assertTrue(notary_snapshot.is_snapshot(data))
+		self.assertTrue(self.read(data) == self.SERVICES)
+		# every block can hold one service or many
+		self.assertTrue(self.read(self.write(self.SERVICES, block_size=1)) == self.SERVICES)
+
+	def test_unicode_names_written_as_utf8(self):
+		data = self.write([(u'a.com:443,2', [(unicode(self.MD5_KEY), [(1, 2)])])])
+		self.assertTrue(self.read(data) == [('a.com:443,2', [(self.MD5_KEY, [(1, 2)])])])
+
+	def test_md5_keys_stored_as_bytes(self):
+		md5 = self.write([('a.com:443,2', [(self.MD5_KEY, [(1, 2)])])])
+		upper = self.write([('a.com:443,2', [(self.MD5_KEY.upper(), [(1, 2)])])])
+		self.assertTrue(self.MD5_KEY not in md5)
+		self.assertTrue(len(md5) < len(upper))
+		self.assertTrue(self.read(upper)[0][1][0][0] == self.MD5_KEY.upper())
+
+	def test_index(self):
+		data = self.write(self.SERVICES, block_size=2)
+		index = notary_snapshot.SnapshotReader(StringIO.StringIO(data)).get_index()
+		self.assertTrue([entry[1:] for entry in index] == [(1, 3, 'a.com:443,2', 'a.com:443,2'),
+			(2, 2, 'a.com:8443,2', 'b.com:22,1'), (1, 1, 'c.com:443,2', 'c.com:443,2')])
+		self.assertTrue(data[index[1][0]] == notary_snapshot.BLOCK_MARKER)
+
+	def test_read_after_service(self):
+		data = self.write(self.SERVICES, block_size=1)
+		self.assertTrue(self.read(data, 'a.com:443,2') == self.SERVICES[1:])
+		self.assertTrue(self.read(data, 'b') == self.SERVICES[2:])
+		self.assertTrue(self.read(data, 'c.com:443,2') == [])
+
+	def test_read_pipe(self):
+		data = self.write(self.SERVICES, block_size=1)
+		reader = notary_snapshot.SnapshotReader(Pipe(data))
+		self.assertTrue(reader.get_index() == None)
+		self.assertTrue(list(reader.read_services()) == self.SERVICES)
+		self.assertRaises(notary_snapshot.SnapshotError, list,
+			notary_snapshot.SnapshotReader(Pipe(data)).read_services('b'))
+
+	def test_services_must_be_sorted(self):
+		writer = notary_snapshot.SnapshotWriter(StringIO.StringIO())
+		writer.write_service('b.com:443,2', [])
+		self.assertRaises(ValueError, writer.write_service, 'a.com:443,2', [])
+		self.assertRaises(ValueError, writer.write_service, 'b.com:443,2', [])
+		self.assertRaises(ValueError, writer.write_service, 'c.com:443,2', [(self.MD5_KEY, [(2, 1)])])
+
+	def test_invalid_data(self):
+		data = self.write(self.SERVICES)
+		self.assertRaises(notary_snapshot.SnapshotError, self.read, 'not a snapshot')
+		self.assertRaises(notary_snapshot.SnapshotError, self.read, data[:len(data) // 2])
+
+		# change one byte of the compressed block
+		block = len(notary_snapshot.MAGIC) + notary_snapshot.HEADER.size + notary_snapshot.BLOCK_HEAD.size
+		corrupt = data[:block + 5] + chr(ord(data[block + 5]) ^ 0xff) + data[block + 6:]
+		self.assertRaises(notary_snapshot.SnapshotError, self.read, corrupt)
+
+		# a newer version
+		newer = notary_snapshot.MAGIC + notary_snapshot.HEADER.pack(notary_snapshot.VERSION + 1, 1)
+		self.assertRaises(notary_snapshot.SnapshotError, self.read, newer + data[len(newer):])
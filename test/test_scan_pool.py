@@ -0,0 +1,154 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import threading
+import unittest
+
+# TODO: HACK
+# add ..\util to the import path
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from util.scan_pool import ScanPool
+
+class BlockingScanner(object):
+	"""Record scanned services, blocking each scan until released."""
+
+	TIMEOUT = 10 # seconds
+
+	def __init__(self):
+		self.scanned = []
+		self.started = threading.Semaphore(0)
+		self.release = threading.Event()
+
+	def scan(self, service):
+		self.started.release()
+		self.release.wait(self.TIMEOUT)
+		self.scanned.append(service)
+
+	def wait_for_start(self):
+		self.started.acquire()
+
+class ScanPoolTestCases(unittest.TestCase):
+	"""Test the background scan pool."""
+
+	def test_services_scanned(self):
+		scanned = []
+		pool = ScanPool(scanned.append, 2, 10)
+		self.assertTrue(pool.submit('a:443,2') == ScanPool.QUEUED)
+		self.assertTrue(pool.submit('b:443,2') == ScanPool.QUEUED)
+		pool.stop()
+		self.assertTrue(sorted(scanned) == ['a:443,2', 'b:443,2'])
+
+		stats = pool.get_stats()
+		self.assertTrue(stats['finished'] == 2)
+		self.assertTrue(stats['queue_depth'] == 0)
+		self.assertTrue(stats['in_progress'] == 0)
+		self.assertTrue(0 <= stats['avg_scan_time'] <= stats['max_scan_time'])
+		self.assertTrue(0 <= stats['avg_wait_time'] <= stats['max_wait_time'])
+
+	def test_duplicate_services_scanned_once(self):
+		scanner = BlockingScanner()
+		pool = ScanPool(scanner.scan, 1, 10)
+
+		# one copy being scanned...
+		self.assertTrue(pool.submit('a:443,2') == ScanPool.QUEUED)
+		scanner.wait_for_start()
+		self.assertTrue(pool.submit('a:443,2') == ScanPool.ALREADY_QUEUED)
+
+		# ...and one copy waiting in the queue
+		self.assertTrue(pool.submit('b:443,2') == ScanPool.QUEUED)
+		self.assertTrue(pool.submit('b:443,2') == ScanPool.ALREADY_QUEUED)
+
+		scanner.release.set()
+		pool.stop()
+		self.assertTrue(scanner.scanned == ['a:443,2', 'b:443,2'])
+		self.assertTrue(pool.get_stats()['duplicates'] == 2)
+
+		# once a scan finishes the service can be queued again
+		pool = ScanPool(scanner.scan, 1, 10)
+		self.assertTrue(pool.submit('a:443,2') == ScanPool.QUEUED)
+		pool.stop()
+
+	def test_full_queue_rejects_services(self):
+		scanner = BlockingScanner()
+		pool = ScanPool(scanner.scan, 1, 2)
+
+		pool.submit('running:443,2')
+		scanner.wait_for_start()
+		self.assertTrue(pool.submit('a:443,2') == ScanPool.QUEUED)
+		self.assertTrue(pool.submit('b:443,2') == ScanPool.QUEUED)
+		self.assertTrue(pool.get_queue_depth() == 2)
+		self.assertTrue(pool.submit('c:443,2') == ScanPool.QUEUE_FULL)
+
+		stats = pool.get_stats()
+		self.assertTrue(stats['rejected'] == 1)
+		self.assertTrue(stats['in_progress'] == 1)
+
+		scanner.release.set()
+		pool.stop()
+		self.assertTrue(scanner.scanned == ['running:443,2', 'a:443,2', 'b:443,2'])
+
+	def test_high_priority_scanned_first(self):
+		scanner = BlockingScanner()
+		pool = ScanPool(scanner.scan, 1, 10)
+
+		pool.submit('running:443,2')
+		scanner.wait_for_start()
+		pool.submit('normal:443,2')
+		pool.submit('high:443,2', ScanPool.PRIORITY_HIGH)
+		pool.submit('normal_2:443,2')
+
+		scanner.release.set()
+		pool.stop()
+		self.assertTrue(scanner.scanned == ['running:443,2', 'high:443,2', 'normal:443,2', 'normal_2:443,2'])
+
+	def test_scan_errors_do_not_stop_workers(self):
+		scanned = []
+
+		def scan(service):
+			if (service == 'bad:443,2'):
+				raise ValueError("scan failed")
+			scanned.append(service)
+
+		pool = ScanPool(scan, 1, 10)
+		pool.submit('bad:443,2')
+		pool.submit('good:443,2')
+		pool.stop()
+		self.assertTrue(scanned == ['good:443,2'])
+		self.assertTrue(pool.get_stats()['finished'] == 2)
+
+	def test_invalid_sizes_rejected(self):
+		self.assertRaises(ValueError, ScanPool, None, 0, 10)
+		self.assertRaises(ValueError, ScanPool, None, 1, 0)
+
+	def test_wait_for_scan(self):
+		scanner = BlockingScanner()
+		pool = ScanPool(scanner.scan, 1, 10)
+
+		# services that aren't queued don't need to be waited for
+		self.assertTrue(pool.wait('a:443,2', 0.01))
+
+		pool.submit('a:443,2')
+		scanner.wait_for_start()
+		self.assertTrue(pool.wait('a:443,2', 0.01) == False)
+
+		scanner.release.set()
+		self.assertTrue(pool.wait('a:443,2', BlockingScanner.TIMEOUT))
+		self.assertTrue(scanner.scanned == ['a:443,2'])
+		pool.stop()
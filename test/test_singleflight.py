@@ -0,0 +1,149 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+# TODO: HACK
+# add ..\util to the import path
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from util.singleflight import SingleFlight, SingleFlightTimeout
+
+class SingleFlightTestCases(unittest.TestCase):
+	"""Test coalescing duplicate work."""
+
+	WAITERS = 5
+	TIMEOUT = 10 # seconds
+
+	def start_flight(self, flight, key, func):
+		"""Start a thread that calls func() through flight, and wait until it is running."""
+		started = threading.Event()
+		release = threading.Event()
+		results = []
+
+		def leader_func():
+			started.set()
+			release.wait(self.TIMEOUT)
+			return func()
+
+		def call():
+			try:
+				results.append(flight.do(key, leader_func, self.TIMEOUT))
+			except Exception as e:
+				results.append(e)
+
+		t = threading.Thread(target=call)
+		t.start()
+		started.wait(self.TIMEOUT)
+		return (t, release, results)
+
+	def run_waiters(self, flight, key, func):
+		"""Call flight.do() from several threads and return the threads and their results."""
+		results = []
+
+		def call():
+			try:
+				results.append(flight.do(key, func, self.TIMEOUT))
+			except Exception as e:
+				results.append(e)
+
+		threads = [threading.Thread(target=call) for i in range(self.WAITERS)]
+		for t in threads:
+			t.start()
+		return (threads, results)
+
+	def wait_for_waiters(self, flight, count):
+		"""Spin until 'count' callers are waiting on the flight."""
+		while (flight.get_stats()[0] < count):
+			time.sleep(0.01)
+
+	def test_single_call(self):
+		flight = SingleFlight()
+		self.assertTrue(flight.do('key', lambda: 'value', self.TIMEOUT) == 'value')
+		self.assertTrue(flight.get_stats() == (0, 0))
+
+	def test_concurrent_calls_share_result(self):
+		flight = SingleFlight()
+		calls = []
+
+		def work():
+			calls.append(1)
+			return 'value'
+
+		(leader, release, leader_results) = self.start_flight(flight, 'key', work)
+		(threads, results) = self.run_waiters(flight, 'key', work)
+		self.wait_for_waiters(flight, self.WAITERS)
+		release.set()
+
+		leader.join()
+		for t in threads:
+			t.join()
+
+		self.assertTrue(len(calls) == 1)
+		self.assertTrue(leader_results == ['value'])
+		self.assertTrue(results == ['value'] * self.WAITERS)
+		self.assertTrue(flight.get_stats() == (self.WAITERS, 0))
+
+	def test_concurrent_calls_share_error(self):
+		flight = SingleFlight()
+
+		def work():
+			raise ValueError("no data")
+
+		(leader, release, leader_results) = self.start_flight(flight, 'key', work)
+		(threads, results) = self.run_waiters(flight, 'key', work)
+		self.wait_for_waiters(flight, self.WAITERS)
+		release.set()
+
+		leader.join()
+		for t in threads:
+			t.join()
+
+		self.assertTrue(isinstance(leader_results[0], ValueError))
+		self.assertTrue(all([r is leader_results[0] for r in results]))
+
+	def test_different_keys_not_coalesced(self):
+		flight = SingleFlight()
+		(leader, release, leader_results) = self.start_flight(flight, 'key', lambda: 'value')
+		try:
+			self.assertTrue(flight.do('other key', lambda: 'other value', self.TIMEOUT) == 'other value')
+			self.assertTrue(flight.get_stats() == (0, 0))
+		finally:
+			release.set()
+			leader.join()
+
+	def test_waiter_times_out(self):
+		flight = SingleFlight()
+		(leader, release, leader_results) = self.start_flight(flight, 'key', lambda: 'value')
+		try:
+			self.assertRaises(SingleFlightTimeout, flight.do, 'key', lambda: 'other value', 0.01)
+			self.assertTrue(flight.get_stats() == (1, 1))
+		finally:
+			release.set()
+			leader.join()
+		self.assertTrue(leader_results == ['value'])
+
+	def test_key_forgotten_after_call(self):
+		flight = SingleFlight()
+		self.assertTrue(flight.do('key', lambda: 'first', self.TIMEOUT) == 'first')
+		self.assertTrue(flight.do('key', lambda: 'second', self.TIMEOUT) == 'second')
+		self.assertRaises(ValueError, flight.do, 'key', lambda: int('x'), self.TIMEOUT)
+		self.assertTrue(flight.do('key', lambda: 'third', self.TIMEOUT) == 'third')
@@ -0,0 +1,150 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import socket
+import sys
+import unittest
+
+# TODO: HACK
+# add ..\util to the import path
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import fake_tls_server
+from fake_tls_server import FakeTLSServer
+from util.ssl_scan_async import AsyncScanner, _Resolver
+from util.ssl_scan_sock import attempt_observation_for_service, SSLAlertException, SSLScanTimeoutException
+
+class AsyncScannerTestCases(unittest.TestCase):
+	"""Test the event loop scanner against a local fake server."""
+
+	TIMEOUT = 2 # seconds
+
+	def scan(self, services, sni=False, timeout=TIMEOUT, max_connections=100):
+		"""Scan services and return a dictionary of service name -> (fingerprint, error)."""
+		results = {}
+		def on_result(service, fp, error):
+			results[service] = (fp, error)
+		AsyncScanner(timeout, sni, max_connections).scan(services, None, on_result)
+		return results
+
+	def test_fingerprint_matches_standard_scanner(self):
+		server = FakeTLSServer(fake_tls_server.CERT)
+		try:
+			service = server.get_service()
+			(fp, error) = self.scan([service])[service]
+			self.assertTrue(error == None)
+			self.assertTrue(fp == fake_tls_server.CERT_FINGERPRINT)
+			self.assertTrue(fp == attempt_observation_for_service(service, self.TIMEOUT))
+		finally:
+			server.stop()
+
+	def test_many_services_at_once(self):
+		server = FakeTLSServer(fake_tls_server.CERT)
+		try:
+			services = [server.get_service() + str(i) for i in range(50)]
+			# the ',2' + number suffix is ignored when connecting, so these are all the same server
+			results = self.scan(services, max_connections=10)
+			self.assertTrue(len(results) == 50)
+			for (fp, error) in results.values():
+				self.assertTrue(fp == fake_tls_server.CERT_FINGERPRINT)
+			self.assertTrue(server.connection_count == 50)
+		finally:
+			server.stop()
+
+	def test_paused_scans_not_started(self):
+		server = FakeTLSServer(fake_tls_server.CERT)
+		try:
+			counts = {'started': 0, 'finished': 0, 'max_active': 0}
+			def services():
+				for i in range(10):
+					counts['started'] += 1
+					counts['max_active'] = max(counts['max_active'], counts['started'] - counts['finished'])
+					yield server.get_service() + str(i)
+			def on_result(service, fp, error):
+				counts['finished'] += 1
+			# only allow one scan at a time
+			can_start = lambda: counts['started'] == counts['finished']
+
+			AsyncScanner(self.TIMEOUT).scan(services(), None, on_result, can_start)
+			self.assertTrue(counts['finished'] == 10)
+			self.assertTrue(counts['max_active'] == 1)
+		finally:
+			server.stop()
+
+	def test_alert(self):
+		server = FakeTLSServer(fake_tls_server.ALERT)
+		try:
+			(fp, error) = self.scan([server.get_service()])[server.get_service()]
+			self.assertTrue(fp == None)
+			self.assertTrue(isinstance(error, SSLAlertException))
+		finally:
+			server.stop()
+
+	def test_sni_alert_retried_without_sni(self):
+		server = FakeTLSServer(fake_tls_server.SNI_ALERT)
+		try:
+			service = server.get_service('localhost')
+			(fp, error) = self.scan([service], sni=True)[service]
+			self.assertTrue(fp == fake_tls_server.CERT_FINGERPRINT)
+			self.assertTrue(server.connection_count == 2)
+			self.assertTrue(server.sni_count == 1)
+		finally:
+			server.stop()
+
+	def test_timeout(self):
+		server = FakeTLSServer(fake_tls_server.STALL)
+		try:
+			(fp, error) = self.scan([server.get_service()], timeout=0.5)[server.get_service()]
+			self.assertTrue(fp == None)
+			self.assertTrue(isinstance(error, SSLScanTimeoutException))
+		finally:
+			server.stop()
+
+	def test_connection_closed(self):
+		server = FakeTLSServer(fake_tls_server.CLOSE)
+		try:
+			(fp, error) = self.scan([server.get_service()])[server.get_service()]
+			self.assertTrue(fp == None)
+			self.assertTrue(isinstance(error, socket.error))
+		finally:
+			server.stop()
+
+	def test_connection_refused(self):
+		server = FakeTLSServer(fake_tls_server.CERT)
+		service = server.get_service()
+		server.stop()
+		(fp, error) = self.scan([service])[service]
+		self.assertTrue(fp == None)
+		self.assertTrue(isinstance(error, socket.error))
+
+	def test_invalid_services(self):
+		results = self.scan(['testsite.com', 'testsite.com:a', '127.0.0.1:443,2'], sni=True)
+		self.assertTrue(len(results) == 3)
+		for (fp, error) in results.values():
+			self.assertTrue(fp == None)
+			self.assertTrue(isinstance(error, ValueError))
+
+	def test_resolver_close_waits_for_threads(self):
+		resolver = _Resolver(2)
+		for i in range(20):
+			resolver.resolve(i, 'localhost', 443)
+		resolver.close()
+		# no thread is left that could write to the closed pipe's fd numbers
+		for t in resolver.threads:
+			self.assertTrue(not t.is_alive())
+		self.assertTrue(resolver.requests.empty())
@@ -16,6 +16,7 @@
 
 import os
 import sys
+import time
 import unittest
 
 # TODO: HACK
@@ -23,7 +24,9 @@ import unittest
 sys.path.insert(0,
 	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 
-from util.ssl_scan_sock import attempt_observation_for_service
+import fake_tls_server
+from fake_tls_server import FakeTLSServer
+from util.ssl_scan_sock import attempt_observation_for_service, SSLAlertException, SSLScanTimeoutException
 
 class SSLScanSockTestCases(unittest.TestCase):
 	"""Test the standalone scanner."""
@@ -38,6 +41,41 @@ class SSLScanSockTestCases(unittest.TestCase):
 		self.assertRaises(ValueError, attempt_observation_for_service, 'testsite.com:a', 10, False)
 		self.assertRaises(ValueError, attempt_observation_for_service, 'testsite.com:a', 10, True)
 
+	def test_fake_server(self):
+		server = FakeTLSServer(fake_tls_server.CERT)
+		try:
+			fp = attempt_observation_for_service(server.get_service(), 10, False)
+			self.assertTrue(fp == fake_tls_server.CERT_FINGERPRINT)
+		finally:
+			server.stop()
+
+	def test_alert(self):
+		server = FakeTLSServer(fake_tls_server.ALERT)
+		try:
+			self.assertRaises(SSLAlertException, attempt_observation_for_service, server.get_service(), 10, False)
+		finally:
+			server.stop()
+
+	def test_timeout_covers_whole_handshake(self):
+		server = FakeTLSServer(fake_tls_server.STALL)
+		try:
+			start = time.time()
+			self.assertRaises(SSLScanTimeoutException, attempt_observation_for_service, server.get_service(), 0.5, False)
+			self.assertTrue(time.time() - start < 2)
+		finally:
+			server.stop()
+
+	def test_connection_closed(self):
+		server = FakeTLSServer(fake_tls_server.CLOSE)
+		try:
+			# socket errors are logged rather than raised
+			start = time.time()
+			self.assertTrue(attempt_observation_for_service(server.get_service(), 10, False) == None)
+			# and we shouldn't wait for the timeout to notice
+			self.assertTrue(time.time() - start < 2)
+		finally:
+			server.stop()
+
 	# TODO: implement --dry-run mode so we can run tests without actually scanning
 	#def test_valid_site(self):
 	#	self.assertTrue(attempt_observation_for_service('testsite.com:443', 10, False))
@@ -0,0 +1,114 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+# TODO: HACK
+# add ..\notary_util to the import path
+sys.path.insert(0,
+	os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from notary_util.threaded_scanner import ResultWriter, get_parser
+
+class RecordingDB(object):
+	"""Record batches of observations instead of writing them, optionally blocking each write until released."""
+
+	TIMEOUT = 10 # seconds
+
+	def __init__(self, block=False):
+		self.batches = []
+		self.release = threading.Event()
+		if not (block):
+			self.release.set()
+
+	def report_observations(self, results):
+		self.release.wait(self.TIMEOUT)
+		self.batches.append(results)
+
+class ResultWriterTestCases(unittest.TestCase):
+	"""Test the background result writer."""
+
+	def test_results_written_in_batches(self):
+		db = RecordingDB()
+		writer = ResultWriter(db, max_pending=100, batch_size=2, batch_wait=60)
+		writer.start()
+		for i in range(5):
+			writer.add(('service{0}:443,2'.format(i), 'aa:bb'))
+		writer.stop()
+
+		# full batches are written straight away; the rest once we stop
+		self.assertTrue([len(batch) for batch in db.batches] == [2, 2, 1])
+		self.assertTrue(db.batches[0][0] == ('service0:443,2', 'aa:bb'))
+		stats = writer.get_stats()
+		self.assertTrue(stats['written'] == 5)
+		self.assertTrue(stats['batches'] == 3)
+		self.assertTrue(stats['pending'] == 0)
+
+	def test_partial_batch_written_after_wait(self):
+		db = RecordingDB()
+		writer = ResultWriter(db, max_pending=100, batch_size=100, batch_wait=0.1)
+		writer.start()
+		writer.add(('service:443,2', 'aa:bb'))
+		time.sleep(1)
+		self.assertTrue(len(db.batches) == 1)
+		self.assertTrue(writer.get_stats()['max_lag'] >= 0.1)
+		writer.stop()
+
+	def test_full_writer_has_no_room(self):
+		db = RecordingDB(block=True)
+		writer = ResultWriter(db, max_pending=2, batch_size=1, batch_wait=0)
+		writer.start()
+
+		# the first result is taken by the (blocked) write...
+		writer.add(('service0:443,2', 'aa:bb'))
+		while (writer.get_stats()['pending'] > 0):
+			time.sleep(0.01)
+		# ...and the rest wait
+		writer.add(('service1:443,2', 'aa:bb'))
+		self.assertTrue(writer.has_room())
+		writer.add(('service2:443,2', 'aa:bb'))
+		self.assertTrue(writer.has_room() == False)
+		# results are never refused
+		writer.add(('service3:443,2', 'aa:bb'))
+		self.assertTrue(writer.get_stats()['pending'] == 3)
+
+		db.release.set()
+		writer.wait_for_room()
+		writer.stop()
+		self.assertTrue(writer.get_stats()['written'] == 4)
+
+	def test_result_after_stop_written(self):
+		db = RecordingDB()
+		writer = ResultWriter(db, max_pending=100, batch_size=100, batch_wait=60)
+		writer.start()
+		writer.stop()
+		# e.g. from a scan that outlived the give-up deadline
+		writer.add(('late:443,2', 'aa:bb'))
+		self.assertTrue(db.batches == [[('late:443,2', 'aa:bb')]])
+		self.assertTrue(writer.get_stats()['written'] == 1)
+
+	def test_invalid_settings(self):
+		db = RecordingDB()
+		self.assertRaises(ValueError, ResultWriter, db, max_pending=0)
+		self.assertRaises(ValueError, ResultWriter, db, batch_size=0)
+		self.assertRaises(ValueError, ResultWriter, db, batch_wait=-1)
+
+		for option in ['--max-pending-results', '--write-batch-size', '--write-interval']:
+			self.assertRaises(SystemExit, get_parser().parse_args, [option, '0'])
@@ -26,10 +26,21 @@ from __future__ import print_function
 import argparse
 import unittest
 
+import test_cache
+import test_crypto
+import test_db2file
+import test_file2db
 import test_list_services
 import test_notary_db
+import test_notary_reply
+import test_notary_response_store
+import test_notary_snapshot
 import test_pycache
+import test_scan_pool
+import test_singleflight
+import test_ssl_scan_async
 import test_ssl_scan_sock
+import test_threaded_scanner
 
 parser = argparse.ArgumentParser(description=__doc__)
 
@@ -38,9 +49,20 @@ if __name__ == '__main__':
 	args = parser.parse_args()
 
 	all_tests = unittest.TestSuite([
+		unittest.TestLoader().loadTestsFromModule(test_cache),
+		unittest.TestLoader().loadTestsFromModule(test_crypto),
+		unittest.TestLoader().loadTestsFromModule(test_db2file),
+		unittest.TestLoader().loadTestsFromModule(test_file2db),
 		unittest.TestLoader().loadTestsFromModule(test_list_services),
 		unittest.TestLoader().loadTestsFromModule(test_notary_db),
+		unittest.TestLoader().loadTestsFromModule(test_notary_reply),
+		unittest.TestLoader().loadTestsFromModule(test_notary_response_store),
+		unittest.TestLoader().loadTestsFromModule(test_notary_snapshot),
 		unittest.TestLoader().loadTestsFromModule(test_pycache),
+		unittest.TestLoader().loadTestsFromModule(test_scan_pool),
+		unittest.TestLoader().loadTestsFromModule(test_singleflight),
+		unittest.TestLoader().loadTestsFromModule(test_ssl_scan_async),
 		unittest.TestLoader().loadTestsFromModule(test_ssl_scan_sock),
+		unittest.TestLoader().loadTestsFromModule(test_threaded_scanner),
 	])
 	unittest.TextTestRunner(verbosity=2).run(all_tests)
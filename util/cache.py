@@ -19,9 +19,12 @@ Cache and retrieve data in key-value pairs.
 """
 
 import abc
+import collections
 import logging
 import os
 import sys
+import threading
+import time
 
 
 class CacheBase(object):
@@ -306,3 +309,74 @@ class Pycache(CacheBase):
 				logging.error("pycache set() error: '{0}'.".format(e))
 		else:
 			logging.error("pycache set() error: cache does not exist! create it before setting values.")
+
+
+class NegativeCache(object):
+	"""
+	Remember keys that recently had no data, so we can skip looking them up again.
+
+	Entries are kept in RAM on the local machine, separately from the main cache,
+	and are forgotten after a short time so new data is noticed.
+	The number of entries is limited; when the cache is full the oldest entry is discarded.
+	"""
+
+	CACHE_SIZE = 10000 # entries
+	CACHE_EXPIRY = 60 # seconds
+
+	def __init__(self, max_entries=CACHE_SIZE, expiry=CACHE_EXPIRY):
+		"""Create a negative cache."""
+		if (max_entries < 1):
+			raise ValueError("NegativeCache must be able to hold at least one entry.")
+		if (expiry < 1):
+			raise ValueError("NegativeCache expiry must be at least 1 second.")
+
+		self.max_entries = max_entries
+		self.expiry = expiry
+		# every entry lasts for the same time,
+		# so keeping them in insertion order also keeps them sorted by expiry time
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+
+	def __len__(self):
+		with self.lock:
+			return len(self.entries)
+
+	def add(self, key):
+		"""Remember that key has no data, replacing any existing entry."""
+		with self.lock:
+			now = time.time()
+			self.entries.pop(key, None)
+			self.entries[key] = now + self.expiry
+
+			while (len(self.entries) > self.max_entries):
+				self.entries.popitem(last=False)
+
+			# clean up expired entries while we're here
+			while (len(self.entries) > 0):
+				(old_key, expires) = next(self.entries.iteritems())
+				if (expires > now):
+					break
+				del self.entries[old_key]
+
+	def contains(self, key):
+		"""Return True if key was recently found to have no data."""
+		with self.lock:
+			expires = self.entries.get(key)
+			if (expires == None):
+				return False
+			if (expires <= time.time()):
+				del self.entries[key]
+				return False
+			self.hits += 1
+			return True
+
+	def discard(self, key):
+		"""Forget about key, e.g. because we now have data for it."""
+		with self.lock:
+			self.entries.pop(key, None)
+
+	def get_hit_count(self):
+		"""Return the number of times contains() has found a key."""
+		with self.lock:
+			return self.hits
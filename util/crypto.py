@@ -21,6 +21,8 @@ Cryptography-related functions.
 import base64
 import hashlib
 import re
+import threading
+import time
 
 from M2Crypto import BIO, RSA
 
@@ -41,6 +43,77 @@ def sign_content(content, private_key):
 
 	return sig
 
+
+class Signer(object):
+	"""
+	Sign content with a private key that is only parsed once.
+
+	Loading the PEM-encoded key is expensive compared to signing itself,
+	so keep the parsed key around and reuse it for every signature.
+	Each thread loads its own copy of the key the first time it signs something,
+	so a single Signer can be safely shared by all web server threads.
+	"""
+
+	def __init__(self, private_key):
+		"""Create a new Signer for the given PEM-encoded private key."""
+		if not (validate_private_rsa(private_key)):
+			raise ValueError("Signer requires a valid private RSA key.")
+
+		self.private_key = private_key
+		self.local = threading.local()
+
+		# track how long signing takes so we can measure performance
+		self.stats_lock = threading.Lock()
+		self.sign_count = 0
+		self.total_sign_time = 0.0 # seconds
+		self.max_sign_time = 0.0 # seconds
+
+		# load the key now so any problems are reported on startup
+		# rather than on the first request
+		self._get_rsa()
+
+	def _get_rsa(self):
+		"""Return the parsed private key for the current thread, loading it if necessary."""
+		rsa_priv = getattr(self.local, 'rsa_priv', None)
+		if (rsa_priv == None):
+			bio = BIO.MemoryBuffer(self.private_key)
+			rsa_priv = RSA.load_key_bio(bio)
+			self.local.rsa_priv = rsa_priv
+		return rsa_priv
+
+	def sign_raw(self, content):
+		"""Sign content and return the raw signature bytes."""
+		start = time.time()
+
+		m = hashlib.md5()
+		m.update(content)
+		sig_raw = self._get_rsa().sign(m.digest(), 'md5')
+
+		elapsed = time.time() - start
+		with self.stats_lock:
+			self.sign_count += 1
+			self.total_sign_time += elapsed
+			if (elapsed > self.max_sign_time):
+				self.max_sign_time = elapsed
+
+		return sig_raw
+
+	def sign(self, content):
+		"""Sign content and return the base64-encoded signature."""
+		return base64.standard_b64encode(self.sign_raw(content))
+
+	def get_stats(self):
+		"""
+		Return a tuple of (number of signatures,
+		average seconds per signature, maximum seconds for one signature).
+		"""
+		with self.stats_lock:
+			average = 0.0
+			if (self.sign_count > 0):
+				average = self.total_sign_time / self.sign_count
+			return (self.sign_count, average, self.max_sign_time)
+
+
 def validate_public_rsa(key):
 	"""Check if a key is a valid public RSA key."""
 	return validate_rsa_key(key, "public")
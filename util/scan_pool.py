@@ -0,0 +1,179 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Scan services in the background with a fixed pool of worker threads.
+"""
+
+import itertools
+import logging
+import threading
+import time
+import Queue
+
+
+class _ScanJob(object):
+	"""A service waiting to be scanned or being scanned."""
+
+	def __init__(self, service, priority):
+		self.service = service
+		self.priority = priority
+		self.submit_time = time.time()
+		self.done = threading.Event()
+
+
+class ScanPool(object):
+	"""
+	Scan services in the background with a fixed number of long-lived worker threads.
+
+	Services wait in a bounded priority queue until a worker is free.
+	Each service is only queued or scanned once at a time;
+	submitting a service that is already waiting or being scanned does nothing.
+	"""
+
+	# results from submit()
+	QUEUED = 'queued'
+	ALREADY_QUEUED = 'already queued'
+	QUEUE_FULL = 'queue full'
+
+	# lower numbers are scanned first
+	PRIORITY_HIGH = 0
+	PRIORITY_NORMAL = 1
+
+	def __init__(self, scan_func, num_threads, max_queue_size):
+		"""
+		Start num_threads workers that call scan_func(service) for each submitted service.
+
+		Exceptions raised by scan_func are logged and otherwise ignored.
+		"""
+		if (num_threads < 1):
+			raise ValueError("ScanPool needs at least one worker thread.")
+		if (max_queue_size < 1):
+			raise ValueError("ScanPool needs room for at least one queued service.")
+
+		self.scan_func = scan_func
+		self.queue = Queue.PriorityQueue(max_queue_size)
+		# keep services in the order they were submitted within each priority
+		self.counter = itertools.count()
+
+		self.lock = threading.Lock()
+		self.jobs = {} # service name -> _ScanJob, for services waiting or being scanned
+		self.submitted_count = 0
+		self.duplicate_count = 0
+		self.rejected_count = 0
+		self.finished_count = 0
+		self.total_wait_time = 0.0
+		self.max_wait_time = 0.0
+		self.total_scan_time = 0.0
+		self.max_scan_time = 0.0
+
+		self.workers = []
+		for i in range(num_threads):
+			t = threading.Thread(target=self._work, name="ScanPoolWorker-{0}".format(i))
+			# don't keep the process alive just for idle workers
+			t.daemon = True
+			t.start()
+			self.workers.append(t)
+
+	def submit(self, service, priority=PRIORITY_NORMAL):
+		"""
+		Queue a service to be scanned.
+
+		Returns QUEUED, ALREADY_QUEUED if the service is already waiting or being scanned,
+		or QUEUE_FULL if there is no room to queue it.
+		"""
+		with self.lock:
+			if (service in self.jobs):
+				self.duplicate_count += 1
+				return self.ALREADY_QUEUED
+
+			job = _ScanJob(service, priority)
+			try:
+				self.queue.put_nowait((priority, next(self.counter), job))
+			except Queue.Full:
+				self.rejected_count += 1
+				return self.QUEUE_FULL
+
+			self.jobs[service] = job
+			self.submitted_count += 1
+			return self.QUEUED
+
+	def stop(self):
+		"""Stop all workers once they have finished the services already queued."""
+		for t in self.workers:
+			# sort after every real priority so queued services are scanned first.
+			# each worker only takes one of these and then exits.
+			self.queue.put((float('inf'), next(self.counter), None))
+		for t in self.workers:
+			t.join()
+
+	def wait(self, service, timeout):
+		"""
+		Wait up to 'timeout' seconds for any queued or running scan of service to finish.
+
+		Returns True if the service is no longer waiting or being scanned.
+		"""
+		with self.lock:
+			job = self.jobs.get(service)
+		if (job == None):
+			return True
+		return job.done.wait(timeout)
+
+	def get_queue_depth(self):
+		"""Return the number of services waiting for a worker."""
+		return self.queue.qsize()
+
+	def get_stats(self):
+		"""Return a dictionary of statistics about queued and finished scans."""
+		with self.lock:
+			finished = self.finished_count
+			return {
+				'queue_depth': self.queue.qsize(),
+				'in_progress': len(self.jobs) - self.queue.qsize(),
+				'submitted': self.submitted_count,
+				'duplicates': self.duplicate_count,
+				'rejected': self.rejected_count,
+				'finished': finished,
+				'avg_wait_time': (self.total_wait_time / finished) if finished else 0.0,
+				'max_wait_time': self.max_wait_time,
+				'avg_scan_time': (self.total_scan_time / finished) if finished else 0.0,
+				'max_scan_time': self.max_scan_time,
+			}
+
+	def _work(self):
+		"""Scan services from the queue until we are stopped."""
+		while True:
+			(priority, count, job) = self.queue.get()
+			if (job == None):
+				return
+
+			start = time.time()
+			try:
+				self.scan_func(job.service)
+			except Exception as e:
+				logging.exception(e)
+			finally:
+				end = time.time()
+				wait_time = start - job.submit_time
+				scan_time = end - start
+				with self.lock:
+					del self.jobs[job.service]
+					self.finished_count += 1
+					self.total_wait_time += wait_time
+					self.max_wait_time = max(self.max_wait_time, wait_time)
+					self.total_scan_time += scan_time
+					self.max_scan_time = max(self.max_scan_time, scan_time)
+				job.done.set()
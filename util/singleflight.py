@@ -0,0 +1,100 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Coalesce duplicate work so that only one thread at a time calculates the value for a given key.
+"""
+
+import threading
+
+
+class SingleFlightTimeout(Exception):
+	"""Raised when a caller gives up waiting for another thread's result."""
+	pass
+
+
+class _Flight(object):
+	"""The result of one in-progress call, shared with every thread waiting for it."""
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+
+class SingleFlight(object):
+	"""
+	Make sure only one thread at a time does the work for a given key.
+
+	The first thread to ask for a key runs the function.
+	Any other thread that asks for the same key while that is happening
+	waits for the first thread to finish and receives the same result
+	(or has the same exception raised).
+	Once the function finishes the key is forgotten,
+	so the next call does the work again.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.flights = {}
+		self.coalesced_count = 0
+		self.timeout_count = 0
+
+	def do(self, key, func, timeout):
+		"""
+		Return the result of func(), sharing it with any other callers for the same key.
+
+		Raises SingleFlightTimeout if another thread is already running func()
+		and does not finish within 'timeout' seconds.
+		"""
+		with self.lock:
+			flight = self.flights.get(key)
+			if (flight == None):
+				flight = _Flight()
+				self.flights[key] = flight
+				leader = True
+			else:
+				self.coalesced_count += 1
+				leader = False
+
+		if (leader):
+			try:
+				flight.result = func()
+				return flight.result
+			except Exception as e:
+				flight.error = e
+				raise
+			finally:
+				with self.lock:
+					del self.flights[key]
+				flight.done.set()
+
+		if not (flight.done.wait(timeout)):
+			with self.lock:
+				self.timeout_count += 1
+			raise SingleFlightTimeout("Timed out after {0} seconds waiting for '{1}'.".format(timeout, key))
+
+		if (flight.error != None):
+			raise flight.error
+		return flight.result
+
+	def get_stats(self):
+		"""
+		Return a tuple of (number of calls that waited for another thread's result,
+		number of those that timed out).
+		"""
+		with self.lock:
+			return (self.coalesced_count, self.timeout_count)
@@ -0,0 +1,463 @@
+#   This file is part of the Perspectives Notary Server
+#
+#   Copyright (C) 2011 Dan Wendlandt
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, version 3 of the License.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Scan many SSL services at once from a single thread.
+
+Rather than using one thread per scan, this scanner uses non-blocking sockets
+and a single event loop (epoll or poll), so thousands of handshakes
+can be in progress at the same time.
+The standard library has no non-blocking DNS lookup,
+so host names are looked up by a small pool of resolver threads.
+
+The ClientHello messages and TLS record parsing are shared with util/ssl_scan_sock.py,
+so both scanners send and accept exactly the same data.
+"""
+
+import binascii
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+import time
+import Queue
+
+from util.ssl_scan_sock import _can_use_sni, _get_fingerprint_from_record, _get_sni_client_hello, \
+	_get_standard_client_hello, _parse_service, SSLAlertException, SSLScanTimeoutException
+
+
+DEFAULT_MAX_CONNECTIONS = 10000
+DEFAULT_RESOLVER_THREADS = 20
+# keep some file descriptors free for the database, log files, and so on
+RESERVED_FILES = 100
+READ_SIZE = 16384
+PAUSE_CHECK_SEC = 0.1
+RECORD_HEADER = struct.Struct('!BBBH') # type, major version, minor version, length
+
+
+def _set_nonblocking(fd):
+	"""Make reads and writes on a file descriptor return immediately."""
+	flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+	fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def _raise_file_limit(max_connections):
+	"""
+	Try to allow enough open files for max_connections sockets.
+	Return the number of connections we can actually use.
+	"""
+	try:
+		import resource
+		(soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+		wanted = max_connections + RESERVED_FILES
+		if (soft != resource.RLIM_INFINITY and soft < wanted):
+			if (hard == resource.RLIM_INFINITY or hard >= wanted):
+				soft = wanted
+			else:
+				soft = hard
+			resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+		if (soft != resource.RLIM_INFINITY and soft - RESERVED_FILES < max_connections):
+			logging.warning("Only {0} files can be open at once; scanning at most {1} services at a time.".format(
+				soft, soft - RESERVED_FILES))
+			return max(1, soft - RESERVED_FILES)
+	except (ImportError, ValueError) as e:
+		logging.warning("Could not check the limit on open files: '{0}'.".format(e))
+	return max_connections
+
+
+class _Poller(object):
+	"""Wait for events on many sockets, using epoll if it's available and poll otherwise."""
+
+	def __init__(self):
+		if hasattr(select, 'epoll'):
+			self.poller = select.epoll()
+			self.timeout_scale = 1 # seconds
+			self.READ = select.EPOLLIN
+			self.WRITE = select.EPOLLOUT
+			self.ERROR = select.EPOLLERR | select.EPOLLHUP
+		elif hasattr(select, 'poll'):
+			self.poller = select.poll()
+			self.timeout_scale = 1000 # milliseconds
+			self.READ = select.POLLIN
+			self.WRITE = select.POLLOUT
+			self.ERROR = select.POLLERR | select.POLLHUP
+		else:
+			raise NotImplementedError("Scanning with an event loop requires select.epoll() or select.poll().")
+
+	def register(self, fd, events):
+		self.poller.register(fd, events)
+
+	def modify(self, fd, events):
+		self.poller.modify(fd, events)
+
+	def unregister(self, fd):
+		self.poller.unregister(fd)
+
+	def poll(self, timeout):
+		"""Return a list of (fd, events) tuples, waiting up to 'timeout' seconds for any to happen."""
+		try:
+			return self.poller.poll(timeout * self.timeout_scale)
+		except (IOError, select.error) as e:
+			if (e.args[0] == errno.EINTR):
+				return []
+			raise
+
+	def close(self):
+		if hasattr(self.poller, 'close'):
+			self.poller.close()
+
+
+class _Resolver(object):
+	"""Look up host names with a pool of threads, waking up the event loop when results are ready."""
+
+	def __init__(self, num_threads):
+		self.requests = Queue.Queue()
+		# deque appends and pops are thread-safe
+		self.results = collections.deque()
+
+		# the event loop watches this pipe; writing to it wakes the loop up
+		(self.wake_fd, self.notify_fd) = os.pipe()
+		_set_nonblocking(self.wake_fd)
+		_set_nonblocking(self.notify_fd)
+		self.stopped = False
+
+		self.threads = []
+		for i in range(num_threads):
+			t = threading.Thread(target=self._work, name="ScanResolver-{0}".format(i))
+			t.daemon = True
+			t.start()
+			self.threads.append(t)
+
+	def resolve(self, scan_id, host, port):
+		"""Start looking up the address for host."""
+		self.requests.put((scan_id, host, port))
+
+	def get_results(self):
+		"""Return a list of (scan_id, address, error) tuples for lookups that have finished."""
+		try:
+			while (os.read(self.wake_fd, 4096)):
+				pass
+		except OSError as e:
+			if (e.errno != errno.EAGAIN):
+				raise
+
+		results = []
+		while (len(self.results) > 0):
+			results.append(self.results.popleft())
+		return results
+
+	def close(self):
+		"""Stop the resolver threads and close the pipe."""
+		self.stopped = True
+		# nobody wants the lookups still waiting, e.g. for scans that have timed out
+		try:
+			while True:
+				self.requests.get_nowait()
+		except Queue.Empty:
+			pass
+		for t in self.threads:
+			self.requests.put(None)
+		# once the pipe is closed its fd numbers can be reused for other files or sockets,
+		# so no thread may still be about to write to it
+		for t in self.threads:
+			t.join()
+		os.close(self.wake_fd)
+		os.close(self.notify_fd)
+
+	def _work(self):
+		while True:
+			request = self.requests.get()
+			if (request == None or self.stopped):
+				return
+
+			(scan_id, host, port) = request
+			try:
+				address = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+				self.results.append((scan_id, address, None))
+			except (socket.error, UnicodeError) as e:
+				# socket.gaierror and socket.herror are both socket.errors
+				self.results.append((scan_id, None, e))
+
+			if (self.stopped):
+				return
+			try:
+				os.write(self.notify_fd, 'x')
+			except OSError:
+				# the pipe is full, so the event loop already knows there is work to do
+				pass
+
+
+class _Scan(object):
+	"""The state of one service scan."""
+
+	def __init__(self, scan_id, service, host, port, sni):
+		self.scan_id = scan_id
+		self.service = service
+		self.host = host
+		self.port = port
+		self.sni = sni
+		self.deadline = None
+		self.address = None
+		self.sock = None
+		self.connected = False
+		self.to_send = ''
+		self.received = ''
+
+
+class AsyncScanner(object):
+	"""
+	Scan many SSL services at the same time with non-blocking sockets and a single event loop.
+
+	Each scan has 'timeout_sec' seconds to finish, including looking up the host name.
+	As with attempt_observation_for_service(), if use_sni is True
+	and the server replies to an SNI request with an SSL alert,
+	the service is scanned again without SNI.
+	"""
+
+	def __init__(self, timeout_sec, use_sni=False, max_connections=DEFAULT_MAX_CONNECTIONS,
+			resolver_threads=DEFAULT_RESOLVER_THREADS):
+		if (max_connections < 1):
+			raise ValueError("AsyncScanner needs at least one connection.")
+		self.timeout_sec = timeout_sec
+		self.use_sni = use_sni
+		self.max_connections = _raise_file_limit(max_connections)
+		self.resolver_threads = resolver_threads
+		self.scans = {} # scan id -> _Scan
+		self.fds = {} # file descriptor -> _Scan
+
+	def get_active_count(self):
+		"""Return the number of scans in progress."""
+		return len(self.scans)
+
+	def scan(self, services, rate, on_result, can_start=None):
+		"""
+		Scan services, starting at most 'rate' scans per second (or as fast as possible if rate is None).
+
+		on_result(service, fingerprint, error) is called from this thread as each scan finishes.
+		If the scan succeeded error is None; otherwise fingerprint is None and error is the exception
+		that stopped the scan (the same exceptions attempt_observation_for_service() can raise,
+		plus socket errors).
+		If can_start is given, no new scans are started while can_start() returns False
+		(e.g. while results are waiting to be saved); scans already in progress continue.
+		Returns once every service has been scanned.
+		"""
+		self.on_result = on_result
+		self.poller = _Poller()
+		self.resolver = _Resolver(self.resolver_threads)
+		self.poller.register(self.resolver.wake_fd, self.poller.READ)
+		self.deadlines = [] # heap of (deadline, scan id)
+		scan_ids = itertools.count()
+
+		services = iter(services)
+		more_services = True
+		next_start = time.time()
+
+		try:
+			while (more_services or len(self.scans) > 0):
+				now = time.time()
+
+				while (more_services and len(self.scans) < self.max_connections and
+					(rate == None or next_start <= now) and (can_start == None or can_start())):
+					try:
+						service = next(services)
+					except StopIteration:
+						more_services = False
+						break
+					self._start(next(scan_ids), service, now)
+					if (rate != None):
+						# if we have fallen behind, catch up by at most a second's worth of scans
+						next_start = max(next_start, now - 1) + (1.0 / rate)
+
+				wait = 1.0
+				if (len(self.deadlines) > 0):
+					wait = min(wait, self.deadlines[0][0] - now)
+				if (more_services and rate != None and len(self.scans) < self.max_connections):
+					wait = min(wait, next_start - now)
+				if (more_services and can_start != None):
+					# check again soon in case we were paused
+					wait = min(wait, PAUSE_CHECK_SEC)
+
+				for (fd, events) in self.poller.poll(max(wait, 0)):
+					if (fd == self.resolver.wake_fd):
+						for (scan_id, address, error) in self.resolver.get_results():
+							self._on_resolved(scan_id, address, error)
+					elif (fd in self.fds):
+						self._on_socket_event(self.fds[fd], events)
+
+				self._expire(time.time())
+		finally:
+			for scan in self.scans.values():
+				self._close_socket(scan)
+			self.scans = {}
+			self.resolver.close()
+			self.poller.close()
+
+	def _start(self, scan_id, service, now):
+		"""Start scanning a service by looking up its address."""
+		try:
+			(host, port) = _parse_service(service)
+		except ValueError as e:
+			self._report(service, None, e)
+			return
+
+		sni = False
+		if (self.use_sni):
+			if not (_can_use_sni(host)):
+				self._report(service, None, ValueError("Service '{0}' must be of the form 'host:port'".format(service)))
+				return
+			sni = True
+
+		scan = _Scan(scan_id, service, host, int(port), sni)
+		self.scans[scan_id] = scan
+		self._set_deadline(scan, now)
+		self.resolver.resolve(scan_id, host, scan.port)
+
+	def _set_deadline(self, scan, now):
+		scan.deadline = now + self.timeout_sec
+		heapq.heappush(self.deadlines, (scan.deadline, scan.scan_id))
+
+	def _on_resolved(self, scan_id, address, error):
+		scan = self.scans.get(scan_id)
+		if (scan == None):
+			# the scan has already timed out
+			return
+		if (error != None):
+			self._finish(scan, None, error)
+			return
+		scan.address = address
+		self._connect(scan)
+
+	def _connect(self, scan):
+		"""Start connecting to the server and queue up the ClientHello."""
+		if (scan.sni):
+			client_hello_hex = _get_sni_client_hello(scan.host)
+		else:
+			client_hello_hex = _get_standard_client_hello()
+		scan.to_send = binascii.a2b_hex(client_hello_hex)
+		scan.received = ''
+		scan.connected = False
+
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setblocking(0)
+		err = sock.connect_ex(scan.address)
+		if (err not in (0, errno.EINPROGRESS, errno.EAGAIN, errno.EWOULDBLOCK)):
+			sock.close()
+			self._finish(scan, None, socket.error(err, os.strerror(err)))
+			return
+
+		scan.sock = sock
+		self.fds[sock.fileno()] = scan
+		self.poller.register(sock.fileno(), self.poller.WRITE | self.poller.ERROR)
+
+	def _on_socket_event(self, scan, events):
+		try:
+			if not (scan.connected):
+				err = scan.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+				if (err != 0):
+					raise socket.error(err, os.strerror(err))
+				scan.connected = True
+
+			if (len(scan.to_send) > 0):
+				sent = scan.sock.send(scan.to_send)
+				scan.to_send = scan.to_send[sent:]
+				if (len(scan.to_send) == 0):
+					self.poller.modify(scan.sock.fileno(), self.poller.READ | self.poller.ERROR)
+				return
+
+			data = scan.sock.recv(READ_SIZE)
+			if (len(data) == 0):
+				raise socket.error(errno.ECONNRESET, "Connection closed by the server")
+			scan.received += data
+
+			fp = self._read_records(scan)
+			if (fp != None):
+				self._finish(scan, fp, None)
+
+		except socket.error as e:
+			if (e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)):
+				return
+			self._finish(scan, None, e)
+		except SSLAlertException as e:
+			if (scan.sni):
+				logging.error("Received SSL Alert during SNI scan of {0}:{1} - '{2}'.".format(scan.host, scan.port, e) +\
+					" Will re-run with non-SNI scan.")
+				self._close_socket(scan)
+				scan.sni = False
+				self._set_deadline(scan, time.time())
+				self._connect(scan)
+			else:
+				self._finish(scan, None, e)
+		except Exception as e:
+			# e.g. struct.error from a badly formed record
+			self._finish(scan, None, e)
+
+	def _read_records(self, scan):
+		"""Read all complete TLS records received so far. Return the server's fingerprint if we found it."""
+		received = scan.received
+		while (len(received) >= RECORD_HEADER.size):
+			(rec_type, ssl_version, tls_version, rec_length) = RECORD_HEADER.unpack_from(received)
+			rec_end = RECORD_HEADER.size + rec_length
+			if (len(received) < rec_end):
+				break
+			rec_data = received[RECORD_HEADER.size:rec_end]
+			received = received[rec_end:]
+
+			fp = _get_fingerprint_from_record(rec_type, rec_data)
+			if (fp != None):
+				return fp
+		scan.received = received
+		return None
+
+	def _expire(self, now):
+		"""Stop scans that have run out of time."""
+		while (len(self.deadlines) > 0 and self.deadlines[0][0] <= now):
+			(deadline, scan_id) = heapq.heappop(self.deadlines)
+			scan = self.scans.get(scan_id)
+			# skip scans that have already finished or been restarted with a new deadline
+			if (scan != None and scan.deadline == deadline):
+				self._finish(scan, None,
+					SSLScanTimeoutException("timeout waiting for data after {0}s".format(self.timeout_sec)))
+
+	def _close_socket(self, scan):
+		if (scan.sock == None):
+			return
+		fd = scan.sock.fileno()
+		if (fd in self.fds):
+			del self.fds[fd]
+			self.poller.unregister(fd)
+		try:
+			scan.sock.close()
+		except socket.error:
+			pass
+		scan.sock = None
+
+	def _finish(self, scan, fp, error):
+		self._close_socket(scan)
+		del self.scans[scan.scan_id]
+		self._report(scan.service, fp, error)
+
+	def _report(self, service, fp, error):
+		try:
+			self.on_result(service, fp, error)
+		except Exception as e:
+			# don't let a problem with one result stop every other scan
+			logging.exception(e)
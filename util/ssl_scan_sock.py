@@ -26,6 +26,7 @@ import errno
 import hashlib
 import logging
 import os
+import select
 import socket
 import struct
 import sys
@@ -33,8 +34,6 @@ import time
 import traceback
 
 
-SLEEP_LEN_SEC = 0.2
-
 class SSLScanTimeoutException(Exception): 
 	pass
 
@@ -102,71 +101,96 @@ class SSLAlertException(Exception):
 		return self.value
 
 
-def _read_data(s,data_len, timeout_sec):
-	buf_str = ""
-	start_time = time.time()
-	while(True): 
+def _wait_for_socket(s, for_write, deadline):
+	"""
+	Wait until the socket is ready to read from (or write to, if for_write is True).
+	Return False if the deadline passes first.
+	"""
+	while True:
+		remaining = deadline - time.time()
+		if remaining <= 0:
+			return False
 		try:
-			buf_str += s.recv(data_len - len(buf_str))
-			if len(buf_str) == data_len:
-				break
-		except socket.error, e:
-			if not _is_nonblocking_exception(e):
+			if hasattr(select, 'poll'):
+				# prefer poll() - select() can't handle file descriptors above 1024,
+				# which the threaded scanner easily reaches
+				p = select.poll()
+				p.register(s, select.POLLOUT if for_write else select.POLLIN)
+				# errors and hangups are always reported;
+				# the next socket call will raise them
+				if p.poll(remaining * 1000):
+					return True
+			else:
+				(readable, writable, errors) = select.select(
+					[] if for_write else [s], [s] if for_write else [], [s], remaining)
+				if readable or writable or errors:
+					return True
+		except (select.error, IOError), e:
+			if e.args[0] != errno.EINTR:
 				raise
-		if time.time() - start_time > timeout_sec: 
+
+def _read_data(s, data_len, deadline, timeout_sec):
+	buf_str = ""
+	while len(buf_str) < data_len:
+		if not _wait_for_socket(s, False, deadline):
 			raise SSLScanTimeoutException("timeout in _read_data after {0}s".format(timeout_sec))
-		time.sleep(SLEEP_LEN_SEC)
+		try:
+			data = s.recv(data_len - len(buf_str))
+		except socket.error, e:
+			if _is_nonblocking_exception(e):
+				continue
+			raise
+		if len(data) == 0:
+			raise socket.error(errno.ECONNRESET, "Connection closed by the server")
+		buf_str += data
 	return buf_str
 
-def _send_data(s, data, timeout_sec):
-	start_time = time.time() 
-	while(True): 
+def _send_data(s, data, deadline, timeout_sec):
+	while len(data) > 0:
+		if not _wait_for_socket(s, True, deadline):
+			raise SSLScanTimeoutException("timeout in _send_data after {0}s".format(timeout_sec))
 		try:
-			s.send(data)
-			break 
-		except socket.error, e: 
+			sent = s.send(data)
+		except socket.error, e:
 			if _is_nonblocking_exception(e):
-				if time.time() - start_time > timeout_sec: 
-					raise SSLScanTimeoutException("timeout in _send_data after {0}s".format(timeout_sec))
-				time.sleep(SLEEP_LEN_SEC)
-			else: 
-				raise
+				continue
+			raise
+		data = data[sent:]
 
 def _is_nonblocking_exception(e):
 	try: 
 		return e.args[0] == errno.EAGAIN or \
+		       e.args[0] == errno.EWOULDBLOCK or \
 		       e.args[0] == errno.EINPROGRESS or \
 		       e.args[0] == errno.EALREADY 
 	except: 
 		return False
 	
-def _do_connect(s, host, port, timeout_sec):
-	start_time = time.time() 
-	while(True): 
-		try:
-			s.connect((host, port))
-			break 
-		except socket.error, e:
-			if e.args[0] == errno.EISCONN: 
-				break
-			if _is_nonblocking_exception(e):
-				if time.time() - start_time > timeout_sec: 
-					raise SSLScanTimeoutException("timeout in _do_connect after {0}s".format(timeout_sec))
-				time.sleep(SLEEP_LEN_SEC) 
-			else: 
-				raise
-
-def _read_record(sock,timeout_sec):
+def _do_connect(s, host, port, deadline, timeout_sec):
+	err = s.connect_ex((host, port))
+	if err == 0 or err == errno.EISCONN:
+		return
+	if not _is_nonblocking_exception(socket.error(err)):
+		raise socket.error(err, os.strerror(err))
+
+	# a non-blocking connect is finished once the socket is writable
+	if not _wait_for_socket(s, True, deadline):
+		raise SSLScanTimeoutException("timeout in _do_connect after {0}s".format(timeout_sec))
+	err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+	if err != 0:
+		raise socket.error(err, os.strerror(err))
+
+def _read_record(sock, deadline, timeout_sec):
 	"""
 	Decipher a TLS record.
 	Return the record type and (still packed) record data.
 	"""
-	rec_start = _read_data(sock,5,timeout_sec)
+	rec_start = _read_data(sock, 5, deadline, timeout_sec)
 	if len(rec_start) != 5: 
 		raise Exception("Error: unable to read start of record")
 
 	(rec_type, ssl_version, tls_version, rec_length) = struct.unpack('!BBBH',rec_start)
-	rest_of_rec = _read_data(sock,rec_length,timeout_sec)
+	rest_of_rec = _read_data(sock, rec_length, deadline, timeout_sec)
 	if len(rest_of_rec) != rec_length: 
 		raise Exception("Error: unable to read full record")
 	return (rec_type, rest_of_rec)
@@ -202,12 +226,29 @@ def _get_server_cert_from_protocol(proto_data):
 	for i in range(len(digest_raw)):
 		fp += binascii.b2a_hex(digest_raw[i]) + ":"
 	return fp[:-1] 
+
+def _get_fingerprint_from_record(rec_type, rec_data):
+	"""
+	Look for the server certificate in a TLS record.
+	Return its fingerprint, or None if the record doesn't contain it.
+	"""
+	if rec_type == 22: # handshake message
+		all_hs_protos = _get_all_handshake_protocols(rec_data)
+		for p in all_hs_protos: 
+			if p[0] == 11: 
+				# server certificate message
+				return _get_server_cert_from_protocol(p[1])
+	elif rec_type == 21: # alert message
+		raise SSLAlertException(rec_data) 
+	return None
 		
 def _run_scan(dns, port, timeout_sec, sni_query):
 	"""
 	Perform an SSL handshake with the given server and port.
 	If possible, retrieve the server's x509 certificate.
+	The whole handshake must finish within timeout_sec.
 	"""
+	deadline = time.time() + timeout_sec
 	try: 	
 		if sni_query:
 			# only do SNI query for DNS names, per RFC
@@ -218,34 +259,20 @@ def _run_scan(dns, port, timeout_sec, sni_query):
 		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		if os.name != "nt":
 			sock.setblocking(0)
-		_do_connect(sock, dns, int(port),timeout_sec)
+		_do_connect(sock, dns, int(port), deadline, timeout_sec)
 		client_hello = binascii.a2b_hex(client_hello_hex)
-		_send_data(sock, client_hello,timeout_sec)
+		_send_data(sock, client_hello, deadline, timeout_sec)
 	
+		# each read raises SSLScanTimeoutException once the deadline passes
 		fp = None
-		start_time = time.time() 
 		while not fp: 
-			t,rec_data = _read_record(sock,timeout_sec)
-			if t == 22: # handshake message
-				all_hs_protos = _get_all_handshake_protocols(rec_data)
-				for p in all_hs_protos: 
-					if p[0] == 11: 
-						# server certificate message
-						fp = _get_server_cert_from_protocol(p[1])
-						break
-			elif t == 21: # alert message
-				raise SSLAlertException(rec_data) 
+			t,rec_data = _read_record(sock, deadline, timeout_sec)
+			fp = _get_fingerprint_from_record(t, rec_data)
 	
-			if not fp: 
-				time.sleep(SLEEP_LEN_SEC)
-				if time.time() - start_time > timeout_sec: 
-					break
 		try: 
 			sock.shutdown(socket.SHUT_RDWR) 
 		except: 
 			pass
-		if not fp: 
-			raise SSLScanTimeoutException("timeout waiting for data after {0}s".format(timeout_sec))
 		sock.close()
 		return fp 
 
@@ -283,8 +310,8 @@ def _get_sni_client_hello(hostname):
 	rec_len = proto_len + 4
 	return "160301" + _get_twobyte_hexstr(rec_len) + "01" + _get_threebyte_hexstr(proto_len) + the_rest
 
-def attempt_observation_for_service(service, timeout_sec, use_sni=False):
-
+def _parse_service(service):
+	"""Split a service name such as 'github.com:443,2' into its host and port."""
 	try:
 		dns, port = service.split(",")[0].split(":")
 	except (ValueError):
@@ -293,10 +320,21 @@ def attempt_observation_for_service(service, timeout_sec, use_sni=False):
 	if not port.isdigit():
 		raise ValueError("Port '{0}' must be a number.".format(port))
 
+	return (dns, port)
+
+def _can_use_sni(dns):
+	"""Return True if we should send an SNI request to this host."""
+	# only do SNI query for DNS names, per RFC
+	return dns[-1:].isalpha()
+
+def attempt_observation_for_service(service, timeout_sec, use_sni=False):
+
+	dns, port = _parse_service(service)
+
 	# if we want to try SNI, do such a scan but if that
 	# scan fails with an SSL alert, retry with a non SNI request
 	if use_sni:
-		if dns[-1:].isalpha():
+		if _can_use_sni(dns):
 			try:
 				return _run_scan(dns,port,timeout_sec,True)
 			except SSLAlertException as e: